@@ -0,0 +1,242 @@
+# Persistent artifact cache
+#
+# Keeps downloaded tarballs and snapshots of built install trees (ruby, git)
+# outside of /tmp, so that a redeployed or newly added unit can restore a
+# toolchain instead of downloading and compiling it again.
+#
+# Layout of the cache directory:
+#
+#   <path>/<name>-<version>/<filename>       downloaded artifact
+#   <path>/<name>-<version>/meta.json        sha256, size and source
+#   <path>/<name>-<version>.tree/tree.tar.gz snapshot of an install tree
+#   <path>/<name>-<version>.tree/meta.json
+#
+# The mtime of meta.json is bumped on every hit, eviction removes the least
+# recently used entries until the cache fits into max_size bytes.
+import glob
+import hashlib
+import json
+import logging
+import os
+import os.path
+import shutil
+import tarfile
+import tempfile
+import threading
+import urllib.parse
+import urllib.request
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CACHE_DIR = "/var/cache/gitlab-charm/artifacts"
+DEFAULT_MAX_SIZE = 8 * 1024 ** 3
+
+META_FILE = "meta.json"
+TREE_FILE = "tree.tar.gz"
+TREE_SUFFIX = ".tree"
+
+
+class ArtifactError(Exception):
+    """Raised when an artifact cannot be fetched or fails verification."""
+
+
+def sha256sum(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class ArtifactCache:
+    """Size bounded, LRU evicted cache of downloads and install trees.
+
+    mirror is an optional local directory, file:// or http(s):// base URL
+    that is tried before the upstream URL, artifacts are looked up there by
+    file name. With a local mirror no network access is needed.
+    """
+
+    def __init__(self, path=DEFAULT_CACHE_DIR, max_size=DEFAULT_MAX_SIZE, mirror=None):
+        self.path = path
+        self.max_size = max_size
+        self.mirror = mirror or None
+        self._lock = threading.Lock()
+
+    def _entry(self, name, version, suffix=""):
+        return os.path.join(self.path, "{}-{}{}".format(name, version, suffix))
+
+    def _read_meta(self, entry):
+        try:
+            with open(os.path.join(entry, META_FILE)) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _write_meta(self, entry, meta):
+        with open(os.path.join(entry, META_FILE), "w") as f:
+            json.dump(meta, f)
+
+    def _touch(self, entry):
+        os.utime(os.path.join(entry, META_FILE))
+
+    def _sources(self, url):
+        filename = os.path.basename(urllib.parse.urlparse(url).path)
+        if self.mirror:
+            if "://" in self.mirror:
+                yield self.mirror.rstrip("/") + "/" + filename
+            else:
+                yield "file://" + os.path.join(os.path.abspath(self.mirror), filename)
+        yield url
+
+    def _download(self, source, target):
+        logger.debug("download %s", source)
+        with urllib.request.urlopen(source) as response, open(target, "wb") as f:
+            shutil.copyfileobj(response, f, 1024 * 1024)
+
+    def lookup(self, name, version, sha256=None):
+        """Return the cached artifact path or None."""
+        entry = self._entry(name, version)
+        meta = self._read_meta(entry)
+        if meta is None:
+            return None
+        path = os.path.join(entry, meta["filename"])
+        if not os.path.isfile(path):
+            return None
+        if sha256 and meta["sha256"] != sha256:
+            return None
+        self._touch(entry)
+        return path
+
+    def fetch(self, name, version, url, sha256=None):
+        """Return a local path of the artifact, downloading it if needed.
+
+        When sha256 is given the download is verified against it, a
+        mismatching download is discarded and the next source is tried.
+        """
+        path = self.lookup(name, version, sha256)
+        if path:
+            logger.debug("artifact cache hit: %s-%s", name, version)
+            return path
+
+        entry = self._entry(name, version)
+        filename = os.path.basename(urllib.parse.urlparse(url).path)
+        os.makedirs(entry, exist_ok=True)
+        errors = []
+        for source in self._sources(url):
+            fd, tmp = tempfile.mkstemp(dir=entry, prefix=".download-")
+            os.close(fd)
+            try:
+                self._download(source, tmp)
+                digest = sha256sum(tmp)
+                if sha256 and digest != sha256:
+                    raise ArtifactError("checksum mismatch, expected {} got {}"
+                                        "".format(sha256, digest))
+            except (OSError, ArtifactError) as e:
+                os.unlink(tmp)
+                errors.append("{}: {}".format(source, e))
+                continue
+            path = os.path.join(entry, filename)
+            os.replace(tmp, path)
+            self._write_meta(entry, {"filename": filename, "sha256": digest,
+                                     "size": os.path.getsize(path), "source": source})
+            self.evict(keep=entry)
+            return path
+        raise ArtifactError("Unable to fetch {}-{}: {}".format(name, version, "; ".join(errors)))
+
+    def snapshot(self, name, version, root, paths=(".",)):
+        """Store the given paths (globs relative to root) as an install tree."""
+        entry = self._entry(name, version, TREE_SUFFIX)
+        os.makedirs(entry, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=entry, prefix=".snapshot-")
+        os.close(fd)
+        members = []
+        for pattern in paths:
+            matches = sorted(glob.glob(os.path.join(root, pattern)))
+            members.extend(os.path.relpath(m, root) for m in matches)
+        if not members:
+            os.unlink(tmp)
+            raise ArtifactError("Nothing to snapshot for {}-{} in {}".format(name, version, root))
+        with tarfile.open(tmp, "w:gz", compresslevel=1) as tar:
+            for member in members:
+                tar.add(os.path.join(root, member), arcname=member)
+        path = os.path.join(entry, TREE_FILE)
+        os.replace(tmp, path)
+        self._write_meta(entry, {"filename": TREE_FILE, "sha256": sha256sum(path),
+                                 "size": os.path.getsize(path), "source": root})
+        logger.debug("stored install tree %s-%s (%d bytes)", name, version,
+                     os.path.getsize(path))
+        self.evict(keep=entry)
+        return path
+
+    def restore(self, name, version, root="/"):
+        """Unpack a stored install tree into root, returns False on a miss."""
+        entry = self._entry(name, version, TREE_SUFFIX)
+        meta = self._read_meta(entry)
+        path = os.path.join(entry, TREE_FILE)
+        if meta is None or not os.path.isfile(path):
+            return False
+        if sha256sum(path) != meta["sha256"]:
+            logger.warning("install tree %s-%s is corrupt, dropping it", name, version)
+            shutil.rmtree(entry, ignore_errors=True)
+            return False
+        with tarfile.open(path, "r:gz") as tar:
+            tar.extractall(root)
+        self._touch(entry)
+        logger.debug("restored install tree %s-%s to %s", name, version, root)
+        return True
+
+    def add_entries(self, source, names=None):
+        """Copy the entries of another cache directory that are missing here.
+
+        Copies the given entry names (like "ruby-2.7.4" or "git-14-3-stable.tree")
+        or all entries. Used to build and to seed from an install bundle.
+        Returns the names of the copied entries.
+        """
+        added = []
+        os.makedirs(self.path, exist_ok=True)
+        for name in sorted(os.listdir(source) if names is None else names):
+            meta = self._read_meta(os.path.join(source, name))
+            if meta is None:
+                continue
+            entry = os.path.join(self.path, name)
+            if self._read_meta(entry) == meta:
+                continue
+            tmp = tempfile.mkdtemp(dir=self.path, prefix=".add-")
+            shutil.rmtree(tmp)
+            shutil.copytree(os.path.join(source, name), tmp)
+            shutil.rmtree(entry, ignore_errors=True)
+            os.rename(tmp, entry)
+            self._touch(entry)
+            added.append(name)
+        if added:
+            logger.debug("added %s to the artifact cache", ", ".join(added))
+            self.evict()
+        return added
+
+    def entries(self):
+        """Return (entry path, size, last use) tuples, least recently used first."""
+        result = []
+        if not os.path.isdir(self.path):
+            return result
+        for name in os.listdir(self.path):
+            entry = os.path.join(self.path, name)
+            meta = self._read_meta(entry)
+            if meta is None:
+                continue
+            used = os.path.getmtime(os.path.join(entry, META_FILE))
+            result.append((entry, meta.get("size", 0), used))
+        return sorted(result, key=lambda e: e[2])
+
+    def evict(self, keep=None):
+        """Remove least recently used entries until the cache fits max_size."""
+        with self._lock:
+            entries = self.entries()
+            total = sum(size for _, size, _ in entries)
+            for entry, size, _ in entries:
+                if total <= self.max_size:
+                    break
+                if entry == keep:
+                    continue
+                logger.debug("evict %s from artifact cache", entry)
+                shutil.rmtree(entry, ignore_errors=True)
+                total -= size
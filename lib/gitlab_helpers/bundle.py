@@ -0,0 +1,250 @@
+# Offline install bundle
+#
+# A bundle holds everything the install hook otherwise downloads, so a unit
+# can be installed without network access. It is built on an installed unit
+# by the build-bundle action and handed to other units as the install-bundle
+# resource or through the install_bundle config option.
+#
+# Layout:
+#
+#   manifest.json             format, platform, sha256 and size of every file
+#   artifacts/                artifact cache entries: ruby and go tarballs,
+#                             the ruby and git install trees
+#   debs/                     .debs of the package manifest and their
+#                             dependencies, with a Packages index
+#   git/<name>.git            shallow bare clones of gitlab, gitlab-shell,
+#                             gitaly and gitlab-pages at the required versions
+#   gems/                     .gem files of gitlab and gitaly-ruby
+#   go/modcache.tar.gz        Go module cache of the Go builds
+#   npm/yarn-<version>.tgz    the yarn package
+#   yarn/                     yarn offline mirror of gitlab's yarn.lock
+#
+# The bundle is shipped as an uncompressed tar, most of its content is
+# compressed already.
+import glob
+import json
+import logging
+import os
+import os.path
+import platform
+import shutil
+import tarfile
+import tempfile
+import time
+
+from gitlab_helpers.artifacts import sha256sum
+
+logger = logging.getLogger(__name__)
+
+FORMAT = 1
+MANIFEST_FILE = "manifest.json"
+# written next to the unpacked bundle, the archive is not unpacked again
+SOURCE_FILE = ".source-sha256"
+DEFAULT_DIR = "/var/lib/gitlab-charm/install-bundle"
+
+
+class BundleError(Exception):
+    """Raised for a missing, corrupt or incompatible install bundle."""
+
+
+def platform_info(os_release="/etc/os-release"):
+    """Return the distribution codename and machine a bundle is bound to."""
+    codename = None
+    try:
+        with open(os_release) as f:
+            for line in f:
+                key, _, value = line.strip().partition("=")
+                if key == "VERSION_CODENAME":
+                    codename = value.strip('"')
+    except OSError:
+        pass
+    return {"codename": codename, "machine": platform.machine()}
+
+
+def _files(root):
+    """Yield the paths of the bundle files relative to root, sorted."""
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames.sort()
+        for name in sorted(filenames):
+            path = os.path.relpath(os.path.join(dirpath, name), root)
+            if path not in (MANIFEST_FILE, SOURCE_FILE):
+                yield path
+
+
+def write_manifest(root, **info):
+    """Checksum the files below root and write the manifest, returns it."""
+    manifest = dict(info, format=FORMAT, created=round(time.time()),
+                    platform=platform_info(), files={})
+    for path in _files(root):
+        full = os.path.join(root, path)
+        manifest["files"][path] = {"sha256": sha256sum(full), "size": os.path.getsize(full)}
+    with open(os.path.join(root, MANIFEST_FILE), "w") as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    return manifest
+
+
+def verify(root, check_platform=True):
+    """Check the files below root against the manifest, returns the manifest.
+
+    Raises BundleError for a missing or changed file, or a bundle built for
+    another distribution release or architecture.
+    """
+    try:
+        with open(os.path.join(root, MANIFEST_FILE)) as f:
+            manifest = json.load(f)
+    except (OSError, ValueError) as e:
+        raise BundleError("No valid manifest in {}: {}".format(root, e))
+    if manifest.get("format") != FORMAT:
+        raise BundleError("Unsupported bundle format {!r}".format(manifest.get("format")))
+    if check_platform and manifest.get("platform") != platform_info():
+        raise BundleError("Bundle was built for {}, this unit is {}".format(
+            manifest.get("platform"), platform_info()))
+    bad = []
+    for path, meta in sorted(manifest["files"].items()):
+        full = os.path.join(root, path)
+        if not os.path.isfile(full):
+            bad.append("{} is missing".format(path))
+        elif os.path.getsize(full) != meta["size"] or sha256sum(full) != meta["sha256"]:
+            bad.append("{} does not match its checksum".format(path))
+    if bad:
+        raise BundleError("Bundle {} is corrupt: {}{}".format(
+            root, ", ".join(bad[:5]), " and {} more".format(len(bad) - 5) if len(bad) > 5 else ""))
+    return manifest
+
+
+def pack(root, archive):
+    """Write the bundle directory root into the tar file archive."""
+    directory = os.path.dirname(os.path.abspath(archive))
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=directory, prefix=".bundle-")
+    os.close(fd)
+    try:
+        with tarfile.open(tmp, "w") as tar:
+            for name in sorted(os.listdir(root)):
+                tar.add(os.path.join(root, name), arcname=name)
+        os.replace(tmp, archive)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+    return archive
+
+
+def _unsafe_path(path):
+    return path.startswith("/") or ".." in os.path.normpath(path).split("/")
+
+
+def _check_members(tar, links=False):
+    """Raise BundleError for a member that would land outside the target.
+
+    With links, symbolic and hard links are accepted when they point inside
+    the archive, like the node_modules/.bin links of a build tree.
+    """
+    for member in tar.getmembers():
+        if _unsafe_path(member.name):
+            raise BundleError("Unsafe path in {}: {}".format(tar.name, member.name))
+        if links and member.issym():
+            target = os.path.join(os.path.dirname(member.name), member.linkname)
+        elif links and member.islnk():
+            target = member.linkname
+        elif member.isfile() or member.isdir():
+            target = None
+        else:
+            raise BundleError("Unsupported file type in {}: {}".format(tar.name, member.name))
+        if target is not None and (member.linkname.startswith("/") or _unsafe_path(target)):
+            raise BundleError("Link out of {}: {} -> {}".format(
+                tar.name, member.name, member.linkname))
+        if member.mode & 0o6000:
+            raise BundleError("setuid/setgid file in {}: {}".format(tar.name, member.name))
+
+
+def unpack(source, target=DEFAULT_DIR):
+    """Return the InstallBundle of a bundle tar file or directory.
+
+    A tar file is unpacked into target, unless target already holds this
+    archive. Either way the files are verified against the manifest.
+    """
+    if os.path.isdir(source):
+        return InstallBundle(source)
+    if not os.path.isfile(source):
+        raise BundleError("Install bundle {} does not exist".format(source))
+    digest = sha256sum(source)
+    try:
+        with open(os.path.join(target, SOURCE_FILE)) as f:
+            unpacked = f.read().strip() == digest
+    except OSError:
+        unpacked = False
+    if unpacked:
+        logger.debug("Install bundle %s is unpacked in %s already", source, target)
+        return InstallBundle(target)
+
+    parent = os.path.dirname(os.path.abspath(target))
+    os.makedirs(parent, exist_ok=True)
+    tmp = tempfile.mkdtemp(dir=parent, prefix=".install-bundle-")
+    try:
+        logger.info("Unpack install bundle %s", source)
+        try:
+            with tarfile.open(source) as tar:
+                _check_members(tar)
+                tar.extractall(tmp)
+        except tarfile.TarError as e:
+            raise BundleError("Unable to unpack {}: {}".format(source, e))
+        # the git user installs from it
+        os.chmod(tmp, 0o755)
+        bundle = InstallBundle(tmp)
+        with open(os.path.join(tmp, SOURCE_FILE), "w") as f:
+            f.write(digest)
+        shutil.rmtree(target, ignore_errors=True)
+        os.rename(tmp, target)
+    except BaseException:
+        shutil.rmtree(tmp, ignore_errors=True)
+        raise
+    bundle.root = target
+    return bundle
+
+
+class InstallBundle:
+    """A verified, unpacked install bundle."""
+
+    def __init__(self, root):
+        self.manifest = verify(root)
+        self.root = root
+
+    def __repr__(self):
+        return "InstallBundle({!r})".format(self.root)
+
+    def path(self, *parts):
+        return os.path.join(self.root, *parts)
+
+    @property
+    def artifacts(self):
+        return self.path("artifacts")
+
+    @property
+    def debs(self):
+        return self.path("debs")
+
+    def git_source(self, name):
+        """URL of the shallow clone of a source repository."""
+        path = self.path("git", name + ".git")
+        if not os.path.isdir(path):
+            raise BundleError("Bundle has no {} repository".format(name))
+        return "file://" + path
+
+    @property
+    def gems(self):
+        return self.path("gems")
+
+    @property
+    def go_modcache(self):
+        return self.path("go", "modcache.tar.gz")
+
+    @property
+    def yarn_package(self):
+        packages = sorted(glob.glob(self.path("npm", "yarn-*.tgz")))
+        if not packages:
+            raise BundleError("Bundle has no yarn package")
+        return packages[-1]
+
+    @property
+    def yarn_mirror(self):
+        return self.path("yarn")
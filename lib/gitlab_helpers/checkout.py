@@ -0,0 +1,225 @@
+# Cached source checkouts
+#
+# gitlab-foss carries gigabytes of history, the install only needs the tip of
+# a stable branch or a release tag. Each source is fetched with --depth 1
+# into a persistent bare mirror below MIRROR_ROOT. Fetching another branch or
+# tag into a mirror only transfers the objects that are not reachable from
+# the refs it has already, so an upgrade to the next stable branch is an
+# incremental fetch.
+#
+# git refuses a shallow repository as --reference, and a local clone or a
+# --depth fetch of the mirror writes a new pack with a copy of every object.
+# A checkout instead gets hard links to the mirror's object files and its
+# shallow file, the fetch from the mirror then finds the objects in place
+# and transfers nothing. Across filesystems, where nothing can be linked, the
+# checkout falls back to a --depth 1 fetch and a copy of the objects.
+#
+# An interrupted fetch leaves lock files and temporary packs behind, they are
+# removed before the fetch is retried. A new checkout is built in a
+# CLONE_PREFIX directory next to the target and renamed over it once
+# complete, only such directories of an interrupted clone are removed. An
+# existing target that is not a checkout is never removed.
+import glob
+import logging
+import os
+import os.path
+import shutil
+import tempfile
+import time
+
+from gitlab_helpers.runner import CommandError, check_output, run
+
+logger = logging.getLogger(__name__)
+
+MIRROR_ROOT = "/var/cache/gitlab-charm/git"
+FETCH_ATTEMPTS = 3
+# seconds, multiplied by the attempt
+RETRY_DELAY = 10
+# a new checkout in progress, next to its target
+CLONE_PREFIX = ".charm-clone-"
+
+_BRANCH_PREFIX = "refs/heads/"
+_TAG_PREFIX = "refs/tags/"
+
+
+class CheckoutError(Exception):
+    """Raised when a checkout target exists but is not a checkout."""
+
+
+def short_ref(ref):
+    """Branch or tag name of a full ref, as git clone --branch takes it."""
+    for prefix in (_BRANCH_PREFIX, _TAG_PREFIX):
+        if ref.startswith(prefix):
+            return ref[len(prefix):]
+    raise ValueError("Not a branch or tag ref: {}".format(ref))
+
+
+def _git(*args, cwd=None, **kwargs):
+    cmd = ["git"]
+    if cwd:
+        # checkouts belong to the git user, the charm runs git as root
+        cmd += ["-c", "safe.directory={}".format(cwd), "-C", cwd]
+    return check_output(cmd + list(args), **kwargs)
+
+
+def revision(path, ref="HEAD"):
+    """Return the commit id of ref in the repository at path, None if invalid."""
+    if not os.path.isdir(path):
+        return None
+    result = run(["git", "-c", "safe.directory={}".format(path), "-C", path, "rev-parse",
+                  "--verify", "--quiet", ref + "^{commit}"], capture=True)
+    return result.output.strip() if result.returncode == 0 else None
+
+
+def clean_stale_files(path):
+    """Remove the lock files and temporary packs of interrupted git commands."""
+    removed = []
+    for dirpath, dirnames, filenames in os.walk(path):
+        for name in filenames:
+            if name.endswith(".lock") or name.startswith(("tmp_pack_", "tmp_idx_", ".tmp-")):
+                removed.append(os.path.join(dirpath, name))
+        for name in list(dirnames):
+            if name.startswith("incoming-"):
+                shutil.rmtree(os.path.join(dirpath, name), ignore_errors=True)
+                dirnames.remove(name)
+    for name in removed:
+        logger.debug("Remove stale %s", name)
+        os.unlink(name)
+    return removed
+
+
+def share_objects(mirror, git_dir):
+    """Hard link the object files and shallow file of a mirror into a repository.
+
+    Returns False when an object could not be linked, like across
+    filesystems, the repository then has to fetch a copy of the objects.
+    """
+    source = os.path.join(mirror, "objects")
+    target = os.path.join(git_dir, "objects")
+    for dirpath, dirnames, filenames in os.walk(source):
+        relative = os.path.relpath(dirpath, source)
+        if relative == "info":
+            dirnames[:] = []
+            continue
+        os.makedirs(os.path.join(target, relative), exist_ok=True)
+        # a pack is linked before its index, git ignores a pack without one
+        for name in sorted(filenames, key=lambda name: name.endswith((".idx", ".rev"))):
+            path = os.path.join(target, relative, name)
+            if os.path.exists(path):
+                continue
+            try:
+                os.link(os.path.join(dirpath, name), path)
+            except OSError as e:
+                logger.debug("Unable to link the objects of %s: %s", mirror, e)
+                return False
+    # the commits the mirror's history is cut at
+    shallow = set()
+    for path in (os.path.join(mirror, "shallow"), os.path.join(git_dir, "shallow")):
+        if os.path.exists(path):
+            with open(path) as f:
+                shallow.update(line.strip() for line in f if line.strip())
+    if shallow:
+        with open(os.path.join(git_dir, "shallow"), "w") as f:
+            f.writelines(commit + "\n" for commit in sorted(shallow))
+    return True
+
+
+class SourceMirror:
+    """Shallow bare mirrors of the source repositories, one per name."""
+
+    def __init__(self, root=MIRROR_ROOT, attempts=FETCH_ATTEMPTS, retry_delay=RETRY_DELAY):
+        self.root = root
+        self.attempts = attempts
+        self.retry_delay = retry_delay
+
+    def path(self, name):
+        return os.path.join(self.root, name + ".git")
+
+    def fetch(self, name, url, ref):
+        """Fetch ref from url into the mirror, returns its commit id.
+
+        Tags are only fetched once. A branch is fetched every time, when that
+        fails the mirrored commit is used, if there is one.
+        """
+        path = self.path(name)
+        cached = revision(path, ref)
+        if cached and ref.startswith(_TAG_PREFIX):
+            logger.debug("%s %s is mirrored already", name, ref)
+            return cached
+        if not os.path.isdir(path):
+            os.makedirs(self.root, exist_ok=True)
+            _git("init", "--quiet", "--bare", path)
+        for attempt in range(1, self.attempts + 1):
+            clean_stale_files(path)
+            try:
+                _git("fetch", "--quiet", "--depth", "1", "--no-tags", url,
+                     "+{0}:{0}".format(ref), cwd=path, name="fetch {} {}".format(name, ref))
+                return revision(path, ref)
+            except CommandError as e:
+                if attempt == self.attempts:
+                    if cached:
+                        logger.warning("Unable to update %s %s, using the mirrored %s: %s",
+                                       name, ref, cached, e)
+                        return cached
+                    raise
+                logger.warning("Fetch of %s %s failed (attempt %d of %d): %s",
+                               name, ref, attempt, self.attempts, e)
+                time.sleep(self.retry_delay * attempt)
+
+    def checkout(self, name, url, ref, target, origin=None, owner=None):
+        """Check out ref of a source in target, returns True if target changed.
+
+        An existing checkout at another commit is updated with an incremental
+        fetch from the mirror. origin becomes the URL of the checkout's
+        origin remote (url by default), owner the owner of the files.
+        """
+        commit = self.fetch(name, url, ref)
+        # a directory without .git must not resolve to a repository above it
+        head = revision(target) if os.path.exists(os.path.join(target, ".git")) else None
+        if head == commit:
+            logger.debug("%s is at %s %s already", target, ref, commit)
+            return False
+        if head is None:
+            work = self._new_checkout(target)
+        else:
+            logger.info("Update %s from %s to %s %s", target, head, ref, commit)
+            work = target
+            clean_stale_files(os.path.join(target, ".git"))
+        fetch = ["fetch", "--quiet", "--no-tags"]
+        if not share_objects(self.path(name), os.path.join(work, ".git")):
+            fetch += ["--depth", "1"]
+        _git(*fetch, self.path(name), ref, cwd=work, name="fetch {} {}".format(name, ref))
+        if ref.startswith(_BRANCH_PREFIX):
+            _git("checkout", "--quiet", "-B", short_ref(ref), "FETCH_HEAD", cwd=work)
+        else:
+            _git("checkout", "--quiet", "--detach", "FETCH_HEAD", cwd=work)
+        if head is None:
+            _git("remote", "add", "origin", origin or url, cwd=work)
+            if work != target:
+                # an empty target directory is replaced as well
+                os.rename(work, target)
+        else:
+            _git("remote", "set-url", "origin", origin or url, cwd=target)
+        if owner:
+            check_output(["chown", "-R", "{0}:{0}".format(owner), target])
+        return True
+
+    def _new_checkout(self, target):
+        """Create an empty repository for a new checkout of target, returns its path.
+
+        Raises CheckoutError when target exists with files in it.
+        """
+        if os.path.exists(target) and (not os.path.isdir(target) or os.listdir(target)):
+            raise CheckoutError("{} exists but is not a git checkout, move it away to check "
+                                "out the sources again".format(target))
+        parent, base = os.path.split(os.path.abspath(target))
+        for path in glob.glob(os.path.join(parent, CLONE_PREFIX + base + "-*")):
+            logger.info("Remove incomplete checkout %s", path)
+            shutil.rmtree(path)
+        os.makedirs(parent, exist_ok=True)
+        work = tempfile.mkdtemp(dir=parent, prefix=CLONE_PREFIX + base + "-")
+        # like a clone, nginx serves gitlab/public from the checkout
+        os.chmod(work, 0o755)
+        logger.info("Check out %s in %s", target, work)
+        _git("init", "--quiet", work)
+        return work
@@ -0,0 +1,180 @@
+# libpq connection strings
+#
+# The pgsql relation hands out the primary as a libpq keyword/value string
+# ("host=10.0.0.1 port=5432 dbname=gitlab user=gitlab password=..."), the
+# standbys as postgresql:// URIs. Values may be single quoted and contain
+# spaces, "=" or backslash escaped quotes, see
+# https://www.postgresql.org/docs/current/libpq-connect.html#LIBPQ-CONNSTRING
+import functools
+import urllib.parse
+
+# keywords kept as attributes, anything else ends up in ConnInfo.options
+FIELDS = ("host", "port", "dbname", "user", "password", "sslmode", "connect_timeout",
+          "keepalives", "keepalives_idle", "target_session_attrs")
+
+# integer valued keywords
+INT_FIELDS = ("port", "connect_timeout", "keepalives", "keepalives_idle")
+
+DEFAULT_PORT = 5432
+
+
+class ConnInfoError(ValueError):
+    """Raised for a malformed connection string."""
+
+
+class ConnInfo:
+    """Immutable, parsed libpq connection parameters.
+
+    Unset keywords are None, except port which defaults to 5432. Keywords
+    without an attribute are kept in options as sorted (key, value) pairs.
+    """
+
+    __slots__ = FIELDS + ("options",)
+
+    def __init__(self, options=(), **params):
+        unknown = set(params) - set(FIELDS)
+        if unknown:
+            raise TypeError("Unknown connection parameters: {}".format(", ".join(sorted(unknown))))
+        for field in FIELDS:
+            value = params.get(field)
+            if field in INT_FIELDS and value is not None:
+                try:
+                    value = int(value)
+                except ValueError:
+                    raise ConnInfoError("{} must be an integer, got {!r}".format(field, value))
+            object.__setattr__(self, field, value)
+        if self.port is None:
+            object.__setattr__(self, "port", DEFAULT_PORT)
+        object.__setattr__(self, "options", tuple(sorted(dict(options).items())))
+
+    def __setattr__(self, name, value):
+        raise AttributeError("ConnInfo is immutable")
+
+    __delattr__ = __setattr__
+
+    def _key(self):
+        return tuple(getattr(self, field) for field in self.__slots__)
+
+    def __eq__(self, other):
+        if not isinstance(other, ConnInfo):
+            return NotImplemented
+        return self._key() == other._key()
+
+    def __hash__(self):
+        return hash(self._key())
+
+    def __repr__(self):
+        # never log the password
+        params = ", ".join("{}={!r}".format(field, "***" if field == "password" else value)
+                           for field, value in self.items())
+        return "ConnInfo({})".format(params)
+
+    def items(self):
+        """(keyword, value) pairs of the set parameters, options last."""
+        for field in FIELDS:
+            value = getattr(self, field)
+            if value is not None:
+                yield field, value
+        yield from self.options
+
+    def replace(self, **params):
+        """Return a copy with the given parameters changed."""
+        values = {field: getattr(self, field) for field in FIELDS}
+        values.update(params)
+        return ConnInfo(self.options, **values)
+
+    def dsn(self, exclude=()):
+        """Serialize back into a keyword/value connection string."""
+        return " ".join("{}={}".format(key, quote(value))
+                        for key, value in self.items() if key not in exclude)
+
+
+def quote(value):
+    """Quote a keyword value for a connection string when needed."""
+    value = str(value)
+    if value and not any(c in value for c in " \t\n\r\f\v'\\="):
+        return value
+    return "'{}'".format(value.replace("\\", "\\\\").replace("'", "\\'"))
+
+
+def _split(conn_str):
+    """Yield the (keyword, value) pairs of a keyword/value string."""
+    length = len(conn_str)
+    i = 0
+    while True:
+        while i < length and conn_str[i].isspace():
+            i += 1
+        if i == length:
+            return
+        start = i
+        while i < length and conn_str[i] != "=" and not conn_str[i].isspace():
+            i += 1
+        key = conn_str[start:i]
+        while i < length and conn_str[i].isspace():
+            i += 1
+        if i == length or conn_str[i] != "=" or not key:
+            raise ConnInfoError("missing \"=\" after {!r} in connection string".format(key))
+        i += 1
+        while i < length and conn_str[i].isspace():
+            i += 1
+        value = []
+        if i < length and conn_str[i] == "'":
+            i += 1
+            while True:
+                if i == length:
+                    raise ConnInfoError("unterminated quoted string in connection string")
+                c = conn_str[i]
+                if c == "\\" and i + 1 < length:
+                    value.append(conn_str[i + 1])
+                    i += 2
+                elif c == "'":
+                    i += 1
+                    break
+                else:
+                    value.append(c)
+                    i += 1
+        else:
+            while i < length and not conn_str[i].isspace():
+                if conn_str[i] == "\\" and i + 1 < length:
+                    i += 1
+                value.append(conn_str[i])
+                i += 1
+        yield key, "".join(value)
+
+
+def _split_uri(uri):
+    parts = urllib.parse.urlsplit(uri)
+    params = {}
+    if parts.hostname:
+        params["host"] = parts.hostname
+    try:
+        if parts.port:
+            params["port"] = str(parts.port)
+    except ValueError as e:
+        raise ConnInfoError(str(e))
+    if parts.username:
+        params["user"] = urllib.parse.unquote(parts.username)
+    if parts.password is not None:
+        params["password"] = urllib.parse.unquote(parts.password)
+    dbname = urllib.parse.unquote(parts.path.lstrip("/"))
+    if dbname:
+        params["dbname"] = dbname
+    params.update(urllib.parse.parse_qsl(parts.query, keep_blank_values=True))
+    return params.items()
+
+
+@functools.lru_cache(maxsize=32)
+def parse(conn_str):
+    """Parse a keyword/value string or a postgresql:// URI into a ConnInfo.
+
+    Results are cached by connection string, a ConnInfo is immutable and
+    safe to share. Repeated keywords override earlier ones, like libpq.
+    """
+    if conn_str.startswith(("postgresql://", "postgres://")):
+        pairs = _split_uri(conn_str)
+    else:
+        pairs = _split(conn_str)
+    params, options = {}, {}
+    for key, value in pairs:
+        (params if key in FIELDS else options)[key] = value
+    return ConnInfo(options, **params)
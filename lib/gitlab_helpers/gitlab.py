@@ -1,159 +1,492 @@
+import contextlib
+import glob
+import hashlib
+import json
 import logging
 import os
 import os.path
+import re
+import shutil
+import signal
 import sys
 import subprocess
+import tarfile
+import tempfile
+import threading
+import time
+
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 
 from charmhelpers.fetch import (
     apt_install, add_source, apt_update, add_source)
 from charmhelpers.core.host import (
     mkdir, symlink, write_file)
-from subprocess import check_call, check_output
-from charmhelpers.core.templating import render
+from gitlab_helpers import artifacts, bundle, checkout, housekeeping, templating
+from gitlab_helpers.profiling import profiled
+from gitlab_helpers.runner import HOUR, CommandError, call, check_output, run
+from gitlab_helpers.templating import file_digest, write_if_changed
 
 logger = logging.getLogger(__name__)
 
+GITLAB_BRANCH = "14-3-stable"
+GITALY_BRANCH = "14-3-stable"
+
+RUBY_VERSION = "2.7.4"
+RUBY_URL = "https://cache.ruby-lang.org/pub/ruby/2.7/ruby-2.7.4.tar.gz"
+RUBY_SHA256 = "3043099089608859fc8cce7f9fdccaa1f53a462457e3838ec3b25a7d609fbc5b"
+
+GO_VERSION = "1.16.9"
+GO_URL = "https://dl.google.com/go/go1.16.9.linux-amd64.tar.gz"
+GO_SHA256 = "d2c095c95f63c2a3ef961000e0ecb9d81d5c68b6ece176e2a8a2db82dc02931c"
+
+NODE_VERSION = "14.x"
+NODE_SETUP_URL = "https://deb.nodesource.com/setup_14.x"
+
+# source repositories, an install bundle carries shallow clones of them
+SOURCES = {
+    "gitlab": "https://gitlab.com/gitlab-org/gitlab-foss.git",
+    "gitlab-shell": "https://gitlab.com/gitlab-org/gitlab-shell.git",
+    "gitaly": "https://gitlab.com/gitlab-org/gitaly.git",
+    "gitlab-pages": "https://gitlab.com/gitlab-org/gitlab-pages.git",
+}
+
+# files installed by gitaly's "make git" below GIT_PREFIX
+GIT_INSTALL_PATHS = ["bin/git", "bin/git-*", "libexec/git-core", "share/git-core",
+                     "share/gitweb", "share/perl5"]
+# the artifact cache key of the installed git build, part of its tree
+GIT_BUILD_KEY_FILE = "/usr/local/share/git-core/.charm-build-key"
+
+# module cache of the git user's Go builds (default GOPATH)
+GO_MODCACHE = "/home/git/go/pkg/mod"
+
+# limit of the compile steps, the other commands use runner.DEFAULT_TIMEOUT
+BUILD_TIMEOUT = 2 * HOUR
+
+# apt/dpkg holds a global lock, install steps running in parallel must take
+# turns when they call apt
+_apt_lock = threading.Lock()
+
+
+def templates():
+    """The render engine of the configuration templates of GITLAB_BRANCH."""
+    return templating.engine(GITLAB_BRANCH)
+
+
+# 0. Install scheduler
+class InstallTask:
+    """An install step and the names of the steps it depends on."""
+
+    def __init__(self, name, func, requires=()):
+        self.name = name
+        self.func = func
+        self.requires = tuple(requires)
+
+    def __repr__(self):
+        return "InstallTask({!r}, requires={!r})".format(self.name, self.requires)
+
+
+class InstallError(Exception):
+    """Raised when an install step fails.
+
+    Carries the name of the failed step, the steps that were never started
+    and the timings of the steps that did run.
+    """
+
+    def __init__(self, task, error, skipped, timings):
+        super().__init__("Install step '{}' failed: {}".format(task, error))
+        self.task = task
+        self.error = error
+        self.skipped = skipped
+        self.timings = timings
+
+
+def _check_install_tasks(tasks):
+    names = [task.name for task in tasks]
+    if len(set(names)) != len(names):
+        raise ValueError("Duplicate install task names: {}".format(names))
+    for task in tasks:
+        for dep in task.requires:
+            if dep not in names:
+                raise ValueError("Install task '{}' requires unknown task '{}'"
+                                 "".format(task.name, dep))
+    # Kahn's algorithm, anything left over is part of a cycle
+    resolved = set()
+    remaining = list(tasks)
+    while remaining:
+        ready = [t for t in remaining if set(t.requires) <= resolved]
+        if not ready:
+            raise ValueError("Install tasks have a dependency cycle: {}".format(
+                sorted(t.name for t in remaining)))
+        resolved.update(t.name for t in ready)
+        remaining = [t for t in remaining if t.name not in resolved]
+
+
+@contextlib.contextmanager
+def _build_timer(step, jobs):
+    """Log the wall-clock time of a compile step and its parallelism."""
+    start = time.monotonic()
+    yield
+    logger.info("Build step '%s' with %d jobs took %.1fs",
+                step, jobs, time.monotonic() - start)
+
+
+def _go_build_env(jobs, offline=False):
+    # make and go build parallelism for the rake tasks that compile Go
+    env = "MAKEFLAGS=-j{0} GOFLAGS=-p={0}".format(jobs)
+    if offline:
+        # modules only come from the module cache unpacked from the bundle
+        env += " GOPROXY=off GOSUMDB=off"
+    return env
+
+
+def _source_url(name, install_bundle=None):
+    return install_bundle.git_source(name) if install_bundle else SOURCES[name]
+
+
+def run_install_tasks(tasks, max_workers=4):
+    """Run the install tasks, independent ones in parallel.
+
+    A task is started once all of its required tasks finished successfully,
+    at most max_workers tasks run at the same time. When a task fails no
+    further tasks are started, the running ones are waited for and an
+    InstallError is raised.
+
+    Returns a dict of task name -> wall-clock seconds.
+    """
+    _check_install_tasks(tasks)
+    timings = {}
+
+    def run_timed(task):
+        logger.info("Install step '%s' started", task.name)
+        start = time.monotonic()
+        try:
+            task.func()
+        finally:
+            timings[task.name] = round(time.monotonic() - start, 3)
+            logger.info("Install step '%s' finished in %.1fs",
+                        task.name, timings[task.name])
+
+    pending = {task.name: task for task in tasks}
+    running = {}
+    done = set()
+    failed = None
+    with ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor:
+        while pending or running:
+            if failed is None:
+                for name, task in list(pending.items()):
+                    if set(task.requires) <= done:
+                        running[executor.submit(run_timed, task)] = task
+                        del pending[name]
+            if not running:
+                break
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                task = running.pop(future)
+                error = future.exception()
+                if error is None:
+                    done.add(task.name)
+                elif failed is None:
+                    logger.error("Install step '%s' failed: %s", task.name, error)
+                    failed = (task.name, error)
+
+    if failed is not None:
+        raise InstallError(failed[0], failed[1], sorted(pending), timings)
+    return timings
+
+
 # 1. Packages and dependencies
-def install_packages_and_dependencies():
-    logger.info("Install packages and dependencies")
-    apt_update()
 
+# apt packages needed by the install helpers, grouped by what needs them.
+# Entries may pin a version with "name=version".
+PACKAGE_MANIFEST = {
     # Build dependencies
-    packages = ["build-essential", "zlib1g-dev", "libyaml-dev", "libssl-dev",
-               "libgdbm-dev", "libre2-dev", "libreadline-dev", "libncurses5-dev",
-               "libffi-dev", "curl", "openssh-server", "libxml2-dev",
-               "libxslt-dev", "libcurl4-openssl-dev", "libicu-dev", "logrotate",
-               "rsync", "python-docutils", "pkg-config", "cmake",
-               "runit-systemd", "libkrb5-dev", "libpq-dev"]
-    apt_install(packages)
-
+    "build": ["build-essential", "zlib1g-dev", "libyaml-dev", "libssl-dev",
+              "libgdbm-dev", "libre2-dev", "libreadline-dev", "libncurses5-dev",
+              "libffi-dev", "curl", "openssh-server", "libxml2-dev",
+              "libxslt-dev", "libcurl4-openssl-dev", "libicu-dev", "logrotate",
+              "rsync", "python-docutils", "pkg-config", "cmake",
+              "runit-systemd", "libkrb5-dev", "libpq-dev"],
     # Git
-    packages = ["libcurl4-openssl-dev", "libexpat1-dev", "gettext", "libz-dev",
-               "libssl-dev", "libpcre2-dev", "build-essential", "git-core"]
-    apt_install(packages)
+    "git": ["libcurl4-openssl-dev", "libexpat1-dev", "gettext", "libz-dev",
+            "libssl-dev", "libpcre2-dev", "build-essential", "git-core"],
+    "graphicsmagick": ["graphicsmagick"],
+    # Mail server
+    "mail": ["postfix"],
+    "exiftool": ["libimage-exiftool-perl"],
+    # from the nodesource repository, see install_node_repository()
+    "node": ["nodejs"],
+    "redis": ["redis"],
+    "nginx": ["nginx"],
+    # optional, installed when the pgbouncer config option is set
+    "pgbouncer": ["pgbouncer"],
+    # apt-ftparchive, indexes the .debs of an install bundle
+    "bundle": ["apt-utils"],
+    # optional, installed when the metrics config option is set
+    "metrics": ["prometheus-redis-exporter", "prometheus-postgres-exporter",
+                "prometheus-nginx-exporter"],
+}
 
-    # clone and build git only if it was not built before
-    if not os.path.isfile("/usr/local/bin/git"):
-        # clone git repository
-        cmd = [
-            "/bin/bash", "-c",
-            "set -o pipefail ;"
-            "git clone https://gitlab.com/gitlab-org/gitaly.git -b {} /tmp/gitaly"
-            "".format("14-3-stable")
-        ]
-        check_output(cmd)
+# groups installed by the install hook
+DEFAULT_PACKAGE_GROUPS = ["build", "git", "graphicsmagick", "mail", "exiftool",
+                          "node", "redis", "nginx"]
+
+
+def package_manifest(groups=None):
+    """Return the sorted, de-duplicated package list of the given groups."""
+    groups = DEFAULT_PACKAGE_GROUPS if groups is None else groups
+    return sorted({package for group in groups for package in PACKAGE_MANIFEST[group]})
+
+
+def installed_packages():
+    """Return a dict of installed package name -> version.
+
+    Virtual packages provided by an installed package are included with a
+    None version.
+    """
+    output = check_output(["dpkg-query", "-W",
+                           "-f=${Package}\t${Version}\t${db:Status-Abbrev}\t${Provides}\n"],
+                          capture=True)
+    installed = {}
+    provided = set()
+    for line in output.splitlines():
+        name, version, status, provides = (line.split("\t") + [""] * 4)[:4]
+        if not status.startswith("ii"):
+            continue
+        installed[name.split(":")[0]] = version
+        for item in provides.split(","):
+            if item.strip():
+                provided.add(item.split()[0].split(":")[0])
+    for name in provided:
+        installed.setdefault(name, None)
+    return installed
+
+
+def missing_packages(packages, installed=None):
+    """Return the manifest entries that are not installed at the wanted version."""
+    installed = installed_packages() if installed is None else installed
+    missing = []
+    for entry in packages:
+        name, _, version = entry.partition("=")
+        if name not in installed:
+            missing.append(entry)
+        elif version and installed[name] != version:
+            missing.append(entry)
+    return missing
+
+
+# apt sources and lists of the bundled .debs, kept on the unit as the bundle
+# may be unpacked on a read-only share
+BUNDLE_APT_DIR = "/var/lib/gitlab-charm/bundle-apt"
+
+
+def _bundle_apt_options(install_bundle):
+    """apt options installing from the .debs of a bundle only."""
+    apt_dir = BUNDLE_APT_DIR
+    mkdir(os.path.join(apt_dir, "lists", "partial"), perms=0o755)
+    sources = os.path.join(apt_dir, "sources.list")
+    write_file(sources, "deb [trusted=yes] file:{} ./\n".format(install_bundle.debs),
+               perms=0o644)
+    return ["--option=Dir::Etc::SourceList={}".format(sources),
+            "--option=Dir::Etc::SourceParts=-",
+            "--option=Dir::State::Lists={}".format(os.path.join(apt_dir, "lists"))]
+
+
+@profiled()
+def install_packages_and_dependencies(packages=None, deb_cache=None, install_bundle=None):
+    """Install the package manifest in a single apt transaction.
+
+    apt is not called at all when dpkg reports every package installed. With
+    deb_cache the .debs are downloaded into (and reused from) that directory.
+    With an install bundle apt only sees the bundled .debs, nothing is
+    downloaded.
+    """
+    logger.info("Install packages and dependencies")
+    packages = package_manifest() if packages is None else packages
+    missing = missing_packages(packages)
+    if not missing:
+        logger.debug("All %d packages are already installed", len(packages))
+        return
+    logger.debug("Install %d missing packages: %s", len(missing), " ".join(missing))
+
+    options = ["--option=Dpkg::Options::=--force-confold"]
+    if install_bundle:
+        options += _bundle_apt_options(install_bundle)
+        with _apt_lock:
+            check_output(["apt-get", "update"] + options[1:])
+            apt_install(missing, options=options, fatal=True)
+        return
+    if deb_cache:
+        mkdir(os.path.join(deb_cache, "partial"), perms=0o755)
+        options.append("--option=Dir::Cache::archives={}".format(deb_cache))
+
+    apt_update(fatal=True)
+    with _apt_lock:
+        if deb_cache:
+            apt_install(missing, options=options + ["--download-only"], fatal=True)
+        apt_install(missing, options=options, fatal=True)
+
+
+# 1.1 Git
+def git_build_key(commit):
+    """Artifact cache key of the git built by a gitaly commit.
+
+    gitaly's Makefile pins the git version, the tip of GITALY_BRANCH may
+    move to another one.
+    """
+    return "{}-{}".format(GITALY_BRANCH, commit)
+
+
+def installed_git_key():
+    """Return the build key of the installed git, None if unknown."""
+    try:
+        with open(GIT_BUILD_KEY_FILE) as f:
+            return f.read().strip() or None
+    except FileNotFoundError:
+        return None
+
+
+@profiled()
+def install_git(cache=None, jobs=1, mirror=None, install_bundle=None):
+    logger.info("Install git")
+    cache = cache or artifacts.ArtifactCache()
+    mirror = mirror or checkout.SourceMirror()
+    # build git only if it was not built before
+    if os.path.isfile("/usr/local/bin/git"):
+        logger.debug("git already installed")
+        return
+    if install_bundle:
+        # the git build of the unit the bundle was built on
+        key = install_bundle.manifest.get("versions", {}).get("git", GITALY_BRANCH)
+        if not cache.restore("git", key, "/usr/local"):
+            raise bundle.BundleError("Bundle has no git build {}".format(key))
+        return
+
+    build_dir = tempfile.mkdtemp(prefix="gitaly-")
+    try:
+        # check out the gitaly sources from the mirror, a local clone
+        mirror.checkout("gitaly", SOURCES["gitaly"], "refs/heads/" + GITALY_BRANCH, build_dir)
+        key = git_build_key(checkout.revision(build_dir))
+        if cache.restore("git", key, "/usr/local"):
+            return
 
         # build git to /usr/local
         cmd = [
             "/bin/bash", "-c",
             "set -o pipefail ;"
-            "cd /tmp/gitaly ;"
-            "sudo make git GIT_PREFIX=/usr/local"
+            "cd {} ;"
+            "sudo make -j{} git GIT_PREFIX=/usr/local".format(build_dir, jobs)
         ]
-        check_output(cmd)
-
-    # GraphicsMagick
-    packages = ["graphicsmagick"]
-    apt_install(packages)
-
-    # Mail server
-    packages = ["postfix"]
-    apt_install(packages)
-
-    # Exiftool
-    packages = ["libimage-exiftool-perl"]
-    apt_install(packages)
+        with _build_timer("git", jobs):
+            check_output(cmd, name="git build", timeout=BUILD_TIMEOUT)
+    finally:
+        shutil.rmtree(build_dir, ignore_errors=True)
+    write_file(GIT_BUILD_KEY_FILE, key, perms=0o644)
+    cache.snapshot("git", key, "/usr/local", GIT_INSTALL_PATHS)
 
 
 # 2. Ruby
-def install_ruby():
+@profiled()
+def install_ruby(cache=None, jobs=1):
     logger.info("Install ruby")
-    ruby_tmpdir = "/tmp/ruby"
-    if not os.path.exists(ruby_tmpdir):
-        os.mkdir(ruby_tmpdir)
-    
+    cache = cache or artifacts.ArtifactCache()
+    if os.path.isfile("/usr/local/bin/ruby"):
+        logger.debug("ruby already installed")
+        return
+    if cache.restore("ruby", RUBY_VERSION):
+        return
+
     logger.debug("download ruby")
-    if not os.path.isfile("/tmp/ruby/ruby-2.7.4.tar.gz"):
-        cmd = [
-            "/bin/bash", "-c",
-            "set -o pipefail ;"
-            "cd /tmp/ruby ;"
-            "curl --remote-name --progress-bar https://cache.ruby-lang.org/pub/ruby/2.7/ruby-2.7.4.tar.gz"
-        ]
-        check_output(cmd)
+    tarball = cache.fetch("ruby", RUBY_VERSION, RUBY_URL, RUBY_SHA256)
 
-    logger.debug("extract ruby")
-    if not os.path.isfile("/tmp/ruby/ruby-2.7.4"):
-        # extract ruby
-        cmd = [
-            "/bin/bash", "-c",
-            "set -o pipefail ;"
-            "cd /tmp/ruby ;"
-            "echo '3043099089608859fc8cce7f9fdccaa1f53a462457e3838ec3b25a7d609fbc5b ruby-2.7.4.tar.gz' | sha256sum -c - && tar xzf ruby-2.7.4.tar.gz"
-        ]
+    build_dir = tempfile.mkdtemp(prefix="ruby-")
+    staging_dir = os.path.join(build_dir, "staging")
+    try:
+        logger.debug("extract ruby")
+        cmd = ["tar", "-C", build_dir, "-xzf", tarball]
         check_output(cmd)
 
-    logger.debug("build and install ruby")
-    # build ruby
-    if not os.path.isfile("/usr/local/bin/ruby"):
+        logger.debug("build and install ruby")
+        # install into a staging directory first, the staged tree is what
+        # gets cached and then copied to /usr/local
         cmd = [
             "/bin/bash", "-c",
             "set -o pipefail ;"
-            "cd /tmp/ruby/ruby-2.7.4 ;"
-            "./configure --disable-install-rdoc --enable-shared ;"
-            "make ;"
-            "sudo make install"
+            "cd {}/ruby-{} ;"
+            "./configure --prefix=/usr/local --disable-install-rdoc --enable-shared && "
+            "make -j{} && "
+            "make install DESTDIR={}".format(build_dir, RUBY_VERSION, jobs, staging_dir)
         ]
-        check_output(cmd)
+        with _build_timer("ruby", jobs):
+            check_output(cmd, name="ruby build", timeout=BUILD_TIMEOUT)
+        cache.snapshot("ruby", RUBY_VERSION, staging_dir, ["usr"])
+    finally:
+        shutil.rmtree(build_dir, ignore_errors=True)
+    cache.restore("ruby", RUBY_VERSION)
+
 
 # 3. Go
-def install_go():
+@profiled()
+def install_go(cache=None):
     logger.info("Install go")
+    cache = cache or artifacts.ArtifactCache()
+    try:
+        with open("/usr/local/go/VERSION") as f:
+            if f.read().split()[0] == "go" + GO_VERSION:
+                logger.debug("go already installed")
+                return
+    except (OSError, IndexError):
+        pass
+
+    # download Go, the cache verifies the checksum
+    tarball = cache.fetch("go", GO_VERSION, GO_URL, GO_SHA256)
+
     # remove former Go installation folder
     if os.path.exists("/usr/local/go"):
         cmd = ["sudo", "rm", "-rf", "/usr/local/go"]
         check_output(cmd)
-    # download Go
-    if not os.path.isfile("/tmp/go1.16.9.linux-amd64.tar.gz"):
-        cmd = [
-            "/bin/bash", "-c",
-            "set -o pipefail ;"
-            "cd /tmp ;"
-            "curl --remote-name --progress-bar https://dl.google.com/go/go1.16.9.linux-amd64.tar.gz ;"
-        ]
-        check_output(cmd)
     # Extract Go distribution
     cmd = [
         "/bin/bash", "-c",
         "set -o pipefail ;"
-        "echo 'd2c095c95f63c2a3ef961000e0ecb9d81d5c68b6ece176e2a8a2db82dc02931c  /tmp/go1.16.9.linux-amd64.tar.gz' | shasum -a256 -c - && "
-        "sudo tar -C /usr/local -xzf /tmp/go1.16.9.linux-amd64.tar.gz ;"
-        "sudo ln -sf /usr/local/go/bin/{go,godoc,gofmt} /usr/local/bin/ ;"
+        "sudo tar -C /usr/local -xzf {} ;"
+        "sudo ln -sf /usr/local/go/bin/{{go,godoc,gofmt}} /usr/local/bin/ ;"
+        "".format(tarball)
     ]
     check_output(cmd)
 
+
 # 4. Node
-def install_node():
-    logger.info("Install node")
-    if not os.path.isfile("/tmp/setup_14.x"):
-        cmd = [
-            "/bin/bash", "-c",
-            "set -o pipefail ;"
-            "cd /tmp ;"
-            "curl --location https://deb.nodesource.com/setup_14.x > /tmp/setup_14.x ;"
-            "cat /tmp/setup_14.x | sudo bash -"
-        ]
+@profiled()
+def install_node_repository(cache=None, install_bundle=None):
+    logger.info("Install node repository")
+    if install_bundle:
+        logger.debug("nodejs is installed from the bundled .debs")
+        return
+    cache = cache or artifacts.ArtifactCache()
+    if os.path.isfile("/etc/apt/sources.list.d/nodesource.list"):
+        logger.debug("nodesource repository already configured")
+        return
+    script = cache.fetch("nodesource", NODE_VERSION, NODE_SETUP_URL)
+    cmd = ["sudo", "bash", script]
+    with _apt_lock:
         check_output(cmd)
-    apt_install(["nodejs"])
 
+
+@profiled()
+def install_node(install_bundle=None):
+    logger.info("Install node")
+    # nodejs itself comes with the package manifest
+    package = install_bundle.yarn_package if install_bundle else "yarn"
     cmd = [
         "/bin/bash", "-c",
         "set -o pipefail ;"
-        "npm install --global yarn ;"
+        "npm install --global {} ;".format(package)
     ]
     check_output(cmd)
 
+
 # 5. System users
+@profiled()
 def create_system_user():
     logger.info("Create system user")
     # Notice: would be great to check the presence of the git user.
@@ -163,30 +496,335 @@ def create_system_user():
         ]
         check_output(cmd)
 
+
 # 7. Redis
+@profiled()
 def install_redis():
     logger.info("Install redis")
-    apt_install(["redis"])
     mkdir("/var/run/redis", owner="redis", group="redis", perms=0o755)
     content = "d  /var/run/redis  0755  redis  redis  10d  -\n"
     write_file("/etc/tmpfiles.d/redis.conf", content, perms=0o644)
     # Add git to the redis group
     check_output(["sudo", "usermod", "-aG", "redis", "git"])
 
+
+REDIS_SOCKET = "/var/run/redis/redis.sock"
+
+# Dedicated redis instances GitLab can use next to the main one (resque.yml),
+# with the tuning profile and their share of the redis memory, the main
+# instance keeps the rest
+REDIS_INSTANCES = {
+    "cache": {"profile": "cache-heavy", "memory_ratio": 0.4},
+    "queues": {"profile": "durable-aof", "memory_ratio": 0.3},
+    "shared_state": {"profile": "durable-aof", "memory_ratio": 0.2},
+}
+
+
+def redis_instance_paths(name):
+    """Return the files and directories of a dedicated redis instance."""
+    slug = name.replace("_", "-")
+    return {
+        "service": "redis-{}".format(slug),
+        "unit": "/etc/systemd/system/redis-{}.service".format(slug),
+        "config": "/etc/redis/redis-{}.conf".format(slug),
+        "socket": "/var/run/redis/redis-{}.sock".format(slug),
+        "pidfile": "/var/run/redis/redis-{}.pid".format(slug),
+        "logfile": "/var/log/redis/redis-{}.log".format(slug),
+        "dir": "/var/lib/redis/{}".format(slug),
+        "gitlab_config": "/home/git/gitlab/config/redis.{}.yml".format(name),
+    }
+
+
+@profiled()
+def configure_redis_instance(name):
+    """Create the data directory and systemd unit of a redis instance."""
+    paths = redis_instance_paths(name)
+    mkdir(paths["dir"], owner="redis", group="redis", perms=0o750)
+    context = {"name": name, "config_path": paths["config"], "socket": paths["socket"]}
+    if templates().render_if_changed("redis-instance.service.j2", paths["unit"], context,
+                                     perms=0o644):
+        check_output(["systemctl", "daemon-reload"])
+        check_output(["systemctl", "enable", paths["service"]])
+
+
+@profiled()
+def remove_redis_instance(name):
+    """Stop a redis instance and remove its unit and configuration files.
+
+    The data directory is kept. Returns True if anything was removed.
+    """
+    paths = redis_instance_paths(name)
+    if not os.path.exists(paths["unit"]):
+        return False
+    logger.info("Remove redis %s instance", name)
+    call(["systemctl", "disable", "--now", paths["service"]])
+    for path in (paths["unit"], paths["config"], paths["gitlab_config"]):
+        if os.path.exists(path):
+            os.unlink(path)
+    check_output(["systemctl", "daemon-reload"])
+    return True
+
+
+SIDEKIQ_UNIT = "/etc/systemd/system/gitlab-sidekiq-{}.service"
+
+
+def sidekiq_service(index):
+    return "gitlab-sidekiq-{}".format(index)
+
+
+def sidekiq_units():
+    """Return the indexes of the rendered sidekiq units."""
+    indexes = []
+    for path in glob.glob(SIDEKIQ_UNIT.format("*")):
+        index = os.path.basename(path)[len("gitlab-sidekiq-"):-len(".service")]
+        if index.isdigit():
+            indexes.append(int(index))
+    return sorted(indexes)
+
+
+@profiled()
+def configure_sidekiq_units(settings, shutdown_timeout=30):
+    """Render one systemd unit per sidekiq process and remove extra ones.
+
+    Returns a dict of unit path -> written.
+    """
+    changed = {}
+    for index, queue_selector in enumerate(settings["queue_groups"], start=1):
+        context = {"index": index, "queue_selector": queue_selector,
+                   "concurrency": settings["concurrency"],
+                   "shutdown_timeout": shutdown_timeout}
+        path = SIDEKIQ_UNIT.format(index)
+        changed[path] = templates().render_if_changed("gitlab-sidekiq.service.j2", path,
+                                                      context, perms=0o644)
+    for index in sidekiq_units():
+        if index > settings["processes"]:
+            logger.info("Remove sidekiq process %d", index)
+            call(["systemctl", "disable", "--now", sidekiq_service(index)])
+            os.unlink(SIDEKIQ_UNIT.format(index))
+            changed[SIDEKIQ_UNIT.format(index)] = False
+    if any(changed.values()) or len(changed) > settings["processes"]:
+        check_output(["systemctl", "daemon-reload"])
+        for index in range(1, settings["processes"] + 1):
+            check_output(["systemctl", "enable", sidekiq_service(index)])
+    return changed
+
+
+PGBOUNCER_CONFIG = "/etc/pgbouncer/pgbouncer.ini"
+PGBOUNCER_USERLIST = "/etc/pgbouncer/userlist.txt"
+PGBOUNCER_SOCKET_DIR = "/var/run/postgresql"
+PGBOUNCER_PORT = 6432
+
+
+@profiled()
+def install_pgbouncer(install_bundle=None):
+    logger.info("Install pgbouncer")
+    install_packages_and_dependencies(package_manifest(["pgbouncer"]),
+                                      install_bundle=install_bundle)
+
+
+def redis_version():
+    """Return the installed redis-server version as a tuple, () if unknown."""
+    try:
+        output = check_output(["redis-server", "--version"], capture=True)
+    except (OSError, subprocess.CalledProcessError):
+        return ()
+    for field in output.split():
+        if field.startswith("v="):
+            return tuple(int(part) for part in field[2:].split(".") if part.isdigit())
+    return ()
+
+
+def redis_persistence(socket):
+    """Return the persistence section of INFO of a running redis, None if down."""
+    try:
+        output = check_output(["redis-cli", "-s", socket, "info", "persistence"],
+                              capture=True)
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    fields = dict(line.split(":", 1) for line in output.splitlines() if ":" in line)
+    return {key: value.strip() for key, value in fields.items()}
+
+
+def _aof_written(socket):
+    info = redis_persistence(socket) or {}
+    expected = {"aof_enabled": "1", "aof_rewrite_in_progress": "0",
+                "aof_rewrite_scheduled": "0"}
+    return all(info.get(key) == value for key, value in expected.items())
+
+
+@profiled()
+def redis_enable_aof(socket, timeout=600):
+    """Switch a running redis to AOF before it is restarted with appendonly yes.
+
+    Started with appendonly yes and no AOF file redis comes up empty, the
+    RDB snapshot is ignored. CONFIG SET writes the AOF from memory first.
+    Returns False if the rewrite did not finish within timeout.
+    """
+    info = redis_persistence(socket)
+    if info is None:
+        logger.warning("Redis on %s is not running, its RDB data is not migrated to AOF",
+                       socket)
+        return True
+    if info.get("aof_enabled") == "1":
+        return True
+    logger.info("Enable AOF on the running redis %s", socket)
+    check_output(["redis-cli", "-s", socket, "config", "set", "appendonly", "yes"])
+    return wait_until(lambda: _aof_written(socket), timeout=timeout)
+
+
+def _rdb_saved(socket, last_save):
+    info = redis_persistence(socket) or {}
+    if info.get("rdb_bgsave_in_progress") != "0":
+        return False
+    return info.get("rdb_last_save_time", last_save) != last_save
+
+
+@profiled()
+def redis_save_rdb(socket, timeout=600):
+    """Take an RDB snapshot of a running AOF redis before it is restarted without AOF.
+
+    Started with appendonly no redis only loads dump.rdb, which the
+    durable-aof profile (save "") leaves old or missing. BGSAVE writes it
+    from memory. Returns False if the snapshot failed or did not finish
+    within timeout.
+    """
+    info = redis_persistence(socket)
+    if info is None:
+        logger.warning("Redis on %s is not running, its AOF data is not saved to RDB", socket)
+        return True
+    if info.get("aof_enabled") != "1":
+        return True
+    logger.info("Save an RDB snapshot of the running redis %s", socket)
+    last_save = info.get("rdb_last_save_time")
+    # scheduled after an AOF rewrite in progress
+    check_output(["redis-cli", "-s", socket, "bgsave", "schedule"])
+    if not wait_until(lambda: _rdb_saved(socket, last_save), timeout=timeout):
+        return False
+    return (redis_persistence(socket) or {}).get("rdb_last_bgsave_status") == "ok"
+
+
 # 8. GitLab
-def install_gitlab():
+def _read_version(name):
+    """Return a version file of the gitlab checkout, like GITALY_SERVER_VERSION."""
+    with open(os.path.join("/home/git/gitlab", name)) as f:
+        return f.read().strip()
+
+
+# The gems, node modules and compiled assets of the gitlab checkout are built
+# once and kept in the artifact cache, keyed by gitlab_build_key(). Units
+# sharing the cache directory, or given the tree as the gitlab-build
+# resource, unpack them instead of building them again.
+GITLAB_BUILD_PATHS = ["vendor/bundle", "node_modules", "public/assets"]
+GITLAB_BUILD_KEY_FILE = "public/assets/.charm-build-key"
+
+
+def gitlab_build_key(root="/home/git/gitlab"):
+    """Cache key of the gems, node modules and assets of a gitlab checkout.
+
+    Covers the checked out revision, Gemfile.lock, yarn.lock, the ruby and
+    node versions and the platform the native gems are built for.
+    """
+    revision = checkout.revision(root)
+    if revision is None:
+        raise ValueError("{} is not a git checkout".format(root))
+    digest = hashlib.sha256(revision.encode())
+    for name in ("Gemfile.lock", "yarn.lock"):
+        digest.update("\0{}".format(file_digest(os.path.join(root, name))).encode())
+    digest.update("\0{}\0{}".format(RUBY_VERSION, NODE_VERSION).encode())
+    platform = bundle.platform_info()
+    digest.update("\0{}\0{}".format(platform["codename"], platform["machine"]).encode())
+    return digest.hexdigest()[:24]
+
+
+def _build_tree_key(path):
+    """Return the build key recorded in a build tree tarball, None if unknown."""
+    try:
+        with tarfile.open(path, "r:gz") as tar:
+            with tar.extractfile(GITLAB_BUILD_KEY_FILE) as f:
+                return f.read().decode().strip()
+    except (OSError, KeyError, tarfile.TarError):
+        return None
+
+
+@profiled()
+def restore_gitlab_build(cache, key, resource=None, root="/home/git/gitlab"):
+    """Unpack the build of key into the checkout, returns True on a hit.
+
+    resource is an optional build tree tarball, it is only used when the key
+    it records matches and all of its members stay inside the checkout.
+    """
+    if cache.restore("gitlab-build", key, root):
+        logger.info("Restored gitlab build %s from the artifact cache", key)
+        return True
+    if resource:
+        resource_key = _build_tree_key(resource)
+        if resource_key == key:
+            with tarfile.open(resource, "r:gz") as tar:
+                try:
+                    bundle._check_members(tar, links=True)
+                except bundle.BundleError as e:
+                    logger.warning("Ignoring gitlab build %s: %s", resource, e)
+                    return False
+                tar.extractall(root)
+            logger.info("Restored gitlab build %s from %s", key, resource)
+            return True
+        logger.warning("Ignoring gitlab build %s, it is for %s, not %s", resource,
+                       resource_key, key)
+    return False
+
+
+@profiled()
+def build_gitlab_assets(cache=None, jobs=1, root="/home/git/gitlab"):
+    """Install the node modules, compile the assets and cache the build.
+
+    Skipped when the build of the current key is in place already, like
+    after restore_gitlab_build(). Returns True when it was built.
+    """
+    cache = cache or artifacts.ArtifactCache()
+    key = gitlab_build_key(root)
+    key_file = os.path.join(root, GITLAB_BUILD_KEY_FILE)
+    try:
+        with open(key_file) as f:
+            if f.read().strip() == key:
+                logger.debug("gitlab build %s is in place", key)
+                return False
+    except OSError:
+        pass
+
+    logger.info("Build gitlab assets")
+    # --prefer-offline uses the yarn offline mirror of an install bundle
+    cmd = [
+        "/bin/bash", "-c",
+        "cd {} ;"
+        "sudo -u git -H yarn install --production --pure-lockfile --prefer-offline "
+        "--network-concurrency {} ;".format(root, jobs)
+    ]
+    with _build_timer("yarn", jobs):
+        check_output(cmd, name="yarn install", timeout=BUILD_TIMEOUT)
+    cmd = [
+        "/bin/bash", "-c",
+        "cd {} ;"
+        "sudo -u git -H bundle exec rake gitlab:assets:compile RAILS_ENV=production "
+        "NODE_ENV=production ;".format(root)
+    ]
+    with _build_timer("assets", jobs):
+        check_output(cmd, name="assets compile", timeout=BUILD_TIMEOUT)
+    write_file(key_file, key, owner="git", group="git", perms=0o644)
+    cache.snapshot("gitlab-build", key, root, GITLAB_BUILD_PATHS)
+    return True
+
+
+@profiled()
+def install_gitlab(jobs=1, install_bundle=None, mirror=None, cache=None, build_resource=None):
     logger.info("Install gitlab")
-    # Clone gitlab repository
-    if not os.path.exists("/home/git/gitlab"):
-        # clone git repository
-        cmd = [
-            "/bin/bash", "-c",
-            "set -o pipefail ;"
-            "cd /home/git ;"
-            "sudo -u git -H git clone https://gitlab.com/gitlab-org/gitlab-foss.git -b {} gitlab"
-            "".format("14-3-stable")
-        ]
-        check_output(cmd)
+    offline = install_bundle is not None
+    mirror = mirror or checkout.SourceMirror()
+    cache = cache or artifacts.ArtifactCache()
+    # Check out the stable branch, the origin of a checkout from the bundle
+    # is gitlab.com too
+    mirror.checkout("gitlab", _source_url("gitlab", install_bundle),
+                    "refs/heads/" + GITLAB_BRANCH, "/home/git/gitlab",
+                    origin=SOURCES["gitlab"], owner="git")
 
     # TODO: create from template: /home/git/gitlab/config/gitlab.yml
     # TODO: generate secrets: /home/git/gitlab/config/secrets.yml
@@ -254,26 +892,60 @@ def install_gitlab():
 
     # Configure Redis connection settings
     # TODO: create from template: /home/git/gitlab/config/resque.yml
-    
+
+    # Parallel yarn installs for the git user
+    cmd = [
+        "/bin/bash", "-c",
+        "sudo -u git -H yarn config set network-concurrency {0} ;"
+        "sudo -u git -H yarn config set child-concurrency {0} ;".format(jobs)
+    ]
+    if offline:
+        cmd[-1] += "sudo -u git -H yarn config set yarn-offline-mirror {} ;".format(
+            install_bundle.yarn_mirror)
+    check_output(cmd)
+
+    # Restore the gems, node modules and assets built by another unit, bundle
+    # install then only checks them
+    restore_gitlab_build(cache, gitlab_build_key(), build_resource)
+
     # Install Gems
 
     # Notice: libpq-dev package is required for the pg 1.2.3 gem
     logger.debug("Install Gems")
+    install_flags = "--retry 3"
     cmd = [
         "/bin/bash", "-c",
         "cd /home/git/gitlab ;"
         "sudo -u git -H bundle config set --local deployment 'true' ;"
         "sudo -u git -H bundle config set --local without 'development test mysql aws kerberos' ;"
-        "sudo -u git -H bundle install ;"
     ]
-    check_output(cmd)
+    if offline:
+        # the .gem files are taken from the bundle instead of rubygems.org
+        cmd[-1] += "sudo -u git -H bundle config set --local cache_path {} ;".format(
+            install_bundle.gems)
+        install_flags = "--local"
+    cmd[-1] += "sudo -u git -H MAKEFLAGS=-j{0} bundle install --jobs {0} {1} ;".format(
+        jobs, install_flags)
+    with _build_timer("gems", jobs):
+        check_output(cmd, name="bundle install", timeout=BUILD_TIMEOUT)
+
+    if offline:
+        # modules of the gitlab-shell, workhorse, pages and gitaly builds
+        logger.debug("Unpack Go module cache")
+        cmd = [
+            "/bin/bash", "-c",
+            "sudo -u git -H mkdir -p {0} ;"
+            "sudo -u git -H tar -C {0} -xzf {1} ;".format(GO_MODCACHE, install_bundle.go_modcache)
+        ]
+        check_output(cmd)
 
     # Install GitLab Shell
     logger.debug("Install GitLab Shell")
     cmd = [
         "/bin/bash", "-c",
         "cd /home/git/gitlab ;"
-        "sudo -u git -H bundle exec rake gitlab:shell:install RAILS_ENV=production ;"
+        "sudo -u git -H {} bundle exec rake \"gitlab:shell:install[{}]\" RAILS_ENV=production ;"
+        "".format(_go_build_env(jobs, offline), _source_url("gitlab-shell", install_bundle))
     ]
     check_output(cmd)
 
@@ -282,70 +954,493 @@ def install_gitlab():
     cmd = [
         "/bin/bash", "-c",
         "cd /home/git/gitlab ;"
-        "sudo -u git -H bundle exec rake \"gitlab:workhorse:install[/home/git/gitlab-workhorse]\" RAILS_ENV=production ;"
+        "sudo -u git -H {} bundle exec rake "
+        "\"gitlab:workhorse:install[/home/git/gitlab-workhorse]\" RAILS_ENV=production ;"
+        "".format(_go_build_env(jobs, offline))
     ]
-    check_output(cmd)
+    with _build_timer("workhorse", jobs):
+        check_output(cmd, name="workhorse build", timeout=BUILD_TIMEOUT)
 
     # Install GitLab Pages
     logger.debug("Install GitLab Pages")
-    if not os.path.exists("/home/git/gitlab-pages"):
+    changed = mirror.checkout("gitlab-pages", _source_url("gitlab-pages", install_bundle),
+                              "refs/tags/v" + _read_version("GITLAB_PAGES_VERSION"),
+                              "/home/git/gitlab-pages", origin=SOURCES["gitlab-pages"],
+                              owner="git")
+    if changed or not os.path.exists("/home/git/gitlab-pages/gitlab-pages"):
         cmd = [
             "/bin/bash", "-c",
-            "cd /home/git ;"
-            "sudo -u git -H git clone https://gitlab.com/gitlab-org/gitlab-pages.git ;"
-            "cd gitlab-pages ;"
-            "sudo -u git -H git checkout v$(</home/git/gitlab/GITLAB_PAGES_VERSION) ;"
-            "sudo -u git -H make"
+            "cd /home/git/gitlab-pages ;"
+            "sudo -u git -H {} make -j{}".format(_go_build_env(jobs, offline), jobs)
         ]
-        check_output(cmd)
+        with _build_timer("pages", jobs):
+            check_output(cmd, name="pages build", timeout=BUILD_TIMEOUT)
 
     # Install Gitaly
     logger.debug("Install Gitaly")
+    env = _go_build_env(jobs, offline)
+    if offline:
+        # gitaly's Makefile passes BUNDLE_FLAGS to the gitaly-ruby bundle install
+        env += " BUNDLE_CACHE_PATH={} BUNDLE_FLAGS='--deployment --local'".format(
+            install_bundle.gems)
     cmd = [
         "/bin/bash", "-c",
         "cd /home/git/gitlab ;"
-        "sudo -u git -H bundle exec rake \"gitlab:gitaly:install[/home/git/gitaly,/home/git/repositories]\" RAILS_ENV=production ;"
+        "sudo -u git -H {} bundle exec rake "
+        "\"gitlab:gitaly:install[/home/git/gitaly,/home/git/repositories,{}]\" "
+        "RAILS_ENV=production ;"
         "sudo chmod 0700 /home/git/gitlab/tmp/sockets/private ;"
         "sudo chown git /home/git/gitlab/tmp/sockets/private ;"
+        "".format(env, _source_url("gitaly", install_bundle))
     ]
 
     logger.debug("Render gitaly system service")
-    config_path = "/etc/systemd/system/gitaly.service"
-    config_template = '14-3-stable/gitaly.service.j2'
-    context = { }
-    render(config_template, config_path, context, perms=0o644,
-            owner='root', group='root')
+    templates().render_if_changed("gitaly.service.j2", GITALY_UNIT, {}, perms=0o644)
 
-    check_output(cmd)
+    with _build_timer("gitaly", jobs):
+        check_output(cmd, name="gitaly build", timeout=BUILD_TIMEOUT)
+
+
+GITALY_CONFIG = "/home/git/gitaly/config.toml"
+GITALY_UNIT = "/etc/systemd/system/gitaly.service"
+GITALY_CGROUPS_MOUNTPOINT = "/sys/fs/cgroup"
+GITALY_CGROUPS_HIERARCHY_ROOT = "gitaly"
+
+
+@profiled()
+def configure_gitaly(settings, pack_objects_cache=True, cgroups=False,
+                     prometheus_listen_addr=None):
+    """Render gitaly's config.toml and its systemd unit.
+
+    With cgroups the unit prepares the cgroup v1 cpu and memory hierarchies
+    gitaly puts the git processes into. With prometheus_listen_addr gitaly
+    serves its metrics there. Returns a dict of path -> written.
+    """
+    cgroups_dirs = []
+    if cgroups:
+        cgroups_dirs = [os.path.join(GITALY_CGROUPS_MOUNTPOINT, controller,
+                                     GITALY_CGROUPS_HIERARCHY_ROOT)
+                        for controller in ("cpu", "memory")]
+    context = dict(settings, pack_objects_cache=pack_objects_cache, cgroups=cgroups,
+                   cgroups_mountpoint=GITALY_CGROUPS_MOUNTPOINT,
+                   cgroups_hierarchy_root=GITALY_CGROUPS_HIERARCHY_ROOT,
+                   cgroups_dirs=cgroups_dirs, prometheus_listen_addr=prometheus_listen_addr)
+    changed = templates().render_all([
+        templating.TemplateFile("gitaly-config.toml.j2", GITALY_CONFIG, owner="git",
+                                group="git", perms=0o644),
+        templating.TemplateFile("gitaly.service.j2", GITALY_UNIT, perms=0o644),
+    ], context)
+    if changed[GITALY_UNIT]:
+        check_output(["systemctl", "daemon-reload"])
+    return changed
 
 
 # 9. Nginx
+@profiled()
 def install_nginx():
     logger.info("Install nginx")
-    apt_install(["nginx"])
     # create gitlab configuration symlink if not present
     if not os.path.exists("/etc/nginx/sites-enabled/gitlab"):
         symlink("/etc/nginx/sites-available/gitlab", "/etc/nginx/sites-enabled/gitlab")
 
 
-def bootstrap_gitlab():
-    # Install Gitaly
+NGINX_CACHE_DIR = "/var/cache/nginx/gitlab"
+
+
+def configure_nginx_cache(enabled):
+    """Create the proxy cache directory, or remove it when the cache is disabled."""
+    if enabled:
+        mkdir(NGINX_CACHE_DIR, owner="www-data", group="www-data", perms=0o700)
+    elif os.path.isdir(NGINX_CACHE_DIR):
+        logger.info("Remove the nginx proxy cache %s", NGINX_CACHE_DIR)
+        shutil.rmtree(NGINX_CACHE_DIR, ignore_errors=True)
+
+
+@profiled()
+def bootstrap_gitlab(redis_sockets=(REDIS_SOCKET,), database_url=None):
+    """Flush redis and set up the database with rake gitlab:setup.
+
+    database_url points the rake task to the primary directly, when
+    database.yml points to the transaction pooling pgbouncer, which the
+    schema load and the migrations can not run through.
+    """
     logger.debug("Bootstrap gitlab")
 
-    # cleanup redis
-    cmd = ["redis-cli", "-s", "/var/run/redis/redis.sock", "flushall"]
-    check_output(cmd)
+    # cleanup every redis instance gitlab uses
+    for socket in redis_sockets:
+        cmd = ["redis-cli", "-s", socket, "flushall"]
+        check_output(cmd)
 
     # setup gitlab
+    env = None
+    sudo_options = ""
+    if database_url:
+        # DATABASE_URL wins over the connection settings of database.yml,
+        # it is passed in the environment to keep the password off the
+        # command line
+        env = dict(os.environ, DATABASE_URL=database_url)
+        sudo_options = "--preserve-env=DATABASE_URL "
     cmd = [
         "/bin/bash", "-c",
         "cd /home/git/gitlab ;"
-        "sudo -u git -H DISABLE_DATABASE_ENVIRONMENT_CHECK=1 bundle exec rake gitlab:setup RAILS_ENV=production GITLAB_ROOT_PASSWORD=s3cr3tpassw0rd GITLAB_ROOT_EMAIL=admin@example.com force=yes ;"
+        "sudo -u git -H {}DISABLE_DATABASE_ENVIRONMENT_CHECK=1 bundle exec rake gitlab:setup "
+        "RAILS_ENV=production GITLAB_ROOT_PASSWORD=s3cr3tpassw0rd "
+        "GITLAB_ROOT_EMAIL=admin@example.com force=yes ;".format(sudo_options)
     ]
     try:
-         p = subprocess.run(cmd, check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+        check_output(cmd, name="gitlab:setup", timeout=HOUR, env=env)
     except subprocess.CalledProcessError as e:
-        logger.debug(e.stderr)
+        logger.debug(e.output)
         raise
 
 
+# 10. Service control
+PUMA_PIDFILE = "/home/git/gitlab/tmp/pids/puma.pid"
+PUMA_SOCKET = "/home/git/gitlab/tmp/sockets/gitlab.socket"
+# the web services, started once the database is bootstrapped
+GITLAB_UNITS = {
+    "gitlab-puma": "/etc/systemd/system/gitlab-puma.service",
+    "gitlab-workhorse": "/etc/systemd/system/gitlab-workhorse.service",
+}
+
+
+def configure_gitlab_units():
+    """Render and enable the puma and workhorse units.
+
+    Returns a dict of unit path -> written.
+    """
+    changed = {}
+    for name, path in GITLAB_UNITS.items():
+        changed[path] = templates().render_if_changed(name + ".service.j2", path, {},
+                                                      perms=0o644)
+    if any(changed.values()):
+        check_output(["systemctl", "daemon-reload"])
+        for name in GITLAB_UNITS:
+            check_output(["systemctl", "enable", name])
+    return changed
+
+
+def puma_pid():
+    """Return the pid of the puma master process, None if it is not running."""
+    try:
+        with open(PUMA_PIDFILE) as f:
+            pid = int(f.read().strip())
+        os.kill(pid, 0)
+    except (OSError, ValueError):
+        return None
+    return pid
+
+
+@profiled()
+def puma_phased_restart():
+    """Cycle the puma workers one at a time (SIGUSR1).
+
+    The master keeps the socket open and old workers finish their in-flight
+    requests. Requires puma.rb without preload_app!.
+    """
+    pid = puma_pid()
+    if pid is None:
+        return False
+    logger.debug("Phased restart of puma master %d", pid)
+    os.kill(pid, signal.SIGUSR1)
+    return True
+
+
+@profiled()
+def puma_hot_restart():
+    """Restart puma in place (SIGUSR2), the listening socket is kept."""
+    pid = puma_pid()
+    if pid is None:
+        return False
+    logger.debug("Hot restart of puma master %d", pid)
+    os.kill(pid, signal.SIGUSR2)
+    return True
+
+
+def puma_ready():
+    """Check that GitLab answers its readiness probe on the puma socket."""
+    cmd = ["curl", "--silent", "--fail", "--max-time", "5",
+           "--unix-socket", PUMA_SOCKET, "http://localhost/-/readiness"]
+    return call(cmd, timeout=10) == 0
+
+
+def service_enabled(name):
+    """Whether the systemd unit of a service exists and is enabled."""
+    return call(["systemctl", "is-enabled", "--quiet", name]) == 0
+
+
+def nginx_config_ok():
+    """Validate the nginx configuration before it gets reloaded."""
+    return call(["nginx", "-t", "-q"]) == 0
+
+
+def wait_until(check, timeout=180, interval=2):
+    """Poll check() until it returns True, False if it timed out."""
+    deadline = time.monotonic() + timeout
+    while True:
+        if check():
+            return True
+        if time.monotonic() >= deadline:
+            return False
+        time.sleep(interval)
+
+
+# 11. Housekeeping
+HOUSEKEEPING_SCRIPT = "/usr/local/lib/gitlab-charm/housekeeping.py"
+HOUSEKEEPING_UNIT = "/etc/systemd/system/gitlab-housekeeping.service"
+HOUSEKEEPING_TIMER = "/etc/systemd/system/gitlab-housekeeping.timer"
+
+
+def _install_housekeeping_script():
+    # the git user can not read the charm directory, it runs a copy
+    mkdir(os.path.dirname(HOUSEKEEPING_SCRIPT), perms=0o755)
+    with open(housekeeping.__file__, "rb") as f:
+        write_if_changed(HOUSEKEEPING_SCRIPT, f.read(), perms=0o755)
+
+
+@profiled()
+def configure_housekeeping(schedule, workers=1):
+    """Install the housekeeping timer, an empty schedule (OnCalendar) removes it.
+
+    The units are not part of the restart handling, restarting the oneshot
+    service would start a housekeeping run.
+    """
+    if not schedule:
+        if os.path.exists(HOUSEKEEPING_TIMER):
+            logger.info("Disable repository housekeeping")
+            call(["systemctl", "disable", "--now", "gitlab-housekeeping.timer"])
+            for path in (HOUSEKEEPING_TIMER, HOUSEKEEPING_UNIT):
+                os.unlink(path)
+            check_output(["systemctl", "daemon-reload"])
+        return False
+    _install_housekeeping_script()
+    context = {"script": HOUSEKEEPING_SCRIPT, "root": housekeeping.REPOSITORIES_ROOT,
+               "workers": workers, "schedule": schedule}
+    changed = templates().render_all([
+        templating.TemplateFile("gitlab-housekeeping.service.j2", HOUSEKEEPING_UNIT,
+                                perms=0o644),
+        templating.TemplateFile("gitlab-housekeeping.timer.j2", HOUSEKEEPING_TIMER,
+                                perms=0o644),
+    ], context)
+    if any(changed.values()):
+        check_output(["systemctl", "daemon-reload"])
+        check_output(["systemctl", "enable", "--now", "gitlab-housekeeping.timer"])
+    return any(changed.values())
+
+
+def run_housekeeping(workers=1, limit=0, dry_run=False):
+    """Run the housekeeping now as the git user and return its report."""
+    _install_housekeeping_script()
+    cmd = ["sudo", "-u", "git", "-H", "/usr/bin/python3", HOUSEKEEPING_SCRIPT, "--json",
+           "--root", housekeeping.REPOSITORIES_ROOT,
+           "--workers", str(workers), "--limit", str(limit)]
+    if dry_run:
+        cmd.append("--dry-run")
+    # exits with 1 when a repository failed, the report tells which
+    # runs as long as it takes, the action can be aborted
+    result = run(cmd, capture=True, timeout=None)
+    try:
+        return json.loads(result.output)
+    except ValueError:
+        raise CommandError(result.returncode, cmd, result.output)
+
+
+# 12. Install bundle
+BUNDLE_BUILD_DIR = "/var/lib/gitlab-charm/bundle-build"
+BUNDLE_ARCHIVE = "/var/lib/gitlab-charm/install-bundle.tar"
+
+_RELEASE_VERSION = re.compile(r"^\d+\.\d+\.\d+(-rc\d+)?(-ee)?$")
+_COMMIT_ID = re.compile(r"^[0-9a-f]{40}$")
+
+
+def version_refs(version):
+    """Return the (remote, local) refs of a GitLab *_VERSION file value.
+
+    Follows the rake install tasks: x.y.z is the tag vx.y.z, a commit id is
+    fetched by itself, anything else is a branch.
+    """
+    if _RELEASE_VERSION.match(version):
+        ref = "refs/tags/v" + version
+        return ref, ref
+    if _COMMIT_ID.match(version):
+        return version, "refs/heads/pinned-" + version[:12]
+    return "refs/heads/" + version, "refs/heads/" + version
+
+
+def _bundle_debs(root):
+    debs = os.path.join(root, "debs")
+    mkdir(os.path.join(debs, "partial"), perms=0o755)
+    # with an empty dpkg status apt downloads the complete dependency closure,
+    # the target only installs what it misses. pgbouncer and the exporters
+    # are installed later, when their config options are enabled
+    packages = package_manifest(DEFAULT_PACKAGE_GROUPS + ["pgbouncer", "metrics"])
+    with _apt_lock:
+        check_output(["apt-get", "install", "--assume-yes", "--download-only",
+                      "--option=Dir::State::status=/dev/null",
+                      "--option=Dir::Cache::archives={}".format(debs)] + packages,
+                     name="download debs", timeout=BUILD_TIMEOUT)
+    shutil.rmtree(os.path.join(debs, "partial"))
+    with contextlib.suppress(FileNotFoundError):
+        os.unlink(os.path.join(debs, "lock"))
+    check_output(["/bin/bash", "-c", "cd {} && apt-ftparchive packages . > Packages".format(debs)])
+
+
+def _bundle_artifacts(root, cache):
+    """Copy the artifacts into the bundle, returns the key of the git build."""
+    # the tarballs are downloaded when they were evicted, the install trees
+    # have to be there
+    cache.fetch("ruby", RUBY_VERSION, RUBY_URL, RUBY_SHA256)
+    cache.fetch("go", GO_VERSION, GO_URL, GO_SHA256)
+    # git installed before the builds were keyed by the gitaly commit
+    git_key = installed_git_key() or GITALY_BRANCH
+    if not cache.lookup("git", git_key + artifacts.TREE_SUFFIX):
+        cache.snapshot("git", git_key, "/usr/local", GIT_INSTALL_PATHS)
+    names = ["ruby-" + RUBY_VERSION, "go-" + GO_VERSION,
+             "ruby-{}{}".format(RUBY_VERSION, artifacts.TREE_SUFFIX),
+             "git-{}{}".format(git_key, artifacts.TREE_SUFFIX)]
+    target = artifacts.ArtifactCache(os.path.join(root, "artifacts"), max_size=sys.maxsize)
+    # the gitlab build is optional, it is there once the assets were compiled
+    target.add_entries(cache.path, names + ["gitlab-build-{}{}".format(
+        gitlab_build_key(), artifacts.TREE_SUFFIX)])
+    missing = [name for name in names if not os.path.isdir(os.path.join(target.path, name))]
+    if missing:
+        raise bundle.BundleError("Not in the artifact cache: {}".format(", ".join(missing)))
+    return git_key
+
+
+def _bundle_sources(root):
+    versions = {
+        "gitlab": GITLAB_BRANCH,
+        "gitlab-shell": _read_version("GITLAB_SHELL_VERSION"),
+        "gitaly": _read_version("GITALY_SERVER_VERSION"),
+        "gitlab-pages": _read_version("GITLAB_PAGES_VERSION"),
+    }
+    for name, version in sorted(versions.items()):
+        remote, local = version_refs(version)
+        target = os.path.join(root, "git", name + ".git")
+        check_output(["git", "init", "--quiet", "--bare", target])
+        check_output(["git", "-C", target, "fetch", "--quiet", "--depth", "1", SOURCES[name],
+                      "+{}:{}".format(remote, local)], name="fetch " + name)
+    return versions
+
+
+def _bundle_gems(root):
+    gems = os.path.join(root, "gems")
+    mkdir(gems, owner="git", group="git", perms=0o755)
+    for app in ("/home/git/gitlab", "/home/git/gitaly/ruby"):
+        cmd = [
+            "/bin/bash", "-c",
+            "cd {} ;"
+            "sudo -u git -H BUNDLE_CACHE_PATH={} bundle cache --no-install ;".format(app, gems)
+        ]
+        check_output(cmd, name="bundle cache " + os.path.basename(app))
+
+
+def _bundle_node(root):
+    npm = os.path.join(root, "npm")
+    mkdir(npm, perms=0o755)
+    version = check_output(["yarn", "--version"], capture=True).strip()
+    check_output(["/bin/bash", "-c", "cd {} && npm pack --quiet yarn@{}".format(npm, version)])
+
+    # a throwaway install of gitlab's yarn.lock fills the offline mirror
+    mirror = os.path.join(root, "yarn")
+    work_dir = tempfile.mkdtemp(prefix="yarn-mirror-")
+    try:
+        for name in ("package.json", "yarn.lock"):
+            shutil.copy(os.path.join("/home/git/gitlab", name), work_dir)
+        with open(os.path.join(work_dir, ".yarnrc"), "w") as f:
+            f.write("yarn-offline-mirror \"{}\"\nyarn-offline-mirror-pruning false\n".format(
+                mirror))
+        cmd = [
+            "/bin/bash", "-c",
+            "cd {0} && yarn install --frozen-lockfile --ignore-scripts --ignore-engines "
+            "--non-interactive --cache-folder {0}/cache --modules-folder {0}/node_modules"
+            "".format(work_dir)
+        ]
+        check_output(cmd, name="yarn mirror", timeout=BUILD_TIMEOUT)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    return version
+
+
+@profiled()
+def build_install_bundle(archive=BUNDLE_ARCHIVE, cache=None):
+    """Build an install bundle of this unit's GitLab install into archive.
+
+    Runs on an installed unit with network access: the install trees come
+    from its artifact cache, the gems and Go modules from its builds.
+    Returns the manifest of the bundle.
+    """
+    logger.info("Build install bundle %s", archive)
+    cache = cache or artifacts.ArtifactCache()
+    install_packages_and_dependencies(package_manifest(["bundle"]))
+    if not os.path.isdir(GO_MODCACHE):
+        raise bundle.BundleError("No Go module cache in {}".format(GO_MODCACHE))
+
+    shutil.rmtree(BUNDLE_BUILD_DIR, ignore_errors=True)
+    root = os.path.join(BUNDLE_BUILD_DIR, "root")
+    mkdir(root, perms=0o755)
+    try:
+        _bundle_debs(root)
+        git_key = _bundle_artifacts(root, cache)
+        versions = _bundle_sources(root)
+        versions["git"] = git_key
+        _bundle_gems(root)
+        mkdir(os.path.join(root, "go"), perms=0o755)
+        check_output(["tar", "-C", GO_MODCACHE, "-czf",
+                      os.path.join(root, "go", "modcache.tar.gz"), "."], name="pack go modules")
+        versions["yarn"] = _bundle_node(root)
+        manifest = bundle.write_manifest(root, gitlab_branch=GITLAB_BRANCH, versions=versions)
+        bundle.pack(root, archive)
+    finally:
+        shutil.rmtree(BUNDLE_BUILD_DIR, ignore_errors=True)
+    return manifest
+
+
+# 13. Metrics exporters
+# The packaged exporters, configured through the /etc/default file their
+# systemd unit reads. The puma, sidekiq and gitaly exporters are built in.
+EXPORTER_SERVICES = {
+    "redis": "prometheus-redis-exporter",
+    "postgres": "prometheus-postgres-exporter",
+    "nginx": "prometheus-nginx-exporter",
+}
+NGINX_STATUS_PORT = 8060
+NGINX_STATUS_URL = "http://127.0.0.1:{}/nginx_status".format(NGINX_STATUS_PORT)
+
+
+def exporter_defaults(name):
+    """Return the /etc/default file of a packaged exporter."""
+    return os.path.join("/etc/default", EXPORTER_SERVICES[name])
+
+
+@profiled()
+def install_exporters(install_bundle=None):
+    logger.info("Install metrics exporters")
+    install_packages_and_dependencies(package_manifest(["metrics"]),
+                                      install_bundle=install_bundle)
+    # redis_exporter connects to the redis socket
+    check_output(["usermod", "-aG", "redis", "prometheus"])
+
+
+@profiled()
+def enable_exporters(names):
+    """Enable the services of packaged exporters, they start on the restart."""
+    services = [EXPORTER_SERVICES[name] for name in sorted(names)]
+    if services:
+        check_output(["systemctl", "enable"] + services)
+
+
+@profiled()
+def disable_exporter(name):
+    """Stop a packaged exporter and remove its settings, the package is kept.
+
+    Returns True if the exporter was configured.
+    """
+    path = exporter_defaults(name)
+    if not os.path.exists(path):
+        return False
+    logger.info("Disable %s", EXPORTER_SERVICES[name])
+    call(["systemctl", "disable", "--now", EXPORTER_SERVICES[name]])
+    os.unlink(path)
+    return True
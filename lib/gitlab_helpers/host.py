@@ -0,0 +1,134 @@
+# Host facts used to size builds and services
+import logging
+import os
+import shutil
+
+logger = logging.getLogger(__name__)
+
+# memory reserved for one parallel compile job (gcc, go build, native gems)
+BUILD_JOB_MEMORY = 1024 ** 3
+
+
+def _read(path):
+    try:
+        with open(path) as f:
+            return f.read().strip()
+    except OSError:
+        return None
+
+
+def cpuinfo_count(path="/proc/cpuinfo"):
+    """Number of processors listed in /proc/cpuinfo."""
+    try:
+        with open(path) as f:
+            count = sum(1 for line in f if line.startswith("processor"))
+    except OSError:
+        return None
+    return count or None
+
+
+def cgroup_cpu_limit():
+    """CPU quota of the cgroup (v2 or v1) rounded up, None when unlimited."""
+    quota = period = None
+    value = _read("/sys/fs/cgroup/cpu.max")
+    if value:
+        fields = value.split()
+        if fields[0] != "max" and len(fields) == 2:
+            quota, period = int(fields[0]), int(fields[1])
+    else:
+        value = _read("/sys/fs/cgroup/cpu/cpu.cfs_quota_us")
+        if value and int(value) > 0:
+            quota = int(value)
+            period = int(_read("/sys/fs/cgroup/cpu/cpu.cfs_period_us") or 100000)
+    if not quota or not period:
+        return None
+    return max(1, -(-quota // period))
+
+
+def cgroup_memory_limit():
+    """Memory limit of the cgroup (v2 or v1) in bytes, None when unlimited."""
+    for path in ("/sys/fs/cgroup/memory.max",
+                 "/sys/fs/cgroup/memory/memory.limit_in_bytes"):
+        value = _read(path)
+        if value is None or value == "max":
+            continue
+        limit = int(value)
+        # cgroup v1 reports "unlimited" as a huge page aligned number
+        if limit < 2 ** 60:
+            return limit
+    return None
+
+
+def cpu_count():
+    """Number of CPUs this process may use.
+
+    The smallest of /proc/cpuinfo, the scheduler affinity and the cgroup
+    CPU quota.
+    """
+    try:
+        counts = [len(os.sched_getaffinity(0))]
+    except AttributeError:
+        counts = [os.cpu_count() or 1]
+    for count in (cpuinfo_count(), cgroup_cpu_limit()):
+        if count:
+            counts.append(count)
+    return min(counts)
+
+
+def meminfo(path="/proc/meminfo"):
+    """Return /proc/meminfo as a dict of field -> bytes."""
+    info = {}
+    with open(path) as f:
+        for line in f:
+            key, _, value = line.partition(":")
+            fields = value.split()
+            if not fields:
+                continue
+            amount = int(fields[0])
+            if len(fields) > 1 and fields[1] == "kB":
+                amount *= 1024
+            info[key] = amount
+    return info
+
+
+def memory_total():
+    """Memory of the host or the cgroup limit, whichever is lower, in bytes."""
+    total = meminfo().get("MemTotal", 0)
+    limit = cgroup_memory_limit()
+    if limit and (not total or limit < total):
+        return limit
+    return total
+
+
+def memory_available():
+    """Memory available for new work in bytes."""
+    info = meminfo()
+    return info.get("MemAvailable", info.get("MemFree", 0))
+
+
+def disk_space(path):
+    """Total and free bytes of the filesystem path is, or would be, on."""
+    while not os.path.exists(path):
+        parent = os.path.dirname(path)
+        if parent == path:
+            break
+        path = parent
+    usage = shutil.disk_usage(path)
+    return usage.total, usage.free
+
+
+def build_jobs(requested=0):
+    """Number of parallel build jobs.
+
+    Defaults to the CPU count when requested is 0, either way the result is
+    capped so that every job has BUILD_JOB_MEMORY of available memory.
+    """
+    jobs = requested if requested > 0 else cpu_count()
+    try:
+        memory_cap = max(1, memory_available() // BUILD_JOB_MEMORY)
+    except OSError:
+        memory_cap = jobs
+    if memory_cap < jobs:
+        logger.info("Limit build jobs from %d to %d by available memory", jobs, memory_cap)
+        jobs = memory_cap
+    return max(1, jobs)
@@ -0,0 +1,289 @@
+# Repository housekeeping
+#
+# git gc.auto is disabled for the git user (see install_gitlab), so the
+# repositories below /home/git/repositories are only optimized when GitLab's
+# own housekeeping runs for them. This module walks the storage, ranks the
+# repositories by how fragmented their object database is and optimizes the
+# worst ones in a small pool of workers at idle I/O priority:
+#
+#   loose objects over the limit   git repack -d -l          (incremental)
+#                                  git prune
+#   packs over the limit           git repack -A -d -l -b    (full, bitmap)
+#   several packs left             git multi-pack-index write
+#   always                         git commit-graph write --reachable --split
+#
+# Object pools (@pools, or any repository other repositories borrow objects
+# from through objects/info/alternates) are never touched: their objects
+# look unreachable from the pool itself, a repack or prune there would
+# remove objects the member repositories depend on. GitLab maintains them.
+#
+# It only uses the standard library and runs as a script as the git user,
+# from the housekeeping timer and the housekeeping action:
+#
+#   python3 housekeeping.py [--workers N] [--limit N] [--dry-run] [--json]
+import argparse
+import json
+import logging
+import os
+import os.path
+import re
+import subprocess
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+REPOSITORIES_ROOT = "/home/git/repositories"
+# where GitLab keeps the object pools of forked projects
+POOLS_DIR = "@pools"
+
+# git's own gc.auto and gc.autoPackLimit defaults are 6700 and 50, the
+# limits are lower to keep the repositories served by gitaly well packed
+LOOSE_OBJECTS_LIMIT = 1024
+PACKS_LIMIT = 16
+# a pack costs about as much on lookups as this many loose objects
+PACK_WEIGHT = 64
+
+# idle I/O class and lowest CPU priority, housekeeping yields to gitaly
+NICE_PREFIX = ["nice", "-n", "19", "ionice", "-c", "3"]
+
+_LOOSE_DIR = re.compile(r"^[0-9a-f]{2}$")
+
+
+class RepositoryStats:
+    """Object database statistics of a bare repository."""
+
+    def __init__(self, path, loose_objects=0, loose_size=0, packs=0, packs_size=0,
+                 commit_graph=False, multi_pack_index=False, bitmap=False):
+        self.path = path
+        self.loose_objects = loose_objects
+        self.loose_size = loose_size
+        self.packs = packs
+        self.packs_size = packs_size
+        self.commit_graph = commit_graph
+        self.multi_pack_index = multi_pack_index
+        self.bitmap = bitmap
+
+    @property
+    def size(self):
+        return self.loose_size + self.packs_size
+
+    @property
+    def score(self):
+        """Higher is worse, used to rank the repositories."""
+        return self.loose_objects + PACK_WEIGHT * self.packs
+
+    def __repr__(self):
+        return "RepositoryStats({!r}, loose_objects={}, packs={})".format(
+            self.path, self.loose_objects, self.packs)
+
+
+def alternates(path):
+    """Return the object directories a bare repository borrows objects from."""
+    objects = os.path.join(path, "objects")
+    try:
+        with open(os.path.join(objects, "info", "alternates")) as f:
+            lines = [line.strip() for line in f]
+    except OSError:
+        return []
+    # relative entries are relative to the objects directory
+    return [os.path.normpath(os.path.join(objects, line)) for line in lines
+            if line and not line.startswith("#")]
+
+
+def find_repositories(root=REPOSITORIES_ROOT):
+    """Return the bare repositories (*.git directories) below root.
+
+    Object pools are left out, the POOLS_DIR tree and any repository listed
+    in the alternates of another one.
+    """
+    found = []
+    for dirpath, dirnames, _ in os.walk(root):
+        repos = [d for d in dirnames if d.endswith(".git")]
+        for name in repos:
+            path = os.path.join(dirpath, name)
+            if os.path.isfile(os.path.join(path, "HEAD")):
+                found.append(path)
+        # gitaly's own state (+gitaly), the pools and the repositories are
+        # not descended into
+        skipped = set(repos) | {POOLS_DIR}
+        dirnames[:] = sorted(d for d in dirnames if d not in skipped and not d.startswith("+"))
+    pools = set()
+    for path in found:
+        pools.update(os.path.dirname(objects) for objects in alternates(path))
+    return [path for path in found if os.path.normpath(path) not in pools]
+
+
+def repository_stats(path):
+    """Collect the RepositoryStats of a bare repository."""
+    stats = RepositoryStats(path)
+    objects = os.path.join(path, "objects")
+    try:
+        entries = os.listdir(objects)
+    except OSError:
+        return stats
+    for entry in entries:
+        if not _LOOSE_DIR.match(entry):
+            continue
+        with os.scandir(os.path.join(objects, entry)) as it:
+            for obj in it:
+                stats.loose_objects += 1
+                stats.loose_size += obj.stat().st_size
+    pack_dir = os.path.join(objects, "pack")
+    try:
+        with os.scandir(pack_dir) as it:
+            for entry in it:
+                if entry.name.endswith(".pack"):
+                    stats.packs += 1
+                    stats.packs_size += entry.stat().st_size
+                elif entry.name.endswith(".bitmap"):
+                    stats.bitmap = True
+                elif entry.name == "multi-pack-index":
+                    stats.multi_pack_index = True
+    except OSError:
+        pass
+    info = os.path.join(objects, "info")
+    stats.commit_graph = any(os.path.exists(os.path.join(info, name))
+                             for name in ("commit-graph", "commit-graphs"))
+    return stats
+
+
+def plan(stats, loose_objects_limit=LOOSE_OBJECTS_LIMIT, packs_limit=PACKS_LIMIT):
+    """Return the housekeeping steps a repository needs, may be empty.
+
+    The steps are "full-repack", "incremental-repack", "prune",
+    "multi-pack-index" and "commit-graph", in the order they have to run.
+    """
+    steps = []
+    if stats.packs > packs_limit:
+        steps = ["full-repack"]
+        packs = 1
+    elif stats.loose_objects > loose_objects_limit:
+        # unreachable objects are left loose by the repack
+        steps = ["incremental-repack", "prune"]
+        packs = stats.packs + 1
+    else:
+        packs = stats.packs
+    # the index has to cover the new packs, an outdated one is rewritten
+    if steps and (packs > 1 or stats.multi_pack_index):
+        steps.append("multi-pack-index")
+    elif packs > 1 and not stats.multi_pack_index:
+        steps.append("multi-pack-index")
+    if steps or (stats.packs and not stats.commit_graph):
+        steps.append("commit-graph")
+    return steps
+
+
+STEP_COMMANDS = {
+    "full-repack": ["git", "repack", "-A", "-d", "-l", "-b", "--pack-kept-objects",
+                    "--unpack-unreachable=2.weeks.ago"],
+    "incremental-repack": ["git", "repack", "-d", "-l"],
+    # objects younger than that may be about to be referenced by a push
+    "prune": ["git", "prune", "--expire=2.weeks.ago"],
+    "multi-pack-index": ["git", "multi-pack-index", "write"],
+    "commit-graph": ["git", "commit-graph", "write", "--reachable", "--split"],
+}
+
+
+def optimize(stats, steps, nice=True):
+    """Run the steps on a repository.
+
+    Returns a result dict with the steps, bytes reclaimed, seconds spent and
+    the error of the failed step, if any.
+    """
+    start = time.monotonic()
+    error = None
+    for step in steps:
+        cmd = ["git", "-C", stats.path] + STEP_COMMANDS[step][1:]
+        if nice:
+            cmd = NICE_PREFIX + cmd
+        try:
+            subprocess.run(cmd, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+                           universal_newlines=True)
+        except (OSError, subprocess.CalledProcessError) as e:
+            error = "{}: {}".format(step, getattr(e, "stderr", None) or e)
+            logger.warning("Housekeeping of %s failed: %s", stats.path, error)
+            break
+    after = repository_stats(stats.path)
+    return {
+        "repository": stats.path,
+        "steps": steps,
+        "bytes_reclaimed": stats.size - after.size,
+        "seconds": round(time.monotonic() - start, 3),
+        "loose_objects": [stats.loose_objects, after.loose_objects],
+        "packs": [stats.packs, after.packs],
+        "error": error,
+    }
+
+
+def run(root=REPOSITORIES_ROOT, workers=1, limit=0, dry_run=False,
+        loose_objects_limit=LOOSE_OBJECTS_LIMIT, packs_limit=PACKS_LIMIT, nice=True):
+    """Optimize the repositories below root, the most fragmented first.
+
+    At most limit repositories (0 for all that need it) are optimized by
+    workers threads, each running its git commands one after another.
+    Returns a report dict with a result per repository and the totals.
+    """
+    start = time.monotonic()
+    candidates = []
+    scanned = 0
+    for path in find_repositories(root):
+        scanned += 1
+        stats = repository_stats(path)
+        steps = plan(stats, loose_objects_limit, packs_limit)
+        if steps:
+            candidates.append((stats, steps))
+    candidates.sort(key=lambda candidate: candidate[0].score, reverse=True)
+    if limit:
+        candidates = candidates[:limit]
+
+    if dry_run:
+        results = [{"repository": stats.path, "steps": steps,
+                    "loose_objects": [stats.loose_objects], "packs": [stats.packs]}
+                   for stats, steps in candidates]
+    else:
+        with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+            results = list(executor.map(lambda candidate: optimize(*candidate, nice=nice),
+                                        candidates))
+    return {
+        "scanned": scanned,
+        "optimized": 0 if dry_run else len(results),
+        "failed": sum(1 for result in results if result.get("error")),
+        "bytes_reclaimed": sum(result.get("bytes_reclaimed", 0) for result in results),
+        "seconds": round(time.monotonic() - start, 3),
+        "results": results,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Optimize the GitLab repositories.")
+    parser.add_argument("--root", default=REPOSITORIES_ROOT)
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--limit", type=int, default=0,
+                        help="optimize at most this many repositories, 0 for all")
+    parser.add_argument("--loose-objects", type=int, default=LOOSE_OBJECTS_LIMIT)
+    parser.add_argument("--packs", type=int, default=PACKS_LIMIT)
+    parser.add_argument("--dry-run", action="store_true")
+    parser.add_argument("--json", action="store_true", help="print the report as JSON")
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+
+    report = run(args.root, workers=args.workers, limit=args.limit, dry_run=args.dry_run,
+                 loose_objects_limit=args.loose_objects, packs_limit=args.packs)
+    if args.json:
+        json.dump(report, sys.stdout)
+        return 1 if report["failed"] else 0
+    for result in report["results"]:
+        logger.info("%s: %s, %d bytes reclaimed in %.1fs%s", result["repository"],
+                    " ".join(result["steps"]), result.get("bytes_reclaimed", 0),
+                    result.get("seconds", 0),
+                    " (failed: {})".format(result["error"]) if result.get("error") else "")
+    logger.info("%d of %d repositories optimized, %d failed, %d bytes reclaimed in %.1fs",
+                report["optimized"], report["scanned"], report["failed"],
+                report["bytes_reclaimed"], report["seconds"])
+    return 1 if report["failed"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,163 @@
+# Prometheus metrics of the GitLab services
+#
+# With the metrics config option each service of a unit exposes its metrics
+# on its own port: puma (web exporter) and sidekiq (sidekiq exporter) are
+# built into GitLab, gitaly listens on prometheus_listen_addr, redis, the
+# database and nginx (stub_status) are covered by the Debian packaged
+# exporters.
+#
+# The exporters are published over the metrics-endpoint relation, the
+# prometheus_scrape interface: the leader sets the scrape jobs and the
+# model metadata in the application data, each unit sets its address in its
+# unit data. Job targets use "*" as their host, Prometheus scrapes the port
+# on every unit address. The exporters have no authentication, they only
+# listen on the ingress address of the metrics-endpoint binding, the address
+# Prometheus scrapes, not on every interface of the unit.
+#
+# scrape() fetches an endpoint the way Prometheus does and parses the text
+# exposition format, the check-metrics action verifies the exporters of a
+# unit with it.
+import json
+import logging
+import re
+import urllib.error
+import urllib.request
+
+logger = logging.getLogger(__name__)
+
+# exporter -> the config option of its port, in the order of the scrape jobs
+EXPORTERS = {
+    "puma": "puma_exporter_port",
+    "sidekiq": "sidekiq_exporter_port",
+    "gitaly": "gitaly_exporter_port",
+    "redis": "redis_exporter_port",
+    "postgres": "postgres_exporter_port",
+    "nginx": "nginx_exporter_port",
+}
+METRICS_PATH = "/metrics"
+# the exporters listen here when the unit has no metrics-endpoint address
+LOCAL_ADDRESS = "127.0.0.1"
+ACCEPT = "text/plain;version=0.0.4;q=1,*/*;q=0.1"
+SCRAPE_TIMEOUT = 10
+
+_DURATION_PATTERN = re.compile(r"^(\d+)(ms|s|m|h|d|w|y)$")
+_DURATION_UNITS = {"ms": 0.001, "s": 1, "m": 60, "h": 3600, "d": 86400, "w": 604800,
+                   "y": 31536000}
+_SAMPLE_PATTERN = re.compile(
+    r"^(?P<name>[a-zA-Z_:][a-zA-Z0-9_:]*)(?P<labels>\{.*\})?\s+(?P<value>\S+)(\s+-?\d+)?$")
+
+
+class MetricsError(Exception):
+    """Raised when an endpoint can not be scraped or returns no metrics."""
+
+
+def duration_seconds(value):
+    """Return a Prometheus duration like "30s" in seconds, None if invalid."""
+    match = _DURATION_PATTERN.match(value)
+    if not match:
+        return None
+    return int(match.group(1)) * _DURATION_UNITS[match.group(2)]
+
+
+def job_name(exporter):
+    return "gitlab-" + exporter if exporter in ("puma", "sidekiq") else exporter
+
+
+def listen_address(address, port):
+    """Return the host:port an exporter listens on, IPv6 addresses in brackets."""
+    return "{}:{}".format("[{}]".format(address) if ":" in address else address, port)
+
+
+def scrape_jobs(ports, interval, timeout):
+    """Return the prometheus_scrape jobs of the exporters.
+
+    ports maps the enabled exporters to their port, each becomes a job
+    scraping that port on every unit.
+    """
+    return [{
+        "job_name": job_name(exporter),
+        "metrics_path": METRICS_PATH,
+        "scrape_interval": interval,
+        "scrape_timeout": timeout,
+        "static_configs": [{"targets": ["*:{}".format(ports[exporter])]}],
+    } for exporter in EXPORTERS if exporter in ports]
+
+
+def scrape_metadata(model, model_uuid, application, charm_name):
+    """Return the model metadata Prometheus labels the scraped series with."""
+    return {
+        "model": model,
+        "model_uuid": model_uuid,
+        "application": application,
+        "charm_name": charm_name,
+    }
+
+
+def relation_data(jobs, metadata):
+    """Return the application data of a metrics-endpoint relation."""
+    return {
+        "scrape_jobs": json.dumps(jobs, sort_keys=True),
+        "scrape_metadata": json.dumps(metadata, sort_keys=True),
+    }
+
+
+def environment_value(value):
+    """Quote a value of a systemd EnvironmentFile, like the /etc/default files."""
+    return '"{}"'.format(str(value).replace("\\", "\\\\").replace('"', '\\"'))
+
+
+def parse_metrics(text):
+    """Parse the text exposition format, returns a dict of metric -> samples.
+
+    Raises MetricsError on a line that is neither a comment nor a sample.
+    """
+    samples = {}
+    for number, line in enumerate(text.splitlines(), start=1):
+        line = line.strip()
+        if not line or line.startswith("#"):
+            continue
+        match = _SAMPLE_PATTERN.match(line)
+        if not match:
+            raise MetricsError("Line {} is not a sample: {}".format(number, line[:80]))
+        try:
+            float(match.group("value"))
+        except ValueError:
+            raise MetricsError("Line {} has no numeric value: {}".format(number, line[:80]))
+        name = match.group("name")
+        samples[name] = samples.get(name, 0) + 1
+    return samples
+
+
+def scrape(url, timeout=SCRAPE_TIMEOUT):
+    """Fetch and parse the metrics at url, returns a dict of metric -> samples."""
+    request = urllib.request.Request(url, headers={"Accept": ACCEPT})
+    try:
+        with urllib.request.urlopen(request, timeout=timeout) as response:
+            text = response.read().decode("utf-8")
+    except (OSError, urllib.error.URLError, UnicodeDecodeError) as e:
+        raise MetricsError("Unable to scrape {}: {}".format(url, e))
+    samples = parse_metrics(text)
+    if not samples:
+        raise MetricsError("No metrics at {}".format(url))
+    return samples
+
+
+def check_exporters(ports, host=LOCAL_ADDRESS, timeout=SCRAPE_TIMEOUT):
+    """Scrape the exporters on host, returns a dict of exporter -> result.
+
+    A result has the number of metrics and samples scraped, or the error.
+    """
+    results = {}
+    for exporter in EXPORTERS:
+        if exporter not in ports:
+            continue
+        url = "http://{}{}".format(listen_address(host, ports[exporter]), METRICS_PATH)
+        try:
+            samples = scrape(url, timeout=timeout)
+        except MetricsError as e:
+            logger.warning("%s exporter: %s", exporter, e)
+            results[exporter] = {"url": url, "error": str(e)}
+            continue
+        results[exporter] = {"url": url, "metrics": len(samples),
+                             "samples": sum(samples.values())}
+    return results
@@ -0,0 +1,131 @@
+# Hook profiling
+#
+# Records the wall-clock time of the helper steps, the template renders and
+# every command run during a hook, together with the exit code and the size
+# of the captured output. The records of the last MAX_HOOKS hooks are kept in
+# a JSON file and reported by the hook-profile action.
+#
+#   @profiled()                 time a function as a "step"
+#   @profiled(kind="render")
+#
+# Commands are recorded by gitlab_helpers.runner.
+import functools
+import json
+import logging
+import os
+import os.path
+import subprocess
+import tempfile
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+PROFILE_FILE = "/var/lib/gitlab-charm/hook-profile.json"
+MAX_HOOKS = 50
+# commands are recorded by their first characters, "bash -c" scripts by
+# their script
+COMMAND_NAME_LENGTH = 80
+
+_lock = threading.Lock()
+_records = []
+
+
+def record(name, kind, seconds, exit_code=None, output_bytes=None):
+    """Add a record to the profile of the running hook."""
+    entry = {"name": name, "kind": kind, "seconds": round(seconds, 4),
+             "exit_code": exit_code, "output_bytes": output_bytes}
+    with _lock:
+        _records.append(entry)
+
+
+def records():
+    """Return the records of the running hook."""
+    with _lock:
+        return list(_records)
+
+
+def reset():
+    with _lock:
+        del _records[:]
+
+
+def profiled(name=None, kind="step"):
+    """Decorator recording the duration of each call of a function.
+
+    An exception is recorded with exit code 1, or the exit code of a failed
+    command.
+    """
+    def decorator(func):
+        label = name or func.__qualname__
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            start = time.monotonic()
+            exit_code = 0
+            try:
+                return func(*args, **kwargs)
+            except subprocess.CalledProcessError as e:
+                exit_code = e.returncode
+                raise
+            except Exception:
+                exit_code = 1
+                raise
+            finally:
+                record(label, kind, time.monotonic() - start, exit_code=exit_code)
+        return wrapper
+    return decorator
+
+
+def command_name(cmd):
+    """Short, readable name of a command for the profile."""
+    if isinstance(cmd, str):
+        text = cmd
+    elif len(cmd) >= 3 and cmd[1] == "-c":
+        text = cmd[2]
+    else:
+        text = " ".join(str(arg) for arg in cmd)
+    text = " ".join(text.split())
+    if len(text) > COMMAND_NAME_LENGTH:
+        text = text[:COMMAND_NAME_LENGTH - 3] + "..."
+    return text
+
+
+def load(path=PROFILE_FILE):
+    """Return the stored hook profiles, oldest first."""
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return []
+
+
+def save(hook, seconds, path=PROFILE_FILE, max_hooks=MAX_HOOKS):
+    """Append the records of the running hook to the profile file.
+
+    Keeps the last max_hooks hooks, the records are reset afterwards. A
+    failure to write is logged, profiling never fails a hook.
+    """
+    profile = {"hook": hook, "time": round(time.time()), "seconds": round(seconds, 3),
+               "records": records()}
+    reset()
+    hooks = (load(path) + [profile])[-max_hooks:]
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".hook-profile-")
+        with os.fdopen(fd, "w") as f:
+            json.dump(hooks, f)
+        os.replace(tmp, path)
+    except OSError as e:
+        logger.warning("Unable to store the hook profile: %s", e)
+    return profile
+
+
+def slowest(hooks, top=10):
+    """Return the top slowest records of the given hooks.
+
+    Each record carries the name of the hook it was recorded in.
+    """
+    entries = [dict(entry, hook=profile["hook"])
+               for profile in hooks for entry in profile["records"]]
+    return sorted(entries, key=lambda entry: entry["seconds"], reverse=True)[:top]
@@ -0,0 +1,216 @@
+# Streaming command runner
+#
+# The install and bootstrap steps run commands with megabytes of output
+# (bundle install, the ruby build, rake gitlab:setup). The runner reads the
+# output line by line instead of buffering it, keeps only the last
+# TAIL_BYTES for the error report, forwards a throttled progress line to a
+# handler (the charm sets it as MaintenanceStatus) and kills commands that
+# run longer than their timeout.
+#
+#   check_output(cmd, name="gems", timeout=2 * HOUR)
+#   call(cmd)                            exit code, never raises
+#   run(cmd, check=False) -> Result      exit code and (tail of) output
+#
+# Every command is recorded in the hook profile.
+import collections
+import contextlib
+import logging
+import os
+import signal
+import subprocess
+import threading
+import time
+
+from gitlab_helpers import profiling
+
+logger = logging.getLogger(__name__)
+
+MINUTE = 60
+HOUR = 60 * MINUTE
+
+DEFAULT_TIMEOUT = 30 * MINUTE
+# output kept for the error report of a failed command
+TAIL_BYTES = 64 * 1024
+# minimum seconds between two progress updates
+PROGRESS_INTERVAL = 10
+PROGRESS_LENGTH = 100
+
+Result = collections.namedtuple("Result", ["returncode", "output"])
+
+
+class CommandError(subprocess.CalledProcessError):
+    """A command failed, output holds the tail of its output."""
+
+    def __str__(self):
+        tail = (self.output or "").strip().splitlines()[-5:]
+        return "{}{}".format(super().__str__(), "".join("\n  " + line for line in tail))
+
+
+class CommandTimeout(CommandError):
+    """A command was killed after running longer than its timeout."""
+
+    def __init__(self, cmd, timeout, output=None):
+        super().__init__(-signal.SIGKILL, cmd, output)
+        self.timeout = timeout
+
+    def __str__(self):
+        return "Command '{}' timed out after {} seconds".format(
+            profiling.command_name(self.cmd), self.timeout)
+
+
+class OutputTail:
+    """Ring buffer of the last max_bytes of output, as whole lines."""
+
+    def __init__(self, max_bytes=TAIL_BYTES):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.total = 0
+        self._lines = collections.deque()
+        self._lock = threading.Lock()
+
+    def append(self, line):
+        with self._lock:
+            self._lines.append(line)
+            self.size += len(line)
+            self.total += len(line)
+            while self.max_bytes and self.size > self.max_bytes and len(self._lines) > 1:
+                self.size -= len(self._lines.popleft())
+
+    def text(self):
+        with self._lock:
+            return "".join(self._lines)
+
+
+class _Progress:
+    """Forwards at most one output line per PROGRESS_INTERVAL to a handler."""
+
+    def __init__(self):
+        self.handler = None
+        self.last = None
+        self._lock = threading.Lock()
+
+    def update(self, name, line):
+        if self.handler is None:
+            return
+        line = line.strip()
+        if not line:
+            return
+        with self._lock:
+            now = time.monotonic()
+            if self.last is not None and now - self.last < PROGRESS_INTERVAL:
+                return
+            self.last = now
+            message = "{}: {}".format(name, line)
+            if len(message) > PROGRESS_LENGTH:
+                message = message[:PROGRESS_LENGTH - 3] + "..."
+            try:
+                self.handler(message)
+            except Exception as e:
+                logger.debug("Progress handler failed: %s", e)
+
+
+_progress = _Progress()
+
+
+@contextlib.contextmanager
+def progress(handler):
+    """Send throttled progress messages of the running commands to handler."""
+    previous, _progress.handler = _progress.handler, handler
+    _progress.last = None
+    try:
+        yield
+    finally:
+        _progress.handler = previous
+
+
+def _read(stream, name, tail, keep=None):
+    for line in iter(stream.readline, ""):
+        tail.append(line)
+        if keep is not None:
+            # captured output is data, not progress
+            keep.append(line)
+        else:
+            _progress.update(name, line)
+
+
+def run(cmd, check=False, timeout=DEFAULT_TIMEOUT, name=None, tail_bytes=TAIL_BYTES,
+        capture=False, env=None, cwd=None):
+    """Run a command and stream its output.
+
+    stderr is merged into stdout, unless capture is set: then the returned
+    output is all of stdout (for commands whose output is parsed) and
+    stderr only goes to the tail. Otherwise the returned output is the
+    tail. The command and its children are killed after timeout seconds
+    (None for no limit), raising CommandTimeout. With check a non-zero exit
+    code raises CommandError.
+    """
+    name = name or profiling.command_name(cmd)
+    tail = OutputTail(tail_bytes)
+    kept = [] if capture else None
+    start = time.monotonic()
+    timed_out = threading.Event()
+    returncode = None
+    try:
+        proc = subprocess.Popen(cmd, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE,
+                                stderr=subprocess.PIPE if capture else subprocess.STDOUT,
+                                universal_newlines=True, errors="replace", env=env, cwd=cwd,
+                                start_new_session=True)
+    except OSError:
+        profiling.record(name, "command", time.monotonic() - start, exit_code=127)
+        raise
+
+    def kill():
+        timed_out.set()
+        logger.warning("Command '%s' timed out after %ss, killing it", name, timeout)
+        try:
+            os.killpg(proc.pid, signal.SIGKILL)
+        except OSError:
+            pass
+
+    timer = threading.Timer(timeout, kill) if timeout else None
+    readers = []
+    if capture:
+        readers.append(threading.Thread(target=_read, args=(proc.stderr, name, tail),
+                                        daemon=True))
+    try:
+        if timer:
+            timer.start()
+        for reader in readers:
+            reader.start()
+        _read(proc.stdout, name, tail, kept)
+        for reader in readers:
+            reader.join()
+        returncode = proc.wait()
+    finally:
+        if timer:
+            timer.cancel()
+        if returncode is None:
+            proc.kill()
+            proc.wait()
+        for stream in (proc.stdout, proc.stderr):
+            if stream:
+                stream.close()
+        profiling.record(name, "command", time.monotonic() - start,
+                         exit_code=proc.returncode, output_bytes=tail.total)
+
+    output = "".join(kept) if capture else tail.text()
+    if timed_out.is_set():
+        raise CommandTimeout(cmd, timeout, tail.text())
+    if check and returncode:
+        raise CommandError(returncode, cmd, tail.text())
+    return Result(returncode, output)
+
+
+def check_output(cmd, universal_newlines=True, **kwargs):
+    """Run a command, raise CommandError when it fails.
+
+    Returns the output like subprocess.check_output, see run() for what is
+    kept of it.
+    """
+    output = run(cmd, check=True, **kwargs).output
+    return output if universal_newlines else output.encode()
+
+
+def call(cmd, **kwargs):
+    """Run a command and return its exit code."""
+    return run(cmd, **kwargs).returncode
@@ -0,0 +1,216 @@
+# Change-aware rendering of the configuration templates
+#
+# The templates of a GitLab release live in templates/<major>-<minor>-stable.
+# A RenderEngine holds one Jinja environment per template set: a template is
+# parsed once per hook, its compiled bytecode is kept in BYTECODE_CACHE_DIR
+# across hooks. Jinja checks the bytecode against the template source, an
+# upgraded charm never renders stale templates.
+#
+# render_all() renders a list of TemplateFiles in one pass from a shared
+# context, each file may add to it. A file is only written when its content
+# changed, through a temporary file renamed over the target, a reader never
+# sees a partially written configuration. render_files() and write_files()
+# are its two halves, for a caller that prepares the host in between.
+import grp
+import hashlib
+import logging
+import os
+import os.path
+import pwd
+import re
+import tempfile
+import time
+
+from charmhelpers.core.hookenv import charm_dir
+from jinja2 import Environment, FileSystemBytecodeCache, FileSystemLoader
+
+from gitlab_helpers import profiling
+
+logger = logging.getLogger(__name__)
+
+BYTECODE_CACHE_DIR = "/var/lib/gitlab-charm/jinja-cache"
+
+_SET_PATTERN = re.compile(r"^(\d+)-(\d+)-stable$")
+_VERSION_PATTERN = re.compile(r"(\d+)[.-](\d+)")
+_engines = {}
+
+
+class TemplateError(Exception):
+    """Raised when there is no template set for a GitLab version."""
+
+
+def templates_dir():
+    return os.path.join(charm_dir() or os.getcwd(), "templates")
+
+
+def template_set(version, root=None):
+    """Return the template set of a GitLab version or stable branch.
+
+    That is the newest set not newer than the version, a patch release or
+    a new stable branch without template changes uses the templates of the
+    release before.
+    """
+    root = root or templates_dir()
+    match = _VERSION_PATTERN.search(version)
+    if not match:
+        raise TemplateError("Not a GitLab version: {}".format(version))
+    wanted = (int(match.group(1)), int(match.group(2)))
+    sets = []
+    for name in os.listdir(root):
+        match = _SET_PATTERN.match(name)
+        if match and os.path.isdir(os.path.join(root, name)):
+            release = (int(match.group(1)), int(match.group(2)))
+            if release <= wanted:
+                sets.append((release, name))
+    if not sets:
+        raise TemplateError("No templates for GitLab {} in {}".format(version, root))
+    return max(sets)[1]
+
+
+def file_digest(path):
+    """Return the sha256 hex digest of a file, None if it does not exist."""
+    digest = hashlib.sha256()
+    try:
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                digest.update(chunk)
+    except FileNotFoundError:
+        return None
+    return digest.hexdigest()
+
+
+def write_atomic(target, content, owner='root', group='root', perms=0o444):
+    """Write content (bytes) to a temporary file and rename it over target."""
+    uid = pwd.getpwnam(owner).pw_uid
+    gid = grp.getgrnam(group).gr_gid
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(target) or ".",
+                               prefix=".{}.".format(os.path.basename(target)))
+    try:
+        with os.fdopen(fd, "wb") as f:
+            os.fchown(f.fileno(), uid, gid)
+            os.fchmod(f.fileno(), perms)
+            f.write(content)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, target)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+
+
+def write_if_changed(target, content, owner='root', group='root', perms=0o444):
+    """Write content (bytes) to target only if it differs from disk.
+
+    Returns True when the target file was written.
+    """
+    if hashlib.sha256(content).hexdigest() == file_digest(target):
+        logger.debug("%s is up to date", target)
+        return False
+    logger.debug("Write %s", target)
+    write_atomic(target, content, owner=owner, group=group, perms=perms)
+    return True
+
+
+class TemplateFile:
+    """A file rendered from a template, with its own additions to the context."""
+
+    def __init__(self, template, target, context=None, owner='root', group='root',
+                 perms=0o444):
+        self.template = template
+        self.target = target
+        self.context = context or {}
+        self.owner = owner
+        self.group = group
+        self.perms = perms
+
+    def __repr__(self):
+        return "TemplateFile({!r}, {!r})".format(self.template, self.target)
+
+
+class RenderEngine:
+    """The Jinja environment of a template set."""
+
+    def __init__(self, template_set, root=None, cache_dir=BYTECODE_CACHE_DIR):
+        self.template_set = template_set
+        self.path = os.path.join(root or templates_dir(), template_set)
+        self.cache_dir = cache_dir
+        self._environment = None
+
+    def __repr__(self):
+        return "RenderEngine({!r})".format(self.path)
+
+    def _bytecode_cache(self):
+        if not self.cache_dir:
+            return None
+        try:
+            os.makedirs(self.cache_dir, mode=0o700, exist_ok=True)
+        except OSError as e:
+            logger.warning("Templates are compiled in every hook, no bytecode cache: %s", e)
+            return None
+        return FileSystemBytecodeCache(self.cache_dir)
+
+    @property
+    def environment(self):
+        if self._environment is None:
+            if not os.path.isdir(self.path):
+                raise TemplateError("No template set {}".format(self.path))
+            self._environment = Environment(loader=FileSystemLoader(self.path),
+                                            bytecode_cache=self._bytecode_cache())
+        return self._environment
+
+    def render(self, template, context):
+        """Render a template of the set, returns the text."""
+        start = time.monotonic()
+        exit_code = 0
+        try:
+            return self.environment.get_template(template).render(context)
+        except Exception:
+            exit_code = 1
+            raise
+        finally:
+            profiling.record(template, "render", time.monotonic() - start, exit_code=exit_code)
+
+    def render_if_changed(self, template, target, context, owner='root', group='root',
+                          perms=0o444):
+        """Render a template and write it only if the result differs from disk.
+
+        Returns True when the target file was written.
+        """
+        content = self.render(template, context).encode("utf-8")
+        return write_if_changed(target, content, owner=owner, group=group, perms=perms)
+
+    def render_files(self, files, context=None):
+        """Render the TemplateFiles from the shared context, nothing is written.
+
+        Returns a list of (file, content) for write_files().
+        """
+        contents = []
+        for file in files:
+            content = self.render(file.template, dict(context or {}, **file.context))
+            contents.append((file, content.encode("utf-8")))
+        return contents
+
+    def render_all(self, files, context=None):
+        """Render the TemplateFiles from the shared context.
+
+        Every file is rendered before the first one is written, a broken
+        template leaves all the files as they were. Returns a dict of
+        target -> written.
+        """
+        return write_files(self.render_files(files, context))
+
+
+def write_files(contents):
+    """Write the rendered (file, content) pairs, returns a dict of target -> written."""
+    return {file.target: write_if_changed(file.target, content, owner=file.owner,
+                                          group=file.group, perms=file.perms)
+            for file, content in contents}
+
+
+def engine(version, root=None):
+    """Return the shared RenderEngine of a GitLab version or stable branch."""
+    key = (version, root)
+    if key not in _engines:
+        _engines[key] = RenderEngine(template_set(version, root), root=root,
+                                     cache_dir=BYTECODE_CACHE_DIR)
+    return _engines[key]
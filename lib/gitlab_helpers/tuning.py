@@ -0,0 +1,304 @@
+# Sizing of the GitLab services from the host's CPUs and memory
+import logging
+
+logger = logging.getLogger(__name__)
+
+MB = 1024 ** 2
+GB = 1024 ** 3
+
+# memory kept for the OS, gitaly, workhorse and nginx, the rest is the budget
+# redis, sidekiq and puma are sized from, in that order
+MEMORY_RESERVE = int(1.5 * GB)
+PUMA_WORKER_MEMORY_MB = 1200
+PUMA_MIN_WORKER_MEMORY_MB = 1024
+PUMA_THREADS = 4
+PUMA_WORKER_TIMEOUT = 60
+
+
+def memory_budget(memory):
+    """Return the memory shared by redis, sidekiq and puma."""
+    return max(0, memory - MEMORY_RESERVE)
+
+
+def puma_settings(cpus, memory, workers=0, min_threads=0, max_threads=0,
+                  worker_timeout=0, worker_max_memory_mb=0):
+    """Return the puma settings, values of 0 are derived from the host.
+
+    cpus is the usable CPU count and memory the part of the memory budget
+    redis and sidekiq leave to puma, in bytes. The worker count is bounded
+    by the CPUs and by how many workers fit into it, a host without room for
+    two workers runs a single one.
+    """
+    if not worker_max_memory_mb:
+        worker_max_memory_mb = PUMA_WORKER_MEMORY_MB
+        if memory < 2 * PUMA_WORKER_MEMORY_MB * MB:
+            worker_max_memory_mb = PUMA_MIN_WORKER_MEMORY_MB
+    if not workers:
+        fit = memory // (worker_max_memory_mb * MB)
+        workers = max(1, min(cpus, fit))
+    if not max_threads:
+        max_threads = max(min_threads, PUMA_THREADS)
+    if not min_threads:
+        min_threads = max_threads
+    min_threads = min(min_threads, max_threads)
+    return {
+        "workers": int(workers),
+        "min_threads": int(min_threads),
+        "max_threads": int(max_threads),
+        "worker_timeout": int(worker_timeout or PUMA_WORKER_TIMEOUT),
+        "worker_max_memory_mb": int(worker_max_memory_mb),
+    }
+
+
+# Redis profiles for the GitLab queue, cache and session workload.
+# maxmemory_ratio is the share of the memory budget given to redis (0 means no
+# limit), io_threads is an upper bound that is also limited by the CPUs.
+REDIS_PROFILES = {
+    # the redis.conf defaults the charm shipped with
+    "default": {
+        "maxmemory_ratio": 0,
+        "maxmemory_policy": "noeviction",
+        "lazyfree": False,
+        "appendonly": False,
+        "appendfsync": "everysec",
+        "io_threads": 1,
+        "save": ["900 1", "300 10", "60 10000"],
+        "hz": 10,
+        "latency_monitor_threshold": 0,
+    },
+    # Sidekiq queues and sessions must not be evicted, AOF instead of RDB
+    # snapshots avoids the periodic fork latency spikes
+    "durable-aof": {
+        "maxmemory_ratio": 0.5,
+        "maxmemory_policy": "noeviction",
+        "lazyfree": True,
+        "appendonly": True,
+        "appendfsync": "everysec",
+        "io_threads": 2,
+        "save": [],
+        "hz": 10,
+        "latency_monitor_threshold": 100,
+    },
+    # Rails cache, anything can be evicted and nothing is persisted
+    "cache-heavy": {
+        "maxmemory_ratio": 0.25,
+        "maxmemory_policy": "allkeys-lru",
+        "lazyfree": True,
+        "appendonly": False,
+        "appendfsync": "no",
+        "io_threads": 4,
+        "save": [],
+        "hz": 50,
+        "latency_monitor_threshold": 100,
+    },
+    # no persistence, data is lost on restart but never evicted
+    "ephemeral": {
+        "maxmemory_ratio": 0.5,
+        "maxmemory_policy": "noeviction",
+        "lazyfree": True,
+        "appendonly": False,
+        "appendfsync": "no",
+        "io_threads": 2,
+        "save": [],
+        "hz": 10,
+        "latency_monitor_threshold": 100,
+    },
+}
+
+
+# the share of the budget the dedicated instances get when the main profile
+# sets no memory limit
+REDIS_SPLIT_MEMORY_RATIO = 0.5
+
+
+def _check_redis_profile(profile):
+    if profile not in REDIS_PROFILES:
+        raise ValueError("Unknown redis profile '{}', expected one of: {}".format(
+            profile, ", ".join(sorted(REDIS_PROFILES))))
+
+
+def redis_memory(profile, budget, maxmemory_mb=0, instances=None):
+    """Return the maxmemory of the main and the dedicated redis instances.
+
+    All instances together get maxmemory_mb or the profile's share of the
+    budget. instances maps the dedicated instances to their share of that,
+    the main instance keeps the rest. Without a limit of the main instance
+    (the default profile) the dedicated ones share REDIS_SPLIT_MEMORY_RATIO
+    of the budget. Returns a dict of instance -> bytes, None is the main
+    instance and 0 means no limit.
+    """
+    _check_redis_profile(profile)
+    instances = instances or {}
+    total = maxmemory_mb * MB or int(budget * REDIS_PROFILES[profile]["maxmemory_ratio"])
+    memory = {None: total}
+    if instances:
+        shared = total or int(budget * REDIS_SPLIT_MEMORY_RATIO)
+        memory.update((name, int(shared * ratio)) for name, ratio in instances.items())
+        if total:
+            memory[None] = total - sum(memory[name] for name in instances)
+    return memory
+
+
+def redis_settings(profile, cpus, maxmemory=0, io_threads_supported=False):
+    """Return the redis.conf settings of a profile for this host.
+
+    maxmemory is the limit in bytes from redis_memory(). io-threads need
+    redis 6, with io_threads_supported False they are left at 1.
+    """
+    _check_redis_profile(profile)
+    settings = dict(REDIS_PROFILES[profile])
+    del settings["maxmemory_ratio"]
+    settings["maxmemory"] = maxmemory
+    io_threads = min(settings["io_threads"], max(1, cpus // 2))
+    settings["io_threads"] = io_threads if io_threads_supported else 1
+    settings["save"] = list(settings["save"])
+    return settings
+
+
+SIDEKIQ_CONCURRENCY = 20
+SIDEKIQ_PROCESS_MEMORY = 4 * GB
+SIDEKIQ_ALL_QUEUES = "*"
+# connections each process keeps on top of its threads, like GitLab's
+# DB_POOL_HEADROOM
+DB_POOL_HEADROOM = 10
+
+
+def sidekiq_settings(cpus, memory, processes=0, concurrency=0, queue_groups=()):
+    """Return the sidekiq process count, concurrency and per-process queues.
+
+    Sidekiq is bound to one core per process, with 0 processes one process
+    per 4 CPUs is used, limited by memory (the budget redis leaves), and at
+    least one per queue group. Processes without a queue group work on all
+    queues. Each process takes SIDEKIQ_PROCESS_MEMORY of the budget.
+    """
+    queue_groups = [group for group in queue_groups if group]
+    if not processes:
+        processes = max(1, min(cpus // 4, memory // SIDEKIQ_PROCESS_MEMORY))
+    processes = max(processes, len(queue_groups))
+    groups = queue_groups + [SIDEKIQ_ALL_QUEUES] * (processes - len(queue_groups))
+    return {
+        "processes": int(processes),
+        "concurrency": int(concurrency or SIDEKIQ_CONCURRENCY),
+        "queue_groups": groups,
+    }
+
+
+def db_pool_size(puma, sidekiq, pool_size=0):
+    """Return the database pool size per process and the minimum it needs.
+
+    Every puma worker needs a connection per thread and every sidekiq
+    process one per job, pool_size of 0 adds DB_POOL_HEADROOM to that.
+    """
+    required = max(puma["max_threads"], sidekiq["concurrency"])
+    return (pool_size or required + DB_POOL_HEADROOM), required
+
+
+# connections used by rake tasks, consoles and migrations next to the app
+PGBOUNCER_CLIENT_HEADROOM = 50
+
+
+def pgbouncer_settings(client_connections, pool_size=0):
+    """Return the pgbouncer pool sizes for the given application concurrency.
+
+    client_connections is the number of connections GitLab may open (puma
+    threads, sidekiq concurrency). With transaction pooling only the
+    concurrently running transactions need a server connection, the default
+    pool is half of the clients.
+    """
+    default_pool_size = pool_size or max(10, -(-client_connections // 2))
+    reserve_pool_size = max(5, default_pool_size // 4)
+    return {
+        "max_client_conn": client_connections + PGBOUNCER_CLIENT_HEADROOM,
+        "default_pool_size": default_pool_size,
+        "min_pool_size": max(1, default_pool_size // 4),
+        "reserve_pool_size": reserve_pool_size,
+        "max_db_connections": default_pool_size + reserve_pool_size,
+    }
+
+
+NGINX_WORKER_CONNECTIONS = 4096
+NGINX_UPSTREAM_KEEPALIVE = 32
+
+
+def nginx_settings(cpus, worker_connections=0, upstream_keepalive=0):
+    """Return the nginx worker and upstream settings.
+
+    One worker per CPU. A proxied request holds two connections (client and
+    upstream), the open file limit allows for both plus the served files.
+    upstream_keepalive is the number of idle connections to workhorse each
+    worker keeps open.
+    """
+    worker_connections = worker_connections or NGINX_WORKER_CONNECTIONS
+    return {
+        "worker_processes": max(1, cpus),
+        "worker_connections": worker_connections,
+        "worker_rlimit_nofile": worker_connections * 2,
+        "upstream_keepalive": upstream_keepalive or NGINX_UPSTREAM_KEEPALIVE,
+    }
+
+
+# the proxy cache takes a share of its filesystem, at most half of the free space
+NGINX_CACHE_DISK_RATIO = 0.1
+NGINX_CACHE_FREE_RATIO = 0.5
+NGINX_CACHE_MIN_SIZE_MB = 256
+NGINX_CACHE_MAX_SIZE_MB = 20 * 1024
+# average size of a cached archive, raw file or avatar, sizes the keys zone,
+# which holds about 8000 keys per MB
+NGINX_CACHE_ENTRY_KB = 256
+NGINX_CACHE_KEYS_PER_MB = 8000
+
+
+def nginx_cache_settings(disk_total, disk_free, max_size_mb=0):
+    """Return the proxy cache size, keys zone and inactive time.
+
+    max_size_mb of 0 is derived from the disk space of the cache directory.
+    Entries of a small cache are evicted by size soon anyway, they are
+    dropped after a shorter inactive time.
+    """
+    if not max_size_mb:
+        max_size_mb = int(min(disk_total * NGINX_CACHE_DISK_RATIO,
+                              disk_free * NGINX_CACHE_FREE_RATIO)) // MB
+        max_size_mb = min(max(max_size_mb, NGINX_CACHE_MIN_SIZE_MB), NGINX_CACHE_MAX_SIZE_MB)
+    keys = max_size_mb * 1024 // NGINX_CACHE_ENTRY_KB
+    if max_size_mb >= 4096:
+        inactive = "1d"
+    elif max_size_mb >= 1024:
+        inactive = "6h"
+    else:
+        inactive = "1h"
+    return {
+        "max_size_mb": max_size_mb,
+        "keys_zone_mb": max(1, -(-keys // NGINX_CACHE_KEYS_PER_MB)),
+        "inactive": inactive,
+    }
+
+
+# gitaly's own default
+GITALY_CATFILE_CACHE_SIZE = 100
+GITALY_PACK_OBJECTS_CACHE_MAX_AGE = "5m"
+# cgroups for git processes, each repository is hashed into one of them
+GITALY_CGROUPS_COUNT = 10
+GITALY_GIT_MEMORY_RATIO = 0.5
+GITALY_GIT_CPU_SHARES = 512
+
+
+def gitaly_settings(cpus, memory, upload_pack_concurrency=0, catfile_cache_size=0,
+                    pack_objects_cache_max_age="", git_memory_limit_mb=0, git_cpu_shares=0):
+    """Return the gitaly concurrency, cache and cgroup settings.
+
+    upload_pack_concurrency limits the concurrent clones and fetches of one
+    repository (PostUploadPack and SSHUploadPack), further requests queue.
+    By default there is one per CPU, so a burst of CI clones of the same
+    repository can not occupy more than the host with git pack-objects.
+    git_memory_limit_mb is the memory limit of the git processes of one
+    cgroup, by default half of the memory.
+    """
+    max_age = pack_objects_cache_max_age or GITALY_PACK_OBJECTS_CACHE_MAX_AGE
+    return {
+        "upload_pack_concurrency": int(upload_pack_concurrency or max(2, cpus)),
+        "catfile_cache_size": int(catfile_cache_size or GITALY_CATFILE_CACHE_SIZE),
+        "pack_objects_cache_max_age": max_age,
+        "cgroups_count": GITALY_CGROUPS_COUNT,
+        "git_memory_limit": int(git_memory_limit_mb * MB or memory * GITALY_GIT_MEMORY_RATIO),
+        "git_cpu_shares": int(git_cpu_shares or GITALY_GIT_CPU_SHARES),
+    }
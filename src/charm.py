@@ -2,18 +2,26 @@
 # Copyright 2021 Márton Kiss
 # See LICENSE file for licensing details.
 
+import base64
+import binascii
+import functools
 import logging
+import os.path
+import re
 import subprocess
 import sys
+import time
 sys.path.append('lib')  # noqa: E402
 
-from charmhelpers.core.templating import render
 from charmhelpers.core.host import (
+    mkdir,
     service,
     service_running,
     service_start
 )
-from gitlab_helpers import gitlab
+from gitlab_helpers import (
+    artifacts, bundle, checkout, conninfo, gitlab, host, metrics, profiling, runner, tuning)
+from gitlab_helpers.templating import TemplateFile, write_files, write_if_changed
 
 from ops.charm import CharmBase
 from ops.main import main
@@ -21,6 +29,8 @@ from ops.model import (
     ActiveStatus,
     BlockedStatus,
     MaintenanceStatus,
+    ModelError,
+    WaitingStatus,
 )
 from ops.framework import StoredState
 import ops.lib
@@ -29,18 +39,77 @@ pgsql = ops.lib.use("pgsql", 1, "postgresql-charmers@lists.launchpad.net")
 
 logger = logging.getLogger(__name__)
 
+REDIS_CONFIG = "/etc/redis/redis.conf"
+GITLAB_CONFIG = "/home/git/gitlab/config/gitlab.yml"
+SECRETS_CONFIG = "/home/git/gitlab/config/secrets.yml"
+RESQUE_CONFIG = "/home/git/gitlab/config/resque.yml"
+PUMA_CONFIG = "/home/git/gitlab/config/puma.rb"
+DATABASE_CONFIG = "/home/git/gitlab/config/database.yml"
+NGINX_CONFIG = "/etc/nginx/sites-available/gitlab"
+NGINX_MAIN_CONFIG = "/etc/nginx/nginx.conf"
+TLS_CERTIFICATE = "/etc/nginx/ssl/gitlab.crt"
+TLS_KEY = "/etc/nginx/ssl/gitlab.key"
+
+# Services that have to pick up a change of a rendered file, and how.
+# "reload" is carried out according to the restart_strategy config option,
+# "restart" always means a full service restart.
+# "gitlab-sidekiq" stands for all sidekiq processes, they are restarted
+# gracefully. A changed systemd unit restarts its own service. The gitlab
+# services need the database, they are left alone until the bootstrap
+# starts them.
+SERVICE_DEPENDENCIES = {
+    REDIS_CONFIG: [("redis", "restart")],
+    GITLAB_CONFIG: [("gitlab-puma", "reload"), ("gitlab-sidekiq", "reload")],
+    SECRETS_CONFIG: [("gitlab-puma", "reload"), ("gitlab-sidekiq", "reload")],
+    RESQUE_CONFIG: [("gitlab-puma", "reload"), ("gitlab-sidekiq", "reload")],
+    # puma.rb is read by the master, workers cycled by a phased restart
+    # would not pick it up
+    PUMA_CONFIG: [("gitlab-puma", "restart")],
+    DATABASE_CONFIG: [("gitlab-puma", "reload"), ("gitlab-sidekiq", "reload")],
+    NGINX_CONFIG: [("nginx", "reload")],
+    NGINX_MAIN_CONFIG: [("nginx", "reload")],
+    TLS_CERTIFICATE: [("nginx", "reload")],
+    TLS_KEY: [("nginx", "reload")],
+    gitlab.GITALY_CONFIG: [("gitaly", "restart")],
+    gitlab.PGBOUNCER_CONFIG: [("pgbouncer", "reload")],
+    gitlab.PGBOUNCER_USERLIST: [("pgbouncer", "reload")],
+}
+
+for _name in gitlab.REDIS_INSTANCES:
+    _paths = gitlab.redis_instance_paths(_name)
+    SERVICE_DEPENDENCIES[_paths["config"]] = [(_paths["service"], "restart")]
+    SERVICE_DEPENDENCIES[_paths["gitlab_config"]] = [("gitlab-puma", "reload"),
+                                                     ("gitlab-sidekiq", "reload")]
+
+for _name, _service in gitlab.EXPORTER_SERVICES.items():
+    SERVICE_DEPENDENCIES[gitlab.exporter_defaults(_name)] = [(_service, "restart")]
+
+RESTART_STRATEGIES = ("restart", "reload", "phased")
+NGINX_PROXY_CACHE_MODES = ("off", "public", "session")
+
 
 class GitlabServerCharm(CharmBase):
     _stored = StoredState()
 
     def __init__(self, *args):
         super().__init__(*args)
+        self._hook_start = time.monotonic()
 
         self._stored.set_default(installed=False, bootstrapped=False,
-                                db_conn_str=None, db_uri=None, db_ro_uris=[])
+                                 db_conn_str=None, db_uri=None, db_ro_uris=[],
+                                 install_timings={})
 
         self.framework.observe(self.on.install, self.on_install)
         self.framework.observe(self.on.config_changed, self.on_config_changed)
+        self.framework.observe(self.on.show_tuning_action, self._on_show_tuning_action)
+        self.framework.observe(self.on.housekeeping_action, self._on_housekeeping_action)
+        self.framework.observe(self.on.hook_profile_action, self._on_hook_profile_action)
+        self.framework.observe(self.on.build_bundle_action, self._on_build_bundle_action)
+        self.framework.observe(self.on.check_metrics_action, self._on_check_metrics_action)
+        self.framework.observe(self.on.leader_elected, self._update_scrape_targets)
+        self.framework.observe(self.on.metrics_endpoint_relation_joined,
+                               self._on_metrics_endpoint_relation_joined)
+        self.framework.observe(self.framework.on.commit, self._on_commit)
 
         self.db = pgsql.PostgreSQLClient(self, 'db')  # 'db' relation in metadata.yaml
         self.framework.observe(self.db.on.database_relation_joined, self._on_database_relation_joined)
@@ -49,51 +118,439 @@ class GitlabServerCharm(CharmBase):
 
     
     def on_install(self, event):
-        self.model.unit.status = MaintenanceStatus('Installing gitlab server')        
-        gitlab.install_packages_and_dependencies()
-        gitlab.install_ruby()
-        gitlab.install_go()
-        gitlab.install_node()
-        gitlab.create_system_user()
-        gitlab.install_redis()
-        gitlab.install_gitlab()
-        gitlab.install_nginx()
+        self.model.unit.status = MaintenanceStatus('Installing gitlab server')
+        cache = self._artifact_cache()
+        mirror = checkout.SourceMirror(self.config["source_mirror_dir"])
+        try:
+            install_bundle = self._install_bundle()
+        except bundle.BundleError as e:
+            logger.error("Invalid install bundle: %s", e)
+            raise
+        if install_bundle:
+            logger.info("Installing offline from %s", install_bundle.root)
+            cache.add_entries(install_bundle.artifacts)
+        jobs = host.build_jobs(self.config["build_jobs"])
+        logger.info("Building with %d parallel jobs", jobs)
+        # the git and ruby builds run at the same time and share the jobs,
+        # with less than one job each they take turns
+        concurrent_builds = max(1, min(2, self.config["install_concurrency"]))
+        compile_jobs = max(1, jobs // concurrent_builds)
+        ruby_requires = ["packages"] if jobs >= concurrent_builds else ["packages", "git"]
+        packages = functools.partial(gitlab.install_packages_and_dependencies,
+                                     deb_cache=self.config["apt_deb_cache"] or None,
+                                     install_bundle=install_bundle)
+        install_gitlab = functools.partial(gitlab.install_gitlab, jobs, install_bundle, mirror,
+                                           cache, self._resource_path("gitlab-build"))
+        tasks = [
+            gitlab.InstallTask("node-repository",
+                               functools.partial(gitlab.install_node_repository, cache,
+                                                 install_bundle)),
+            gitlab.InstallTask("packages", packages, requires=["node-repository"]),
+            gitlab.InstallTask("git", functools.partial(gitlab.install_git, cache, compile_jobs,
+                                                        mirror, install_bundle),
+                               requires=["packages"]),
+            gitlab.InstallTask("ruby", functools.partial(gitlab.install_ruby, cache, compile_jobs),
+                               requires=ruby_requires),
+            gitlab.InstallTask("go", functools.partial(gitlab.install_go, cache),
+                               requires=["packages"]),
+            gitlab.InstallTask("node", functools.partial(gitlab.install_node, install_bundle),
+                               requires=["packages"]),
+            gitlab.InstallTask("user", gitlab.create_system_user),
+            gitlab.InstallTask("redis", gitlab.install_redis,
+                               requires=["packages", "user"]),
+            gitlab.InstallTask("gitlab", install_gitlab,
+                               requires=["git", "ruby", "go", "node", "redis"]),
+            gitlab.InstallTask("nginx", gitlab.install_nginx, requires=["packages"]),
+        ]
+        try:
+            with runner.progress(self._maintenance_progress('Installing gitlab server')):
+                timings = gitlab.run_install_tasks(
+                    tasks, max_workers=self.config["install_concurrency"])
+        except gitlab.InstallError as e:
+            logger.error("Install failed at step '%s', skipped steps: %s, timings: %s",
+                         e.task, e.skipped, e.timings)
+            raise
+        self._stored.install_timings = timings
         self._stored.installed = True
         self.model.unit.status = BlockedStatus('Waiting for database relation')
-        logger.info("Install hook finished.")
-
-    def _on_config_changed(self, _):
-        # current = self.config["thing"]
-        # if current not in self._stored.things:
-        #     logger.debug("found a new thing: %r", current)
-        #     self._stored.things.append(current)
-        return
-
-    def _on_fortune_action(self, event):
-        fail = event.params["fail"]
-        if fail:
-            event.fail(fail)
+        logger.info("Install hook finished, step timings: %s", timings)
+
+    def _maintenance_progress(self, status):
+        """Progress handler of the runner, shows the current output line."""
+        def handler(message):
+            self.model.unit.status = MaintenanceStatus("{}, {}".format(status, message))
+        return handler
+
+    def _resource_path(self, name):
+        """Return the path of an attached file resource, None if there is none.
+
+        An empty file counts as not attached.
+        """
+        try:
+            path = self.model.resources.fetch(name)
+            if os.path.getsize(path) > 0:
+                return str(path)
+        except (ModelError, NameError, OSError):
+            pass
+        return None
+
+    def _install_bundle(self):
+        """Return the InstallBundle to install from, None to download.
+
+        The install-bundle resource takes precedence over the install_bundle
+        config option.
+        """
+        source = self._resource_path("install-bundle") or self.config["install_bundle"]
+        return bundle.unpack(source) if source else None
+
+    def _artifact_cache(self):
+        return artifacts.ArtifactCache(
+            path=self.config["artifact_cache_dir"],
+            max_size=self.config["artifact_cache_size"] * 1024 * 1024,
+            mirror=self.config["artifact_mirror"])
+
+    def _check_config(self):
+        """Return a message describing an invalid configuration, or None."""
+        if self.config["restart_strategy"] not in RESTART_STRATEGIES:
+            return "restart_strategy must be one of: {}".format(", ".join(RESTART_STRATEGIES))
+        if self.config["redis_profile"] not in tuning.REDIS_PROFILES:
+            return "redis_profile must be one of: {}".format(
+                ", ".join(sorted(tuning.REDIS_PROFILES)))
+        if self.config["redis_profile"] == "cache-heavy" and not self.config["redis_split"]:
+            # the main instance holds the Sidekiq queues without redis_split
+            return "redis_profile cache-heavy evicts the Sidekiq queues, enable redis_split"
+        if self.config["nginx_proxy_cache"] not in NGINX_PROXY_CACHE_MODES:
+            return "nginx_proxy_cache must be one of: {}".format(
+                ", ".join(NGINX_PROXY_CACHE_MODES))
+        if not re.match(r"^\d+(ms|s|m|h|d)?$", self.config["nginx_proxy_cache_valid"]):
+            return "nginx_proxy_cache_valid must be an nginx time, like 5m"
+        for option in ("metrics_scrape_interval", "metrics_scrape_timeout"):
+            if metrics.duration_seconds(self.config[option]) is None:
+                return "{} must be a Prometheus duration, like 30s".format(option)
+        interval = metrics.duration_seconds(self.config["metrics_scrape_interval"])
+        if metrics.duration_seconds(self.config["metrics_scrape_timeout"]) > interval:
+            return "metrics_scrape_timeout must not exceed metrics_scrape_interval"
+        ports = [self.config[option] for option in metrics.EXPORTERS.values()]
+        if len(set(ports + [gitlab.NGINX_STATUS_PORT])) != len(ports) + 1:
+            return "the exporter ports must differ from each other and from {}".format(
+                gitlab.NGINX_STATUS_PORT)
+        if bool(self.config["tls_certificate"]) != bool(self.config["tls_key"]):
+            return "tls_certificate and tls_key must be set together"
+        for option in ("tls_certificate", "tls_key"):
+            try:
+                base64.b64decode(self.config[option], validate=True)
+            except binascii.Error:
+                return "{} must be base64 encoded".format(option)
+        pool, required = self._db_pool_size()
+        if pool < required:
+            return "db_pool_size {} is below the puma threads/sidekiq concurrency {}".format(
+                pool, required)
+        return self._check_database_replicas()
+
+    def _puma_settings(self):
+        # puma gets what redis and sidekiq leave of the memory budget
+        sidekiq_memory = self._sidekiq_settings()["processes"] * tuning.SIDEKIQ_PROCESS_MEMORY
+        memory = max(0, self._app_memory() - sidekiq_memory)
+        return tuning.puma_settings(
+            host.cpu_count(), memory,
+            workers=self.config["puma_workers"],
+            min_threads=self.config["puma_min_threads"],
+            max_threads=self.config["puma_max_threads"],
+            worker_timeout=self.config["puma_worker_timeout"],
+            worker_max_memory_mb=self.config["puma_worker_max_memory"])
+
+    def _gitaly_settings(self):
+        return tuning.gitaly_settings(
+            host.cpu_count(), host.memory_total(),
+            upload_pack_concurrency=self.config["gitaly_upload_pack_concurrency"],
+            catfile_cache_size=self.config["gitaly_catfile_cache_size"],
+            pack_objects_cache_max_age=self.config["gitaly_pack_objects_cache_max_age"],
+            git_memory_limit_mb=self.config["gitaly_git_memory_limit"],
+            git_cpu_shares=self.config["gitaly_git_cpu_shares"])
+
+    def _nginx_settings(self):
+        return tuning.nginx_settings(
+            host.cpu_count(),
+            worker_connections=self.config["nginx_worker_connections"],
+            upstream_keepalive=self.config["nginx_upstream_keepalive"])
+
+    def _nginx_cache_settings(self):
+        """Return the proxy cache settings, None when the cache is off.
+
+        The cache directory may not exist yet, its filesystem is measured.
+        """
+        if self.config["nginx_proxy_cache"] == "off":
+            return None
+        disk_total, disk_free = host.disk_space(gitlab.NGINX_CACHE_DIR)
+        return tuning.nginx_cache_settings(disk_total, disk_free,
+                                           max_size_mb=self.config["nginx_proxy_cache_size"])
+
+    def _sidekiq_settings(self):
+        groups = [group.strip() for group in self.config["sidekiq_queue_groups"].split(";")]
+        return tuning.sidekiq_settings(
+            host.cpu_count(), self._app_memory(),
+            processes=self.config["sidekiq_processes"],
+            concurrency=self.config["sidekiq_concurrency"],
+            queue_groups=groups)
+
+    def _sidekiq_services(self):
+        return [gitlab.sidekiq_service(index)
+                for index in range(1, self._sidekiq_settings()["processes"] + 1)]
+
+    def _db_pool_size(self):
+        return tuning.db_pool_size(self._puma_settings(), self._sidekiq_settings(),
+                                   pool_size=self.config["db_pool_size"])
+
+    def _redis_settings(self, instance=None):
+        """Return the redis.conf settings of the main or a dedicated instance."""
+        profile = self.config["redis_profile"]
+        if instance is not None:
+            profile = gitlab.REDIS_INSTANCES[instance]["profile"]
+        return tuning.redis_settings(
+            profile, host.cpu_count(), maxmemory=self._redis_memory().get(instance, 0),
+            io_threads_supported=gitlab.redis_version() >= (6,))
+
+    def _redis_memory(self):
+        """Return the maxmemory of the main (None) and the dedicated instances."""
+        instances = {name: gitlab.REDIS_INSTANCES[name]["memory_ratio"]
+                     for name in self._redis_instances()}
+        return tuning.redis_memory(
+            self.config["redis_profile"], tuning.memory_budget(host.memory_total()),
+            maxmemory_mb=self.config["redis_maxmemory"], instances=instances)
+
+    def _app_memory(self):
+        """Return the part of the memory budget redis leaves to sidekiq and puma."""
+        budget = tuning.memory_budget(host.memory_total())
+        return max(0, budget - sum(self._redis_memory().values()))
+
+    def _redis_instances(self):
+        return sorted(gitlab.REDIS_INSTANCES) if self.config["redis_split"] else []
+
+    def _redis_services(self):
+        return ["redis"] + [gitlab.redis_instance_paths(name)["service"]
+                            for name in self._redis_instances()]
+
+    def _redis_sockets(self):
+        return [gitlab.REDIS_SOCKET] + [gitlab.redis_instance_paths(name)["socket"]
+                                        for name in self._redis_instances()]
+
+    def _on_show_tuning_action(self, event):
+        """Return the service settings chosen for this unit."""
+        def dashed(settings):
+            return {key.replace("_", "-"): ", ".join(value) if isinstance(value, list)
+                    else str(value) for key, value in settings.items()}
+
+        memory = host.memory_total()
+        results = {
+            "host": dashed({"cpus": host.cpu_count(),
+                            "memory_mb": memory // tuning.MB,
+                            "memory_budget_mb": tuning.memory_budget(memory) // tuning.MB}),
+            "puma": dashed(self._puma_settings()),
+            "redis": dashed(self._redis_settings()),
+            "nginx": dashed(self._nginx_settings()),
+            "gitaly": dashed(self._gitaly_settings()),
+        }
+        results["sidekiq"] = dashed(self._sidekiq_settings())
+        results["database"] = dashed({"pool": self._db_pool_size()[0],
+                                      "clients": self._database_clients()})
+        if self.config["pgbouncer"]:
+            results["pgbouncer"] = dashed(self._pgbouncer_settings())
+        cache = self._nginx_cache_settings()
+        if cache:
+            results["nginx-cache"] = dashed(cache)
+        for name in self._redis_instances():
+            results["redis-" + name.replace("_", "-")] = dashed(self._redis_settings(name))
+        event.set_results(results)
+
+    def _housekeeping_workers(self, workers=0):
+        return workers or self.config["housekeeping_workers"] or max(1, host.cpu_count() // 4)
+
+    def _on_housekeeping_action(self, event):
+        if not self._stored.installed:
+            event.fail("GitLab is not installed yet")
+            return
+        report = gitlab.run_housekeeping(
+            workers=self._housekeeping_workers(event.params["workers"]),
+            limit=event.params["limit"], dry_run=event.params["dry-run"])
+        lines = []
+        for result in report["results"]:
+            line = "{}: {}".format(result["repository"], " ".join(result["steps"]))
+            if not event.params["dry-run"]:
+                line += ", {} bytes reclaimed in {}s".format(
+                    result["bytes_reclaimed"], result["seconds"])
+            if result.get("error"):
+                line += " (failed: {})".format(result["error"].strip())
+            lines.append(line)
+        event.set_results({
+            "scanned": report["scanned"],
+            "optimized": report["optimized"],
+            "failed": report["failed"],
+            "bytes-reclaimed": report["bytes_reclaimed"],
+            "seconds": report["seconds"],
+            "repositories": "\n".join(lines),
+        })
+
+    def _on_commit(self, _):
+        """Store the profile of the hook, run by the framework at its end."""
+        # JUJU_DISPATCH_PATH is hooks/<hook> or actions/<action>
+        hook = os.path.basename(os.environ.get("JUJU_DISPATCH_PATH", ""))
+        if not hook or hook == "hook-profile":
+            profiling.reset()
+            return
+        profile = profiling.save(hook, time.monotonic() - self._hook_start)
+        logger.debug("Hook %s took %.1fs, %d steps recorded", hook, profile["seconds"],
+                     len(profile["records"]))
+
+    def _on_hook_profile_action(self, event):
+        hooks = profiling.load()[-event.params["hooks"]:] if event.params["hooks"] > 0 else []
+        if not hooks:
+            event.fail("No hook profiles recorded yet")
+            return
+        slowest = []
+        for entry in profiling.slowest(hooks, top=event.params["top"]):
+            line = "{:.3f}s {} {} {}".format(entry["seconds"], entry["hook"], entry["kind"],
+                                             entry["name"])
+            if entry["exit_code"]:
+                line += " (exit code {})".format(entry["exit_code"])
+            if entry["output_bytes"] is not None:
+                line += " [{} bytes]".format(entry["output_bytes"])
+            slowest.append(line)
+        event.set_results({
+            "hooks": "\n".join("{} {}s".format(profile["hook"], profile["seconds"])
+                               for profile in hooks),
+            "slowest": "\n".join(slowest),
+        })
+
+    def _on_build_bundle_action(self, event):
+        if not self._stored.installed:
+            event.fail("GitLab is not installed yet")
+            return
+        path = event.params["path"] or gitlab.BUNDLE_ARCHIVE
+        try:
+            with runner.progress(event.log):
+                manifest = gitlab.build_install_bundle(path, self._artifact_cache())
+        except (bundle.BundleError, subprocess.CalledProcessError) as e:
+            event.fail("Unable to build the install bundle: {}".format(e))
+            return
+        event.set_results({
+            "path": path,
+            "size": os.path.getsize(path),
+            "sha256": artifacts.sha256sum(path),
+            "files": len(manifest["files"]),
+            "versions": ", ".join("{} {}".format(name, version)
+                                  for name, version in sorted(manifest["versions"].items())),
+        })
+
+    def _on_check_metrics_action(self, event):
+        ports = self._metrics_ports()
+        if not ports:
+            event.fail("Metrics are disabled, see the metrics config option")
+            return
+        results = metrics.check_exporters(ports, host=self._metrics_address(),
+                                          timeout=event.params["timeout"])
+        event.set_results({
+            exporter: result["error"] if "error" in result else
+            "{metrics} metrics, {samples} samples from {url}".format(**result)
+            for exporter, result in results.items()
+        })
+        failed = [exporter for exporter, result in results.items() if "error" in result]
+        if failed:
+            event.fail("Unable to scrape {}".format(", ".join(failed)))
+
+    def _metrics_ports(self):
+        """Return the ports of the enabled exporters, none without metrics."""
+        if not self.config["metrics"]:
+            return {}
+        ports = {exporter: self.config[option]
+                 for exporter, option in metrics.EXPORTERS.items()}
+        if not self._stored.db_conn_str:
+            # postgres_exporter connects to the primary of the db relation
+            del ports["postgres"]
+        return ports
+
+    def _metrics_address(self):
+        """Return the address the exporters listen on.
+
+        The ingress address of the metrics-endpoint relation, or of the
+        endpoint binding before Prometheus is related, the loopback address
+        when the unit has neither.
+        """
+        relations = self.model.relations["metrics-endpoint"]
+        address = self._ingress_address(relations[0] if relations else "metrics-endpoint")
+        return address or metrics.LOCAL_ADDRESS
+
+    def _metrics_listen_address(self, exporter):
+        """Return the address an exporter listens on, None when it is disabled."""
+        port = self._metrics_ports().get(exporter)
+        return None if port is None else metrics.listen_address(self._metrics_address(), port)
+
+    def _ingress_address(self, relation):
+        """Return the ingress address of a relation or an endpoint, None if unknown."""
+        name = relation if isinstance(relation, str) else relation.name
+        try:
+            address = self.model.get_binding(relation).network.ingress_address
+        except ModelError as e:
+            logger.warning("No address on the %s relation: %s", name, e)
+            return None
+        return str(address) if address else None
+
+    def _on_metrics_endpoint_relation_joined(self, event):
+        """Publish the scrape targets, move the exporters to the relation address."""
+        if self._stored.installed and self._metrics_ports():
+            self.on_config_changed(event)
         else:
-            event.set_results({"fortune": "A bug in the code is worth two in the documentation."})
+            self._update_scrape_targets()
+
+    def _update_scrape_targets(self, _=None):
+        """Publish the exporters of the unit on the metrics-endpoint relations."""
+        relations = self.model.relations["metrics-endpoint"]
+        if not relations or self._check_config():
+            return
+        jobs = metrics.scrape_jobs(self._metrics_ports(),
+                                   self.config["metrics_scrape_interval"],
+                                   self.config["metrics_scrape_timeout"])
+        metadata = metrics.scrape_metadata(self.model.name, self.model.uuid, self.app.name,
+                                           self.meta.name)
+        for relation in relations:
+            address = self._ingress_address(relation)
+            if address:
+                relation.data[self.unit]["prometheus_scrape_unit_address"] = address
+            relation.data[self.unit]["prometheus_scrape_unit_name"] = self.unit.name
+            if self.unit.is_leader():
+                relation.data[self.app].update(metrics.relation_data(jobs, metadata))
 
     def on_config_changed(self, event):
         logger.info("Configuration changed")
+        # the scrape jobs only depend on the configuration
+        self._update_scrape_targets()
         if not self._stored.installed:
             logger.debug("Skipping configuration hook as the site is not installed yet.")
             return
-        self._render_redis_configuration()
-        self._render_gitlab_configuration()
-        self._render_secrets_configuration()
-        self._render_gitlab_redis_configuration()
-        self._render_puma_configuration()
-        self._render_database_configuration()
-        self._render_nginx_configuration()
+        error = self._check_config()
+        if error:
+            logger.error("Invalid configuration: %s", error)
+            self.model.unit.status = BlockedStatus(error)
+            return
+        changed = self._render_configuration()
+        changed.update(self._write_tls_certificate())
+        changed.update(self._remove_redis_instances())
+        self._update_exporters(changed)
+        changed.update(gitlab.configure_sidekiq_units(self._sidekiq_settings()))
+        changed.update(gitlab.configure_gitlab_units())
+        changed.update(gitlab.configure_gitaly(
+            self._gitaly_settings(),
+            pack_objects_cache=self.config["gitaly_pack_objects_cache"],
+            cgroups=self.config["gitaly_cgroups"],
+            prometheus_listen_addr=self._metrics_listen_address("gitaly")))
+        gitlab.configure_housekeeping(self.config["housekeeping_schedule"],
+                                      workers=self._housekeeping_workers())
 
         # restart services to pick up configuration changes
-
-        logger.info("Restart services")
-        logger.debug("Restart redis service")
-        service("restart", "redis")
+        restarted = self._restart_services(
+            path for path, written in changed.items() if written)
+        if not self.config["pgbouncer"] and service_running("pgbouncer"):
+            logger.info("Stop pgbouncer service, gitlab connects to the database directly")
+            service("stop", "pgbouncer")
 
         if not self._stored.db_conn_str and not self._stored.bootstrapped:
             self.model.unit.status = BlockedStatus('Waiting for database relation')
@@ -101,90 +558,458 @@ class GitlabServerCharm(CharmBase):
         if self._stored.db_conn_str and not self._stored.bootstrapped:
             self.model.unit.status = MaintenanceStatus('Bootstrapping gitlab server')
             logger.debug("Bootstrap Gitlab Database")
-            logger.debug("ensure gitaly service is running")
+            logger.debug("ensure redis and gitaly services are running")
+            for name in self._redis_services():
+                if not service_running(name):
+                    service_start(name)
             if not service_running("gitaly"):
                 started = service_start("gitaly")
             logger.debug("pgsql db conn = {}".format(self._stored.db_conn_str))
             try:
-                gitlab.bootstrap_gitlab()
+                with runner.progress(self._maintenance_progress('Bootstrapping gitlab server')):
+                    gitlab.bootstrap_gitlab(self._redis_sockets(),
+                                            database_url=self._direct_database_url())
             except subprocess.CalledProcessError as e:
                 logger.error("Failed to execute rake gitlab:setup")
                 raise RuntimeError('Failed to bootstrap gitlab')
             self._stored.bootstrapped = True
+            self._build_assets()
+            for name in self._sidekiq_services() + list(gitlab.GITLAB_UNITS):
+                service_start(name)
             self.model.unit.status = ActiveStatus('Ready')
+        elif self._stored.bootstrapped:
+            # a no-op unless the revision or the lock files changed, or an
+            # earlier build failed
+            self._build_assets()
+            self._wait_for_services(restarted)
+
+    def _build_assets(self):
+        status = 'Compiling gitlab assets'
+        with runner.progress(self._maintenance_progress(status)):
+            gitlab.build_gitlab_assets(self._artifact_cache(),
+                                       host.build_jobs(self.config["build_jobs"]))
+
+    @profiling.profiled()
+    def _restart_services(self, changed_paths):
+        """Restart or reload only the services depending on the changed files.
+
+        Returns the names of the services that were restarted or reloaded.
+        """
+        actions = {}
+        for path in changed_paths:
+            dependencies = SERVICE_DEPENDENCIES.get(path, [])
+            if path.startswith("/etc/systemd/system/") and path.endswith(".service"):
+                dependencies = [(os.path.basename(path)[:-len(".service")], "restart")]
+            for name, action in dependencies:
+                # a restart wins over a reload
+                if actions.get(name) != "restart":
+                    actions[name] = action
+        if not actions:
+            logger.info("Configuration unchanged, no service restart needed")
+            return set()
+
+        strategy = self.config["restart_strategy"]
+        redis_aof = tuning.REDIS_PROFILES[self.config["redis_profile"]]["appendonly"]
+        for name, action in sorted(actions.items()):
+            if action == "reload" and strategy == "restart":
+                action = "restart"
+            if self._gitlab_service(name) and not self._stored.bootstrapped:
+                continue
+            if name == "gitlab-puma":
+                self._restart_puma(action, strategy)
+                continue
+            if name == "gitlab-sidekiq":
+                self._restart_sidekiq()
+                continue
+            if action == "reload" and not service_running(name):
+                action = "restart"
+            if name == "nginx" and not gitlab.nginx_config_ok():
+                raise RuntimeError('Invalid nginx configuration')
+            if name == "redis" and redis_aof:
+                # restarted without its AOF redis would drop the RDB data
+                if not gitlab.redis_enable_aof(gitlab.REDIS_SOCKET):
+                    raise RuntimeError('Redis did not finish writing its AOF')
+            elif name == "redis":
+                # and restarted without AOF it only loads its RDB snapshot
+                if not gitlab.redis_save_rdb(gitlab.REDIS_SOCKET):
+                    raise RuntimeError('Redis did not finish writing its RDB snapshot')
+            logger.info("%s %s service", action.capitalize(), name)
+            if not service(action, name):
+                logger.warning("Failed to %s %s service", action, name)
+        restarted = set(actions)
+        if "gitlab-sidekiq" in restarted:
+            restarted.discard("gitlab-sidekiq")
+            restarted.update(self._sidekiq_services())
+        return restarted
+
+    def _gitlab_service(self, name):
+        """Whether name is a service that needs the bootstrapped database."""
+        return name in gitlab.GITLAB_UNITS or name.startswith("gitlab-sidekiq")
+
+    def _restart_sidekiq(self):
+        """Restart all sidekiq processes, running jobs are finished first."""
+        for name in self._sidekiq_services():
+            logger.info("Restart %s service", name)
+            if not service("restart", name):
+                logger.warning("Failed to restart %s service", name)
+
+    def _restart_puma(self, action, strategy):
+        if action == "reload":
+            if strategy == "phased" and gitlab.puma_phased_restart():
+                logger.info("Phased restart of gitlab-puma service")
+                return
+            if strategy == "reload" and gitlab.puma_hot_restart():
+                logger.info("Hot restart of gitlab-puma service")
+                return
+        logger.info("Restart gitlab-puma service")
+        if not service("restart", "gitlab-puma"):
+            logger.warning("Failed to restart gitlab-puma service")
+
+    @profiling.profiled()
+    def _wait_for_services(self, names):
+        """Wait for restarted services to serve requests, then report Ready.
+
+        Services without an enabled unit are not started by the charm, they
+        are not waited for.
+        """
+        checks = {
+            "gitlab-puma": gitlab.puma_ready,
+        }
+        for name in sorted(names):
+            if not gitlab.service_enabled(name):
+                logger.debug("%s is not enabled, not waiting for it", name)
+                continue
+            check = checks.get(name, functools.partial(service_running, name))
+            self.model.unit.status = MaintenanceStatus(
+                'Waiting for {} to become ready'.format(name))
+            if not gitlab.wait_until(check, timeout=self.config["readiness_timeout"]):
+                logger.error("%s did not become ready", name)
+                self.model.unit.status = WaitingStatus('{} is not ready'.format(name))
+                return
+        self.model.unit.status = ActiveStatus('Ready')
+
+    def _template_context(self):
+        """The context shared by all configuration templates."""
+        context = dict(self.config)
+        context.update({
+            "fqdn": self.config["fqdn"] or "localhost",
+            "https": bool(self.config["tls_certificate"]),
+            "tls": bool(self.config["tls_certificate"]),
+            "metrics_address": self._metrics_address() if self.config["metrics"] else None,
+        })
+        return context
+
+    def _render_configuration(self):
+        """Render all configuration files in one pass.
+
+        The host is only changed once every template rendered: the packages
+        owning the directories and users of the files are installed before
+        they are written, the units and the proxy cache are set up after.
+        Returns a dict of path -> written for the service restarts.
+        """
+        logger.debug("Render configuration")
+        files = [
+            self._redis_configuration(),
+            self._gitlab_configuration(),
+            self._secrets_configuration(),
+            self._gitlab_redis_configuration(),
+            self._puma_configuration(),
+            self._database_configuration(),
+            self._nginx_configuration(),
+            self._nginx_main_configuration(),
+        ]
+        files += self._redis_instances_configuration()
+        files += self._pgbouncer_configuration()
+        files += self._exporters_configuration()
+        contents = gitlab.templates().render_files(files, self._template_context())
+        self._install_optional_packages()
+        changed = write_files(contents)
+        for name in sorted(self._redis_instances()):
+            gitlab.configure_redis_instance(name)
+        gitlab.configure_nginx_cache(self.config["nginx_proxy_cache"] != "off")
+        return changed
+
+    def _install_optional_packages(self):
+        """Install pgbouncer and the exporters when enabled.
+
+        They come from the install bundle like the packages of the install
+        hook, the bundle is only opened when a package is missing.
+        """
+        groups = []
+        if self._pgbouncer_enabled():
+            groups.append("pgbouncer")
+        if self._exporters():
+            groups.append("metrics")
+        if not groups:
+            return
+        install_bundle = None
+        if gitlab.missing_packages(gitlab.package_manifest(groups)):
+            install_bundle = self._install_bundle()
+        if "pgbouncer" in groups:
+            gitlab.install_pgbouncer(install_bundle)
+        if "metrics" in groups:
+            gitlab.install_exporters(install_bundle)
+
+    def _gitlab_configuration(self):
+        return TemplateFile('gitlab.yml.j2', GITLAB_CONFIG, perms=0o755)
+
+    def _redis_configuration(self):
+        settings = self._redis_settings()
+        logger.info("Redis settings (%s profile): %s", self.config["redis_profile"], settings)
+        context = {"redis_" + key: value for key, value in settings.items()}
+        context.update({
+            "redis_unixsocket": gitlab.REDIS_SOCKET,
+            "redis_pidfile": "/var/run/redis/redis-server.pid",
+            "redis_logfile": "/var/log/redis/redis-server.log",
+            "redis_dir": "/var/lib/redis",
+        })
+        return TemplateFile('redis.conf.j2', REDIS_CONFIG, context, perms=0o640,
+                            owner='redis', group='redis')
+
+    def _redis_instances_configuration(self):
+        """Return the configuration files of the dedicated redis instances."""
+        files = []
+        for name in sorted(self._redis_instances()):
+            paths = gitlab.redis_instance_paths(name)
+            settings = self._redis_settings(name)
+            context = {"redis_" + key: value for key, value in settings.items()}
+            context.update({
+                "redis_unixsocket": paths["socket"],
+                "redis_pidfile": paths["pidfile"],
+                "redis_logfile": paths["logfile"],
+                "redis_dir": paths["dir"],
+            })
+            files.append(TemplateFile('redis.conf.j2', paths["config"], context, perms=0o640,
+                                      owner='redis', group='redis'))
+            files.append(TemplateFile('redis.instance.yml.j2', paths["gitlab_config"],
+                                      {"name": name, "socket": paths["socket"]}, perms=0o644,
+                                      owner='git', group='git'))
+        return files
+
+    def _remove_redis_instances(self):
+        """Remove the disabled redis instances.
+
+        Returns a dict of path -> written for the service restarts.
+        """
+        changed = {}
+        for name in sorted(set(gitlab.REDIS_INSTANCES) - set(self._redis_instances())):
+            if gitlab.remove_redis_instance(name):
+                changed[gitlab.redis_instance_paths(name)["gitlab_config"]] = True
+        return changed
+
+    def _secrets_configuration(self):
+        return TemplateFile('secrets.yml.j2', SECRETS_CONFIG, perms=0o755,
+                            owner='git', group='git')
+
+    def _gitlab_redis_configuration(self):
+        return TemplateFile('resque.yml.j2', RESQUE_CONFIG, perms=0o755,
+                            owner='git', group='git')
+
+    def _puma_configuration(self):
+        context = {
+            # preloading the app rules out phased restarts
+            "preload_app": self.config["restart_strategy"] != "phased",
+        }
+        settings = self._puma_settings()
+        logger.info("Puma settings: %s", settings)
+        context.update({"puma_" + key: value for key, value in settings.items()})
+        return TemplateFile('puma.rb.j2', PUMA_CONFIG, context, perms=0o755,
+                            owner='git', group='git')
+
+    def _database_connection(self):
+        """Return the primary database settings, None without a db relation."""
+        if not self._stored.db_conn_str:
+            return None
+        info = conninfo.parse(self._stored.db_conn_str)
+        return {
+            "database": info.dbname,
+            "username": info.user,
+            "password": info.password,
+            "db_host": info.host,
+            "db_port": info.port,
+            "db_params": {field: getattr(info, field) for field in conninfo.FIELDS},
+            "db_dsn": conninfo.ConnInfo(host=info.host, port=info.port,
+                                        dbname=info.dbname).dsn(),
+        }
+
+    def _direct_database_url(self):
+        """Return the primary for the rake tasks when GitLab uses pgbouncer.
+
+        Only the application processes go through the transaction pooling
+        bouncer, the database setup connects to the primary directly.
+        """
+        if not self.config["pgbouncer"]:
+            return None
+        return self._stored.db_uri
+
+    def _database_clients(self):
+        """Number of database connections the GitLab processes may open."""
+        puma = self._puma_settings()
+        sidekiq = self._sidekiq_settings()
+        puma_clients = puma["workers"] * puma["max_threads"]
+        return puma_clients + sidekiq["processes"] * sidekiq["concurrency"]
+
+    def _pgbouncer_settings(self):
+        return tuning.pgbouncer_settings(self._database_clients(),
+                                         pool_size=self.config["pgbouncer_pool_size"])
+
+    def _pgbouncer_enabled(self):
+        return bool(self.config["pgbouncer"] and self._database_connection())
+
+    def _pgbouncer_configuration(self):
+        """Return pgbouncer.ini and its userlist, none when pgbouncer is disabled."""
+        if not self._pgbouncer_enabled():
+            return []
+        connection = self._database_connection()
+        settings = self._pgbouncer_settings()
+        logger.info("PgBouncer settings: %s", settings)
+        context = dict(connection, **settings)
+        context.update({
+            "listen_port": gitlab.PGBOUNCER_PORT,
+            "socket_dir": gitlab.PGBOUNCER_SOCKET_DIR,
+            "auth_file": gitlab.PGBOUNCER_USERLIST,
+        })
+        return [
+            TemplateFile('pgbouncer.ini.j2', gitlab.PGBOUNCER_CONFIG, context,
+                         perms=0o640, owner='postgres', group='postgres'),
+            TemplateFile('pgbouncer-userlist.txt.j2', gitlab.PGBOUNCER_USERLIST, context,
+                         perms=0o640, owner='postgres', group='postgres'),
+        ]
+
+    def _database_configuration(self):
+        context = dict.fromkeys(("database", "username", "password", "db_host", "db_port"))
+        context.update({"db_prepared_statements": True, "db_pool": self._db_pool_size()[0],
+                        "db_params": dict.fromkeys(conninfo.FIELDS)})
+        connection = self._database_connection()
+        if connection:
+            context.update(connection)
+            if self.config["pgbouncer"]:
+                # connect through the local bouncer, prepared statements do
+                # not survive transaction pooling. TLS, timeouts and
+                # keepalives apply to the server side, see pgbouncer.ini
+                context["db_host"] = gitlab.PGBOUNCER_SOCKET_DIR
+                context["db_port"] = gitlab.PGBOUNCER_PORT
+                context["db_params"] = dict.fromkeys(conninfo.FIELDS)
+                context["db_prepared_statements"] = False
+        context.update(self._database_load_balancing())
+        return TemplateFile('database.yml.j2', DATABASE_CONFIG, context, perms=0o755,
+                            owner='git', group='git')
+
+    def _database_replicas(self):
+        """Return the (host, port) of the hot standbys used for load balancing."""
+        replicas = []
+        if self.config["db_load_balancing"]:
+            for uri in self._stored.db_ro_uris:
+                info = conninfo.parse(uri)
+                if info.host and (info.host, info.port) not in replicas:
+                    replicas.append((info.host, info.port))
+        return replicas
+
+    def _check_database_replicas(self):
+        """Return a message if a replica does not listen on the primary's port.
 
+        GitLab's load balancing hosts are hostnames only, the replicas are
+        connected to on the port of the primary in database.yml. With
+        pgbouncer that is the bouncer's port, no standby listens on it.
+        """
+        connection = self._database_connection()
+        if not connection:
+            return None
+        if self.config["pgbouncer"] and self._database_replicas():
+            return ("pgbouncer and db_load_balancing are mutually exclusive, disable "
+                    "one of them")
+        port = connection["db_port"]
+        others = ["{}:{}".format(host, replica_port)
+                  for host, replica_port in self._database_replicas() if replica_port != port]
+        if others:
+            return ("db replicas must use port {} like the primary ({}), or disable "
+                    "db_load_balancing".format(port, ", ".join(others)))
+        return None
 
-    def _render_gitlab_configuration(self):
-        logger.debug("Render gitlab configuration")
-        config_path = "/home/git/gitlab/config/gitlab.yml"
-        config_template = '14-3-stable/gitlab.yml.j2'
-        context = { 
-            "fqdn": "localhost",
-            "email_from": "example@example.com",
-            "email_display_name": "GitLab",
-            "email_reply_to": "noreply@example.com",
-            "email_subject_suffix": ""
+    def _database_load_balancing(self):
+        """Return the load balancing context of the hot standby replicas."""
+        return {
+            "db_replicas": [host for host, _ in self._database_replicas()],
+            "db_replica_max_lag": self.config["db_replica_max_lag"],
+            "db_replica_max_difference": self.config["db_replica_max_difference"] * 1024 * 1024,
+            "db_replica_check_interval": self.config["db_replica_check_interval"],
         }
-        render(config_template, config_path, context, perms=0o755)
-
-    def _render_redis_configuration(self):
-        logger.debug("Render redis configuration")
-        config_path = "/etc/redis/redis.conf"
-        config_template = '14-3-stable/redis.conf.j2'
-        context = {  }
-        render(config_template, config_path, context, perms=0o640,
-              owner='redis', group='redis')
-
-    def _render_secrets_configuration(self):
-        logger.debug("Render secrets configuration")
-        config_path = "/home/git/gitlab/config/secrets.yml"
-        config_template = '14-3-stable/secrets.yml.j2'
-        context = { }
-        render(config_template, config_path, context, perms=0o755,
-              owner='git', group='git')
-
-    def _render_gitlab_redis_configuration(self):
-        logger.debug("Render gitlab redis configuration")
-        config_path = "/home/git/gitlab/config/resque.yml"
-        config_template = '14-3-stable/resque.yml.j2'
-        context = { }
-        render(config_template, config_path, context, perms=0o755,
-              owner='git', group='git')
-
-    def _render_puma_configuration(self):
-        logger.debug("Render puma gitlab configuration")
-        config_path = "/home/git/gitlab/config/puma.rb"
-        config_template = '14-3-stable/puma.rb.j2'
-        context = { }
-        render(config_template, config_path, context, perms=0o755,
-              owner='git', group='git')
-
-    def _render_database_configuration(self):
-        logger.debug("Render database configuration")
-        config_path = "/home/git/gitlab/config/database.yml"
-        config_template = '14-3-stable/database.yml.j2'
-        context = { }
-        if self._stored.db_conn_str:
-            kv = dict(item.split("=") for item in self._stored.db_conn_str.split(" "))
-            # context.update(res)
-            context["database"] = kv["dbname"]
-            context["username"] = kv["user"]
-            context["password"] = kv["password"]
-            context["db_host"] = kv["host"]
-            context["db_port"] = kv["port"]
-            # TODO: use port in database template
-
-        render(config_template, config_path, context, perms=0o755,
-              owner='git', group='git')
-
-    def _render_nginx_configuration(self):
-        logger.debug("Render nginx configuration")
-        config_path = "/etc/nginx/sites-available/gitlab"
-        config_template = '14-3-stable/nginx-gitlab.j2'
+
+    def _nginx_configuration(self):
+        mode = self.config["nginx_proxy_cache"]
+        cache = self._nginx_cache_settings()
+        if cache:
+            logger.info("Nginx proxy cache (%s): %s", mode, cache)
         context = {
-            "fqdn": "localhost"
+            "upstream_keepalive": self._nginx_settings()["upstream_keepalive"],
+            "proxy_read_timeout": self.config["nginx_proxy_read_timeout"],
+            "gzip": self.config["nginx_gzip"],
+            "tls_certificate": TLS_CERTIFICATE,
+            "tls_key": TLS_KEY,
+            "http2": self.config["nginx_http2"],
+            "proxy_cache": mode if cache else None,
+            "proxy_cache_dir": gitlab.NGINX_CACHE_DIR,
+            "proxy_cache_valid": self.config["nginx_proxy_cache_valid"],
+            "status_port": gitlab.NGINX_STATUS_PORT,
+        }
+        context.update({"proxy_cache_" + key: value for key, value in (cache or {}).items()})
+        return TemplateFile('nginx-gitlab.j2', NGINX_CONFIG, context, perms=0o755)
+
+    def _nginx_main_configuration(self):
+        return TemplateFile('nginx.conf.j2', NGINX_MAIN_CONFIG, self._nginx_settings(),
+                            perms=0o644)
+
+    def _exporters(self):
+        """Return the enabled packaged exporters."""
+        ports = self._metrics_ports()
+        return [name for name in sorted(gitlab.EXPORTER_SERVICES) if name in ports]
+
+    def _exporters_configuration(self):
+        """Return the settings files of the enabled packaged exporters."""
+        names = self._exporters()
+        if not names:
+            return []
+        args = {
+            "nginx": ["--nginx.scrape-uri=" + gitlab.NGINX_STATUS_URL],
+            "postgres": [],
+            "redis": ["--redis.addr=unix://" + gitlab.REDIS_SOCKET],
+        }
+        files = []
+        for name in names:
+            listen = "--web.listen-address=" + self._metrics_listen_address(name)
+            variables = [("ARGS", " ".join([listen] + args[name]))]
+            if name == "postgres":
+                # connection and database statistics of the primary
+                variables.append(("DATA_SOURCE_NAME",
+                                  conninfo.parse(self._stored.db_conn_str).dsn()))
+            context = {
+                "service": gitlab.EXPORTER_SERVICES[name],
+                "variables": [(key, metrics.environment_value(value))
+                              for key, value in variables],
+            }
+            files.append(TemplateFile('prometheus-exporter.default.j2',
+                                      gitlab.exporter_defaults(name), context, perms=0o600))
+        return files
+
+    def _update_exporters(self, changed):
+        """Enable the exporters whose settings were written, disable the unused ones."""
+        ports = self._metrics_ports()
+        gitlab.enable_exporters([name for name in gitlab.EXPORTER_SERVICES
+                                 if changed.get(gitlab.exporter_defaults(name))])
+        for name in sorted(set(gitlab.EXPORTER_SERVICES) - set(ports)):
+            gitlab.disable_exporter(name)
+
+    def _write_tls_certificate(self):
+        """Write the configured certificate and key for nginx."""
+        if not self.config["tls_certificate"]:
+            return {}
+        mkdir(os.path.dirname(TLS_KEY), perms=0o700)
+        return {
+            TLS_CERTIFICATE: write_if_changed(
+                TLS_CERTIFICATE, base64.b64decode(self.config["tls_certificate"]), perms=0o644),
+            TLS_KEY: write_if_changed(
+                TLS_KEY, base64.b64decode(self.config["tls_key"]), perms=0o600),
         }
-        render(config_template, config_path, context, perms=0o755)
 
     def _on_database_relation_joined(self, event: pgsql.DatabaseRelationJoinedEvent):
         logger.debug("_on_database_relation_joined()")
@@ -233,6 +1058,24 @@ class GitlabServerCharm(CharmBase):
         # databases are available.
         self._stored.db_ro_uris = [c.uri for c in event.standbys]
 
+        # only database.yml depends on the standbys, no full reconfiguration
+        if not self._stored.installed:
+            return
+        error = self._check_database_replicas()
+        if error:
+            logger.error("Invalid configuration: %s", error)
+            self.model.unit.status = BlockedStatus(error)
+            return
+        if isinstance(self.model.unit.status, BlockedStatus):
+            # the replicas may have blocked the unit, a full pass sets the status
+            self.on_config_changed(event)
+            return
+        changed = gitlab.templates().render_all([self._database_configuration()],
+                                                self._template_context())
+        if changed[DATABASE_CONFIG] and self._stored.bootstrapped:
+            restarted = self._restart_services([DATABASE_CONFIG])
+            self._wait_for_services(restarted)
+
 
 
 if __name__ == "__main__":
@@ -0,0 +1,77 @@
+# Copyright 2021 Márton Kiss
+# See LICENSE file for licensing details.
+
+import hashlib
+import os
+import sys
+import tempfile
+import time
+import unittest
+sys.path.append('lib')
+
+from gitlab_helpers import artifacts  # noqa: E402
+
+
+class TestArtifactCache(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.mirror = os.path.join(self.tmp.name, "mirror")
+        os.mkdir(self.mirror)
+        self.cache = artifacts.ArtifactCache(os.path.join(self.tmp.name, "cache"),
+                                             mirror=self.mirror)
+
+    def _mirror_file(self, name, content):
+        with open(os.path.join(self.mirror, name), "wb") as f:
+            f.write(content)
+        return hashlib.sha256(content).hexdigest()
+
+    def test_fetch_from_local_mirror(self):
+        sha = self._mirror_file("ruby-2.7.4.tar.gz", b"ruby")
+        path = self.cache.fetch("ruby", "2.7.4", "https://invalid./ruby-2.7.4.tar.gz", sha)
+        with open(path, "rb") as f:
+            self.assertEqual(f.read(), b"ruby")
+        # second fetch is a cache hit even with the mirror gone
+        os.unlink(os.path.join(self.mirror, "ruby-2.7.4.tar.gz"))
+        self.assertEqual(
+            self.cache.fetch("ruby", "2.7.4", "https://invalid./ruby-2.7.4.tar.gz", sha), path)
+
+    def test_checksum_mismatch(self):
+        self._mirror_file("go.tar.gz", b"go")
+        with self.assertRaises(artifacts.ArtifactError):
+            self.cache.fetch("go", "1.16.9", "https://invalid./go.tar.gz", "0" * 64)
+        self.assertIsNone(self.cache.lookup("go", "1.16.9"))
+
+    def test_snapshot_and_restore(self):
+        root = os.path.join(self.tmp.name, "staging")
+        os.makedirs(os.path.join(root, "usr", "local", "bin"))
+        with open(os.path.join(root, "usr", "local", "bin", "ruby"), "w") as f:
+            f.write("#!/bin/sh\n")
+        self.cache.snapshot("ruby", "2.7.4", root, ["usr"])
+
+        target = os.path.join(self.tmp.name, "target")
+        self.assertFalse(self.cache.restore("ruby", "2.7.5", target))
+        self.assertTrue(self.cache.restore("ruby", "2.7.4", target))
+        self.assertTrue(os.path.isfile(os.path.join(target, "usr", "local", "bin", "ruby")))
+
+    def test_lru_eviction(self):
+        self.cache.max_size = 10
+        sha_a = self._mirror_file("a.tar.gz", b"a" * 6)
+        sha_b = self._mirror_file("b.tar.gz", b"b" * 6)
+        self.cache.fetch("a", "1", "https://invalid./a.tar.gz", sha_a)
+        # make sure the entries have distinct access times
+        entry_a = os.path.join(self.cache.path, "a-1", artifacts.META_FILE)
+        os.utime(entry_a, (time.time() - 60, time.time() - 60))
+        self.cache.fetch("b", "1", "https://invalid./b.tar.gz", sha_b)
+        self.assertIsNone(self.cache.lookup("a", "1"))
+        self.assertIsNotNone(self.cache.lookup("b", "1"))
+
+    def test_add_entries(self):
+        sha = self._mirror_file("ruby-2.7.4.tar.gz", b"ruby")
+        self.cache.fetch("ruby", "2.7.4", "https://invalid./ruby-2.7.4.tar.gz", sha)
+        seeded = artifacts.ArtifactCache(os.path.join(self.tmp.name, "seeded"))
+        self.assertEqual(seeded.add_entries(self.cache.path, ["ruby-2.7.4", "go-1.16.9"]),
+                         ["ruby-2.7.4"])
+        self.assertIsNotNone(seeded.lookup("ruby", "2.7.4", sha))
+        # present entries are not copied again
+        self.assertEqual(seeded.add_entries(self.cache.path), [])
@@ -0,0 +1,107 @@
+# Copyright 2021 Márton Kiss
+# See LICENSE file for licensing details.
+
+import io
+import os
+import sys
+import tarfile
+import tempfile
+import unittest
+from unittest.mock import patch
+sys.path.append('lib')
+
+from gitlab_helpers import bundle  # noqa: E402
+
+
+class TestInstallBundle(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.root = os.path.join(self.tmp.name, "root")
+        self._write("debs/nginx_1.18.0_amd64.deb", b"deb")
+        self._write("npm/yarn-1.22.17.tgz", b"yarn")
+        self._write("git/gitlab.git/HEAD", b"ref: refs/heads/14-3-stable\n")
+        self.manifest = bundle.write_manifest(self.root, versions={"yarn": "1.22.17"})
+
+    def _write(self, path, content):
+        path = os.path.join(self.root, path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "wb") as f:
+            f.write(content)
+
+    def test_manifest(self):
+        self.assertEqual(sorted(self.manifest["files"]),
+                         ["debs/nginx_1.18.0_amd64.deb", "git/gitlab.git/HEAD",
+                          "npm/yarn-1.22.17.tgz"])
+        self.assertEqual(self.manifest["files"]["npm/yarn-1.22.17.tgz"]["size"], 4)
+        self.assertEqual(bundle.verify(self.root)["versions"], {"yarn": "1.22.17"})
+
+    def test_verify_detects_changes(self):
+        self._write("debs/nginx_1.18.0_amd64.deb", b"bad")
+        with self.assertRaisesRegex(bundle.BundleError, "nginx_1.18.0_amd64.deb does not match"):
+            bundle.verify(self.root)
+        os.unlink(os.path.join(self.root, "npm/yarn-1.22.17.tgz"))
+        with self.assertRaisesRegex(bundle.BundleError, "yarn-1.22.17.tgz is missing"):
+            bundle.verify(self.root)
+
+    def test_verify_checks_platform(self):
+        bundle.write_manifest(self.root)
+        with patch.object(bundle, "platform_info",
+                          return_value={"codename": "jammy", "machine": "s390x"}):
+            with self.assertRaisesRegex(bundle.BundleError, "was built for"):
+                bundle.verify(self.root)
+
+    def test_pack_and_unpack(self):
+        archive = bundle.pack(self.root, os.path.join(self.tmp.name, "bundle.tar"))
+        target = os.path.join(self.tmp.name, "unpacked")
+        install_bundle = bundle.unpack(archive, target)
+        self.assertEqual(install_bundle.root, target)
+        self.assertEqual(install_bundle.yarn_package,
+                         os.path.join(target, "npm", "yarn-1.22.17.tgz"))
+        self.assertEqual(install_bundle.git_source("gitlab"),
+                         "file://" + os.path.join(target, "git", "gitlab.git"))
+        with self.assertRaises(bundle.BundleError):
+            install_bundle.git_source("gitaly")
+
+        # the same archive is not unpacked again
+        marker = os.path.join(target, "marker")
+        open(marker, "w").close()
+        bundle.unpack(archive, target)
+        self.assertTrue(os.path.exists(marker))
+
+    def test_unsafe_archive(self):
+        archive = os.path.join(self.tmp.name, "evil.tar")
+        with tarfile.open(archive, "w") as tar:
+            member = tarfile.TarInfo("../escape")
+            member.size = 1
+            tar.addfile(member, io.BytesIO(b"x"))
+        with self.assertRaisesRegex(bundle.BundleError, "Unsafe path"):
+            bundle.unpack(archive, os.path.join(self.tmp.name, "unpacked"))
+        self.assertFalse(os.path.exists(os.path.join(self.tmp.name, "escape")))
+
+    def test_links_must_stay_inside(self):
+        def archive(*members):
+            data = io.BytesIO()
+            with tarfile.open(fileobj=data, mode="w") as tar:
+                for name, linkname, mode in members:
+                    member = tarfile.TarInfo(name)
+                    member.mode = mode
+                    if linkname:
+                        member.type, member.linkname = tarfile.SYMTYPE, linkname
+                    tar.addfile(member, io.BytesIO())
+            data.seek(0)
+            return tarfile.open(fileobj=data)
+
+        inside = ("node_modules/.bin/webpack", "../webpack/bin/webpack.js", 0o777)
+        bundle._check_members(archive(inside), links=True)
+        with self.assertRaisesRegex(bundle.BundleError, "Unsupported file type"):
+            bundle._check_members(archive(inside))
+        for linkname in ("../../../etc/passwd", "/etc/passwd"):
+            with self.assertRaisesRegex(bundle.BundleError, "Link out of"):
+                bundle._check_members(archive(("bin/x", linkname, 0o777)), links=True)
+        with self.assertRaisesRegex(bundle.BundleError, "setuid"):
+            bundle._check_members(archive(("bin/x", None, 0o4755)), links=True)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,35 +1,222 @@
 # Copyright 2021 Márton Kiss
 # See LICENSE file for licensing details.
 
+import json
 import unittest
-from unittest.mock import Mock
+from unittest.mock import Mock, patch
 
+from ops.model import ActiveStatus, BlockedStatus
 from ops.testing import Harness
-from charm import GitlabOperatorCharm
+from charm import GitlabServerCharm
+from gitlab_helpers import bundle, gitlab, host, profiling, templating, tuning
 
 
 class TestCharm(unittest.TestCase):
     def test_config_changed(self):
-        harness = Harness(GitlabOperatorCharm)
+        harness = Harness(GitlabServerCharm)
         self.addCleanup(harness.cleanup)
         harness.begin()
-        self.assertEqual(list(harness.charm._stored.things), [])
-        harness.update_config({"thing": "foo"})
-        self.assertEqual(list(harness.charm._stored.things), ["foo"])
+        # nothing is configured before the install hook
+        with patch.object(GitlabServerCharm, "_render_configuration") as render:
+            harness.update_config({"restart_strategy": "bogus"})
+        self.assertFalse(render.called)
+        harness.charm._stored.installed = True
+        with patch.object(GitlabServerCharm, "_render_configuration") as render:
+            harness.update_config({"restart_strategy": "bogus", "fqdn": "gitlab.example.com"})
+        self.assertFalse(render.called)
+        self.assertEqual(harness.model.unit.status,
+                         BlockedStatus("restart_strategy must be one of: restart, reload, phased"))
+        harness.update_config({"restart_strategy": "restart", "nginx_proxy_cache": "all"})
+        self.assertEqual(harness.model.unit.status,
+                         BlockedStatus("nginx_proxy_cache must be one of: off, public, session"))
+        harness.update_config({"nginx_proxy_cache": "off", "metrics_scrape_timeout": "2m"})
+        self.assertEqual(harness.model.unit.status, BlockedStatus(
+            "metrics_scrape_timeout must not exceed metrics_scrape_interval"))
+        harness.update_config({"metrics_scrape_timeout": "10s", "redis_profile": "cache-heavy"})
+        self.assertEqual(harness.model.unit.status, BlockedStatus(
+            "redis_profile cache-heavy evicts the Sidekiq queues, enable redis_split"))
 
-    def test_action(self):
-        harness = Harness(GitlabOperatorCharm)
+    def test_metrics_endpoint(self):
+        harness = Harness(GitlabServerCharm)
+        self.addCleanup(harness.cleanup)
+        harness.set_leader(True)
+        harness.begin()
+        relation_id = harness.add_relation("metrics-endpoint", "prometheus")
+        harness.add_relation_unit(relation_id, "prometheus/0")
+        data = harness.get_relation_data(relation_id, harness.charm.app.name)
+        self.assertEqual(json.loads(data["scrape_jobs"]), [])
+        self.assertEqual(json.loads(data["scrape_metadata"])["charm_name"], "gitlab-operator")
+        unit_data = harness.get_relation_data(relation_id, harness.charm.unit.name)
+        self.assertEqual(unit_data["prometheus_scrape_unit_name"], harness.charm.unit.name)
+        self.assertIn("prometheus_scrape_unit_address", unit_data)
+
+        harness.update_config({"metrics": True, "metrics_scrape_interval": "30s"})
+        jobs = json.loads(harness.get_relation_data(relation_id, "gitlab-operator")["scrape_jobs"])
+        # postgres_exporter waits for the db relation
+        self.assertEqual([job["job_name"] for job in jobs],
+                         ["gitlab-puma", "gitlab-sidekiq", "gitaly", "redis", "nginx"])
+        self.assertEqual(jobs[0]["static_configs"], [{"targets": ["*:8083"]}])
+        self.assertEqual(jobs[0]["scrape_interval"], "30s")
+
+        harness.charm._stored.db_conn_str = "host=10.0.0.10 dbname=gitlab-server"
+        harness.update_config({"redis_exporter_port": 9200})
+        jobs = json.loads(harness.get_relation_data(relation_id, "gitlab-operator")["scrape_jobs"])
+        self.assertIn("postgres", [job["job_name"] for job in jobs])
+        self.assertEqual(jobs[3]["static_configs"], [{"targets": ["*:9200"]}])
+
+    def test_metrics_address(self):
+        harness = Harness(GitlabServerCharm)
+        self.addCleanup(harness.cleanup)
         harness.begin()
-        # the harness doesn't (yet!) help much with actions themselves
-        action_event = Mock(params={"fail": ""})
-        harness.charm._on_fortune_action(action_event)
+        harness.update_config({"metrics": True})
+        self.assertEqual(harness.charm._metrics_listen_address("gitaly"), "127.0.0.1:9236")
+        harness.add_network("10.0.0.20", endpoint="metrics-endpoint")
+        self.assertEqual(harness.charm._metrics_listen_address("gitaly"), "10.0.0.20:9236")
+        self.assertEqual(harness.charm._template_context()["metrics_address"], "10.0.0.20")
+        relation_id = harness.add_relation("metrics-endpoint", "prometheus")
+        harness.add_network("fd00::20", endpoint="metrics-endpoint", relation_id=relation_id)
+        self.assertEqual(harness.charm._metrics_listen_address("redis"), "[fd00::20]:9121")
 
-        self.assertTrue(action_event.set_results.called)
+    def test_memory_budget_is_shared(self):
+        harness = Harness(GitlabServerCharm)
+        self.addCleanup(harness.cleanup)
+        harness.begin()
+        harness.update_config({"redis_profile": "durable-aof", "redis_split": True})
+        with patch.object(host, "cpu_count", return_value=8), \
+                patch.object(host, "memory_total", return_value=32 * tuning.GB):
+            redis = sum(harness.charm._redis_memory().values())
+            sidekiq = harness.charm._sidekiq_settings()["processes"]
+            puma = harness.charm._puma_settings()
+        self.assertEqual(redis, int(15.25 * tuning.GB))
+        puma_memory = puma["workers"] * puma["worker_max_memory_mb"] * tuning.MB
+        used = redis + sidekiq * tuning.SIDEKIQ_PROCESS_MEMORY + puma_memory
+        self.assertLessEqual(used, tuning.memory_budget(32 * tuning.GB))
+        self.assertEqual(puma["workers"], 6)
 
-    def test_action_fail(self):
-        harness = Harness(GitlabOperatorCharm)
+    def test_database_replica_ports(self):
+        harness = Harness(GitlabServerCharm)
+        self.addCleanup(harness.cleanup)
+        harness.begin()
+        harness.charm._stored.db_conn_str = "host=10.0.0.10 port=5432 dbname=gitlab-server"
+        harness.charm._stored.db_ro_uris = [
+            "postgresql://gitlab@10.0.0.11:5432/gitlab-server",
+            "postgresql://gitlab@10.0.0.11/gitlab-server",
+            "postgresql://gitlab@10.0.0.12:5432/gitlab-server",
+        ]
+        self.assertIsNone(harness.charm._check_database_replicas())
+        self.assertEqual(harness.charm._database_load_balancing()["db_replicas"],
+                         ["10.0.0.11", "10.0.0.12"])
+        harness.charm._stored.db_ro_uris.append("postgresql://gitlab@10.0.0.13:5433/gitlab")
+        self.assertEqual(harness.charm._check_database_replicas(),
+                         "db replicas must use port 5432 like the primary (10.0.0.13:5433), "
+                         "or disable db_load_balancing")
+        harness.charm._stored.db_ro_uris.pop()
+        harness.update_config({"pgbouncer": True})
+        self.assertEqual(harness.charm._check_database_replicas(),
+                         "pgbouncer and db_load_balancing are mutually exclusive, disable "
+                         "one of them")
+        harness.update_config({"db_load_balancing": False})
+        self.assertIsNone(harness.charm._check_database_replicas())
+
+    def test_broken_template_changes_nothing(self):
+        harness = Harness(GitlabServerCharm)
+        self.addCleanup(harness.cleanup)
+        harness.begin()
+        harness.charm._stored.db_conn_str = "host=10.0.0.10 dbname=gitlab-server"
+        harness.update_config({"pgbouncer": True, "redis_split": True,
+                               "nginx_proxy_cache": "public"})
+        engine = Mock()
+        engine.render_files.side_effect = templating.TemplateError("broken")
+        with patch.object(gitlab, "templates", return_value=engine), \
+                patch.object(gitlab, "install_pgbouncer") as install_pgbouncer, \
+                patch.object(gitlab, "configure_redis_instance") as configure_redis_instance, \
+                patch.object(gitlab, "configure_nginx_cache") as configure_nginx_cache:
+            with self.assertRaises(templating.TemplateError):
+                harness.charm._render_configuration()
+        self.assertFalse(install_pgbouncer.called)
+        self.assertFalse(configure_redis_instance.called)
+        self.assertFalse(configure_nginx_cache.called)
+
+    def test_optional_packages_from_install_bundle(self):
+        harness = Harness(GitlabServerCharm)
+        self.addCleanup(harness.cleanup)
         harness.begin()
-        action_event = Mock(params={"fail": "fail this"})
-        harness.charm._on_fortune_action(action_event)
+        harness.charm._stored.db_conn_str = "host=10.0.0.10 dbname=gitlab-server"
+        harness.update_config({"pgbouncer": True, "metrics": True})
+        install_bundle = Mock()
+        with patch.object(GitlabServerCharm, "_install_bundle",
+                          return_value=install_bundle) as open_bundle, \
+                patch.object(gitlab, "missing_packages", side_effect=[["pgbouncer"], []]), \
+                patch.object(gitlab, "install_pgbouncer") as install_pgbouncer, \
+                patch.object(gitlab, "install_exporters") as install_exporters:
+            harness.charm._install_optional_packages()
+            install_pgbouncer.assert_called_once_with(install_bundle)
+            install_exporters.assert_called_once_with(install_bundle)
+            # nothing missing, the bundle is not opened
+            harness.charm._install_optional_packages()
+        self.assertEqual(open_bundle.call_count, 1)
+        install_pgbouncer.assert_called_with(None)
 
-        self.assertEqual(action_event.fail.call_args, [("fail this",)])
+    def test_assets_keep_hsts(self):
+        harness = Harness(GitlabServerCharm)
+        self.addCleanup(harness.cleanup)
+        harness.begin()
+        harness.update_config({"tls_certificate": "Y2VydA==", "tls_key": "a2V5"})
+        file = harness.charm._nginx_configuration()
+        text = gitlab.templates().render(file.template,
+                                         dict(harness.charm._template_context(), **file.context))
+        assets = text.split("location ^~ /assets/ {")[1].split("}")[0]
+        self.assertIn('add_header Strict-Transport-Security "max-age=63072000" always;', assets)
+
+    def test_wait_for_enabled_services(self):
+        harness = Harness(GitlabServerCharm)
+        self.addCleanup(harness.cleanup)
+        harness.begin()
+        with patch.object(gitlab, "service_enabled", side_effect=lambda name: name == "nginx"), \
+                patch.object(gitlab, "puma_ready", return_value=False) as puma_ready, \
+                patch("charm.service_running", return_value=True) as service_running:
+            harness.charm._wait_for_services({"gitlab-puma", "nginx"})
+        self.assertFalse(puma_ready.called)
+        service_running.assert_called_once_with("nginx")
+        self.assertEqual(harness.model.unit.status, ActiveStatus("Ready"))
+
+    def test_hook_profile_action(self):
+        harness = Harness(GitlabServerCharm)
+        self.addCleanup(harness.cleanup)
+        harness.begin()
+        hooks = [{"hook": "install", "seconds": 12.5, "records": [
+            {"name": "install_ruby", "kind": "step", "seconds": 10.0,
+             "exit_code": 0, "output_bytes": None},
+            {"name": "make", "kind": "command", "seconds": 2.0,
+             "exit_code": 2, "output_bytes": 42},
+        ]}]
+        action_event = Mock(params={"hooks": 10, "top": 1})
+        with patch.object(profiling, "load", return_value=hooks):
+            harness.charm._on_hook_profile_action(action_event)
+        results = action_event.set_results.call_args[0][0]
+        self.assertEqual(results["hooks"], "install 12.5s")
+        self.assertEqual(results["slowest"], "10.000s install step install_ruby")
+
+    def test_hook_profile_action_without_profiles(self):
+        harness = Harness(GitlabServerCharm)
+        self.addCleanup(harness.cleanup)
+        harness.begin()
+        action_event = Mock(params={"hooks": 10, "top": 10})
+        with patch.object(profiling, "load", return_value=[]):
+            harness.charm._on_hook_profile_action(action_event)
+        self.assertTrue(action_event.fail.called)
+
+    def test_install_bundle_source(self):
+        harness = Harness(GitlabServerCharm)
+        self.addCleanup(harness.cleanup)
+        harness.begin()
+        with patch.object(bundle, "unpack") as unpack:
+            self.assertIsNone(harness.charm._install_bundle())
+            harness.update_config({"install_bundle": "/srv/install-bundle.tar"})
+            harness.charm._install_bundle()
+            unpack.assert_called_with("/srv/install-bundle.tar")
+            # the resource takes precedence
+            harness.add_resource("install-bundle", "bundle")
+            harness.charm._install_bundle()
+            self.assertTrue(unpack.call_args[0][0].endswith("install-bundle.tar"))
+            self.assertNotEqual(unpack.call_args[0][0], "/srv/install-bundle.tar")
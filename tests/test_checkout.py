@@ -0,0 +1,137 @@
+# Copyright 2021 Márton Kiss
+# See LICENSE file for licensing details.
+
+import glob
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+sys.path.append('lib')
+
+from gitlab_helpers import checkout, profiling  # noqa: E402
+
+
+def git(*args, cwd=None):
+    env = dict(os.environ, GIT_AUTHOR_NAME="t", GIT_AUTHOR_EMAIL="t@example.com",
+               GIT_COMMITTER_NAME="t", GIT_COMMITTER_EMAIL="t@example.com")
+    return subprocess.run(["git"] + list(args), cwd=cwd, env=env, check=True,
+                          stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                          universal_newlines=True).stdout.strip()
+
+
+@unittest.skipIf(shutil.which("git") is None, "git is not installed")
+class TestSourceMirror(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.addCleanup(profiling.reset)
+        self.upstream = os.path.join(self.tmp.name, "upstream")
+        git("init", "-q", self.upstream)
+        self.commits = [self._commit(str(i)) for i in range(3)]
+        git("branch", "14-3-stable", cwd=self.upstream)
+        git("tag", "v1.0.0", cwd=self.upstream)
+        self.url = "file://" + self.upstream
+        self.mirror = checkout.SourceMirror(os.path.join(self.tmp.name, "mirror"),
+                                            attempts=2, retry_delay=0)
+        self.target = os.path.join(self.tmp.name, "gitlab")
+
+    def _commit(self, content):
+        with open(os.path.join(self.upstream, "VERSION"), "w") as f:
+            f.write(content)
+        git("add", "VERSION", cwd=self.upstream)
+        git("commit", "-q", "-m", content, cwd=self.upstream)
+        return git("rev-parse", "HEAD", cwd=self.upstream)
+
+    def _head(self):
+        return git("rev-parse", "HEAD", cwd=self.target)
+
+    def test_shallow_checkout(self):
+        self.assertTrue(self.mirror.checkout("gitlab", self.url, "refs/heads/14-3-stable",
+                                             self.target, origin="https://example.com/g.git"))
+        self.assertEqual(self._head(), self.commits[-1])
+        self.assertTrue(os.path.isfile(os.path.join(self.mirror.path("gitlab"), "shallow")))
+        self.assertEqual(git("rev-list", "--count", "HEAD", cwd=self.target), "1")
+        self.assertEqual(git("remote", "get-url", "origin", cwd=self.target),
+                         "https://example.com/g.git")
+        # up to date, nothing to do
+        self.assertFalse(self.mirror.checkout("gitlab", self.url, "refs/heads/14-3-stable",
+                                              self.target))
+
+    def test_update_to_new_branch(self):
+        self.mirror.checkout("gitlab", self.url, "refs/heads/14-3-stable", self.target)
+        new = self._commit("next")
+        git("branch", "14-4-stable", cwd=self.upstream)
+        self.assertTrue(self.mirror.checkout("gitlab", self.url, "refs/heads/14-4-stable",
+                                             self.target))
+        self.assertEqual(self._head(), new)
+        self.assertEqual(git("rev-parse", "--abbrev-ref", "HEAD", cwd=self.target),
+                         "14-4-stable")
+
+    def test_mirror_is_used_when_upstream_fails(self):
+        self.mirror.checkout("gitlab", self.url, "refs/tags/v1.0.0", self.target)
+        shutil.rmtree(self.upstream)
+        shutil.rmtree(self.target)
+        # tags are not fetched again
+        self.assertEqual(self.mirror.fetch("gitlab", self.url, "refs/tags/v1.0.0"),
+                         self.commits[-1])
+        self.assertTrue(self.mirror.checkout("gitlab", self.url, "refs/tags/v1.0.0",
+                                             self.target))
+        self.assertEqual(self._head(), self.commits[-1])
+        with self.assertRaises(checkout.CommandError):
+            self.mirror.fetch("gitlab", self.url, "refs/heads/14-3-stable")
+
+    def test_objects_are_shared(self):
+        self.mirror.checkout("gitlab", self.url, "refs/heads/14-3-stable", self.target)
+        new = self._commit("next")
+        git("branch", "14-4-stable", cwd=self.upstream)
+        self.mirror.checkout("gitlab", self.url, "refs/heads/14-4-stable", self.target)
+        self.assertEqual(self._head(), new)
+        self.assertEqual(git("fsck", "--no-dangling", cwd=self.target), "")
+
+        def objects(path):
+            return {os.path.relpath(os.path.join(dirpath, name), path): os.stat(
+                os.path.join(dirpath, name)).st_ino
+                for dirpath, _, filenames in os.walk(path) for name in filenames}
+        mirrored = objects(os.path.join(self.mirror.path("gitlab"), "objects"))
+        checked_out = objects(os.path.join(self.target, ".git", "objects"))
+        # nothing was fetched, every object is a link to the mirror's
+        self.assertEqual(checked_out, {name: inode for name, inode in mirrored.items()
+                                       if not name.startswith("info")})
+
+    def test_interrupted_checkout_and_fetch(self):
+        # an interrupted clone and fetch
+        clone = os.path.join(self.tmp.name, checkout.CLONE_PREFIX + "gitlab-x1y2")
+        os.makedirs(os.path.join(clone, ".git"))
+        os.makedirs(self.target)
+        os.makedirs(self.mirror.path("gitlab"))
+        git("init", "-q", "--bare", self.mirror.path("gitlab"))
+        lock = os.path.join(self.mirror.path("gitlab"), "shallow.lock")
+        open(lock, "w").close()
+
+        self.mirror.checkout("gitlab", self.url, "refs/heads/14-3-stable", self.target)
+        self.assertEqual(self._head(), self.commits[-1])
+        self.assertFalse(os.path.exists(lock))
+        self.assertFalse(os.path.exists(clone))
+        self.assertEqual(os.stat(self.target).st_mode & 0o777, 0o755)
+
+    def test_target_is_never_removed(self):
+        os.makedirs(os.path.join(self.target, "config"))
+        with open(os.path.join(self.target, "config", "gitlab.yml"), "w") as f:
+            f.write("production: {}\n")
+        with self.assertRaises(checkout.CheckoutError):
+            self.mirror.checkout("gitlab", self.url, "refs/heads/14-3-stable", self.target)
+        self.assertEqual(os.listdir(self.target), ["config"])
+        self.assertEqual(glob.glob(os.path.join(self.tmp.name, checkout.CLONE_PREFIX + "*")),
+                         [])
+
+    def test_short_ref(self):
+        self.assertEqual(checkout.short_ref("refs/heads/14-3-stable"), "14-3-stable")
+        self.assertEqual(checkout.short_ref("refs/tags/v1.44.0"), "v1.44.0")
+        with self.assertRaises(ValueError):
+            checkout.short_ref("0123abc")
+
+
+if __name__ == '__main__':
+    unittest.main()
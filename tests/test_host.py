@@ -0,0 +1,38 @@
+# Copyright 2021 Márton Kiss
+# See LICENSE file for licensing details.
+
+import os
+import sys
+import tempfile
+import unittest
+from unittest.mock import patch
+sys.path.append('lib')
+
+from gitlab_helpers import host  # noqa: E402
+
+
+class TestBuildJobs(unittest.TestCase):
+    @patch.object(host, "cpu_count", return_value=16)
+    @patch.object(host, "memory_available", return_value=64 * 1024 ** 3)
+    def test_defaults_to_cpu_count(self, *_):
+        self.assertEqual(host.build_jobs(0), 16)
+        self.assertEqual(host.build_jobs(4), 4)
+
+    @patch.object(host, "cpu_count", return_value=16)
+    @patch.object(host, "memory_available", return_value=3 * 1024 ** 3)
+    def test_capped_by_memory(self, *_):
+        self.assertEqual(host.build_jobs(0), 3)
+        self.assertEqual(host.build_jobs(8), 3)
+
+    @patch.object(host, "cpu_count", return_value=2)
+    @patch.object(host, "memory_available", return_value=100)
+    def test_at_least_one_job(self, *_):
+        self.assertEqual(host.build_jobs(0), 1)
+
+
+class TestDiskSpace(unittest.TestCase):
+    def test_missing_path_uses_its_parent(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            total, free = host.disk_space(os.path.join(tmp, "cache", "nginx"))
+            self.assertEqual((total, free), host.disk_space(tmp))
+            self.assertGreaterEqual(total, free)
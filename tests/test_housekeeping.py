@@ -0,0 +1,95 @@
+# Copyright 2021 Márton Kiss
+# See LICENSE file for licensing details.
+
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+sys.path.append('lib')
+
+from gitlab_helpers import housekeeping  # noqa: E402
+
+
+def git(*args, cwd=None):
+    env = dict(os.environ, GIT_AUTHOR_NAME="t", GIT_AUTHOR_EMAIL="t@example.com",
+               GIT_COMMITTER_NAME="t", GIT_COMMITTER_EMAIL="t@example.com")
+    subprocess.run(["git"] + list(args), cwd=cwd, env=env, check=True,
+                   stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+@unittest.skipIf(shutil.which("git") is None, "git is not installed")
+class TestHousekeeping(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.root = os.path.join(self.tmp.name, "repositories")
+
+    def _repository(self, name, commits):
+        work = os.path.join(self.tmp.name, "work-" + name.replace("/", "-"))
+        git("init", "-q", work)
+        for i in range(commits):
+            with open(os.path.join(work, "file"), "w") as f:
+                f.write(str(i))
+            git("add", "file", cwd=work)
+            git("commit", "-q", "-m", str(i), cwd=work)
+        path = os.path.join(self.root, name)
+        git("clone", "-q", "--bare", "--no-local", work, path)
+        # a clone is packed, move the objects back to loose ones
+        pack_dir = os.path.join(path, "objects", "pack")
+        for pack in os.listdir(pack_dir):
+            if pack.endswith(".pack"):
+                moved = os.path.join(self.tmp.name, pack)
+                os.rename(os.path.join(pack_dir, pack), moved)
+                os.unlink(os.path.join(pack_dir, pack[:-5] + ".idx"))
+                with open(moved, "rb") as f:
+                    subprocess.run(["git", "unpack-objects", "-q"], cwd=path, stdin=f, check=True)
+        return path
+
+    def test_find_and_rank(self):
+        small = self._repository("@hashed/aa/bb/small.git", 2)
+        large = self._repository("@hashed/cc/dd/large.git", 10)
+        os.makedirs(os.path.join(self.root, "+gitaly", "tmp.git"))
+        self.assertEqual(sorted(housekeeping.find_repositories(self.root)), [small, large])
+        stats = housekeeping.repository_stats(large)
+        self.assertEqual(stats.loose_objects, 30)
+        self.assertEqual(stats.packs, 0)
+
+        report = housekeeping.run(self.root, loose_objects_limit=5, dry_run=True)
+        self.assertEqual(report["scanned"], 2)
+        self.assertEqual([r["repository"] for r in report["results"]], [large, small])
+
+    def test_object_pools_are_skipped(self):
+        pool = self._repository("@pools/aa/bb/pool.git", 2)
+        other_pool = self._repository("@hashed/ee/ff/pool.git", 2)
+        member = self._repository("@hashed/aa/bb/member.git", 2)
+        fork = self._repository("@hashed/cc/dd/fork.git", 2)
+        with open(os.path.join(member, "objects", "info", "alternates"), "w") as f:
+            f.write(os.path.join(pool, "objects") + "\n")
+        with open(os.path.join(fork, "objects", "info", "alternates"), "w") as f:
+            f.write(os.path.relpath(os.path.join(other_pool, "objects"),
+                                    os.path.join(fork, "objects")) + "\n")
+        self.assertEqual(housekeeping.alternates(member), [os.path.join(pool, "objects")])
+        self.assertEqual(sorted(housekeeping.find_repositories(self.root)), [member, fork])
+
+    def test_plan(self):
+        stats = housekeeping.RepositoryStats("r", loose_objects=10, packs=1, commit_graph=True)
+        self.assertEqual(housekeeping.plan(stats), [])
+        stats.loose_objects = 2000
+        self.assertEqual(housekeeping.plan(stats),
+                         ["incremental-repack", "prune", "multi-pack-index", "commit-graph"])
+        stats.packs = 20
+        self.assertEqual(housekeeping.plan(stats), ["full-repack", "commit-graph"])
+
+    def test_optimize(self):
+        path = self._repository("project.git", 10)
+        report = housekeeping.run(self.root, workers=2, loose_objects_limit=5, nice=False)
+        self.assertEqual(report["optimized"], 1)
+        self.assertEqual(report["failed"], 0)
+        result = report["results"][0]
+        self.assertEqual(result["loose_objects"], [30, 0])
+        self.assertGreater(result["bytes_reclaimed"], 0)
+        stats = housekeeping.repository_stats(path)
+        self.assertTrue(stats.commit_graph)
+        self.assertEqual(housekeeping.plan(stats, loose_objects_limit=5), [])
@@ -0,0 +1,128 @@
+# Copyright 2021 Márton Kiss
+# See LICENSE file for licensing details.
+
+import http.server
+import socket
+import sys
+import threading
+import unittest
+sys.path.append('lib')
+
+from gitlab_helpers import metrics  # noqa: E402
+
+EXPOSITION = """\
+# HELP puma_queued_connections The number of queued connections on that worker
+# TYPE puma_queued_connections gauge
+puma_queued_connections{worker="puma_0"} 0
+puma_queued_connections{worker="puma_1"} 3
+# HELP http_request_duration_seconds A histogram of request latencies
+# TYPE http_request_duration_seconds histogram
+http_request_duration_seconds_bucket{method="get",le="0.1"} 12 1633036800000
+http_request_duration_seconds_bucket{method="get",le="+Inf"} 14
+http_request_duration_seconds_sum{method="get"} 2.5e+00
+http_request_duration_seconds_count{method="get"} 14
+redis_up NaN
+"""
+
+
+class _ExporterHandler(http.server.BaseHTTPRequestHandler):
+    """Serves the exposition text of its server on /metrics."""
+
+    def do_GET(self):
+        if self.path != metrics.METRICS_PATH:
+            self.send_error(404)
+            return
+        body = self.server.body.encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class TestMetrics(unittest.TestCase):
+    def _exporter(self, body):
+        """Start an exporter stand-in on a free local port, returns the port."""
+        server = http.server.HTTPServer(("127.0.0.1", 0), _ExporterHandler)
+        server.body = body
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        return server.server_address[1]
+
+    def _closed_port(self):
+        with socket.socket() as s:
+            s.bind(("127.0.0.1", 0))
+            return s.getsockname()[1]
+
+    def test_duration_seconds(self):
+        self.assertEqual(metrics.duration_seconds("30s"), 30)
+        self.assertEqual(metrics.duration_seconds("1m"), 60)
+        self.assertEqual(metrics.duration_seconds("500ms"), 0.5)
+        for value in ("", "30", "1.5m", "5 m", "1h30m"):
+            self.assertIsNone(metrics.duration_seconds(value), value)
+
+    def test_scrape_jobs(self):
+        jobs = metrics.scrape_jobs({"redis": 9121, "puma": 8083}, "1m", "10s")
+        self.assertEqual(jobs, [{
+            "job_name": "gitlab-puma",
+            "metrics_path": "/metrics",
+            "scrape_interval": "1m",
+            "scrape_timeout": "10s",
+            "static_configs": [{"targets": ["*:8083"]}],
+        }, {
+            "job_name": "redis",
+            "metrics_path": "/metrics",
+            "scrape_interval": "1m",
+            "scrape_timeout": "10s",
+            "static_configs": [{"targets": ["*:9121"]}],
+        }])
+        self.assertEqual(metrics.scrape_jobs({}, "1m", "10s"), [])
+
+    def test_listen_address(self):
+        self.assertEqual(metrics.listen_address("10.0.0.20", 9121), "10.0.0.20:9121")
+        self.assertEqual(metrics.listen_address("fd00::20", 9121), "[fd00::20]:9121")
+
+    def test_environment_value(self):
+        self.assertEqual(metrics.environment_value("--web.listen-address=:9121"),
+                         '"--web.listen-address=:9121"')
+        self.assertEqual(metrics.environment_value(r'password=a"b\c'),
+                         r'"password=a\"b\\c"')
+
+    def test_parse_metrics(self):
+        self.assertEqual(metrics.parse_metrics(EXPOSITION), {
+            "puma_queued_connections": 2,
+            "http_request_duration_seconds_bucket": 2,
+            "http_request_duration_seconds_sum": 1,
+            "http_request_duration_seconds_count": 1,
+            "redis_up": 1,
+        })
+        with self.assertRaises(metrics.MetricsError):
+            metrics.parse_metrics("<html>Active connections: 1</html>\n")
+        with self.assertRaises(metrics.MetricsError):
+            metrics.parse_metrics("nginx_up yes\n")
+
+    def test_check_exporters(self):
+        ports = {
+            "puma": self._exporter(EXPOSITION),
+            # stub_status served as is, not in the exposition format
+            "nginx": self._exporter("Active connections: 1\n"),
+            "redis": self._exporter("# no metrics yet\n"),
+            "gitaly": self._closed_port(),
+        }
+        results = metrics.check_exporters(ports, timeout=5)
+        self.assertEqual(list(results), ["puma", "gitaly", "redis", "nginx"])
+        self.assertEqual(results["puma"], {
+            "url": "http://127.0.0.1:{}/metrics".format(ports["puma"]),
+            "metrics": 5, "samples": 7})
+        self.assertIn("Unable to scrape", results["gitaly"]["error"])
+        self.assertIn("No metrics", results["redis"]["error"])
+        self.assertIn("Line 1", results["nginx"]["error"])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,54 @@
+# Copyright 2021 Márton Kiss
+# See LICENSE file for licensing details.
+
+import os
+import subprocess
+import sys
+import tempfile
+import unittest
+sys.path.append('lib')
+
+from gitlab_helpers import profiling  # noqa: E402
+
+
+class TestProfiling(unittest.TestCase):
+    def setUp(self):
+        profiling.reset()
+        self.addCleanup(profiling.reset)
+
+    def test_profiled_step(self):
+        @profiling.profiled(kind="render")
+        def render():
+            return "done"
+
+        @profiling.profiled(name="broken")
+        def broken():
+            raise subprocess.CalledProcessError(2, ["false"])
+
+        self.assertEqual(render(), "done")
+        with self.assertRaises(subprocess.CalledProcessError):
+            broken()
+        records = profiling.records()
+        self.assertEqual([(r["name"], r["kind"], r["exit_code"]) for r in records],
+                         [("TestProfiling.test_profiled_step.<locals>.render", "render", 0),
+                          ("broken", "step", 2)])
+
+    def test_command_name(self):
+        self.assertEqual(profiling.command_name(["systemctl", "daemon-reload"]),
+                         "systemctl daemon-reload")
+        name = profiling.command_name(["/bin/bash", "-c", "cd /home/git ;\n" + "x" * 200])
+        self.assertEqual(len(name), profiling.COMMAND_NAME_LENGTH)
+        self.assertTrue(name.startswith("cd /home/git ; xxx"))
+
+    def test_save_keeps_last_hooks(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "state", "profile.json")
+            for i in range(5):
+                profiling.record("step-{}".format(i), "step", i)
+                profiling.save("hook-{}".format(i), i, path=path, max_hooks=3)
+            hooks = profiling.load(path)
+        self.assertEqual([h["hook"] for h in hooks], ["hook-2", "hook-3", "hook-4"])
+        self.assertEqual(profiling.records(), [])
+        slowest = profiling.slowest(hooks, top=2)
+        self.assertEqual([(e["hook"], e["name"]) for e in slowest],
+                         [("hook-4", "step-4"), ("hook-3", "step-3")])
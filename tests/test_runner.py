@@ -0,0 +1,73 @@
+# Copyright 2021 Márton Kiss
+# See LICENSE file for licensing details.
+
+import sys
+import time
+import unittest
+from unittest.mock import patch
+sys.path.append('lib')
+
+from gitlab_helpers import profiling, runner  # noqa: E402
+
+
+class TestRunner(unittest.TestCase):
+    def setUp(self):
+        profiling.reset()
+        self.addCleanup(profiling.reset)
+
+    def test_output_tail_is_bounded(self):
+        tail = runner.OutputTail(max_bytes=10)
+        for i in range(10):
+            tail.append("line{}\n".format(i))
+        self.assertEqual(tail.text(), "line9\n")
+        self.assertEqual(tail.total, 60)
+        # a single line longer than the limit is kept
+        tail.append("x" * 20)
+        self.assertEqual(tail.text(), "x" * 20)
+
+    def test_commands(self):
+        output = runner.check_output([sys.executable, "-c", "print('x' * 9)"],
+                                     universal_newlines=False)
+        self.assertEqual(output, b"x" * 9 + b"\n")
+        self.assertEqual(runner.call([sys.executable, "-c", "raise SystemExit(3)"]), 3)
+        with self.assertRaises(runner.CommandError) as cm:
+            runner.check_output(["/bin/sh", "-c", "echo failing; exit 4"])
+        self.assertEqual(cm.exception.returncode, 4)
+        self.assertEqual(cm.exception.output, "failing\n")
+        self.assertIn("failing", str(cm.exception))
+        records = profiling.records()
+        self.assertEqual([(r["kind"], r["exit_code"], r["output_bytes"]) for r in records],
+                         [("command", 0, 10), ("command", 3, 0), ("command", 4, 8)])
+        self.assertEqual(records[2]["name"], "echo failing; exit 4")
+
+    def test_tail_and_capture(self):
+        script = "import sys\nfor i in range(1000): print(i)\nprint('warning', file=sys.stderr)"
+        result = runner.run([sys.executable, "-c", script], tail_bytes=20)
+        self.assertLessEqual(len(result.output), 20)
+        self.assertTrue(result.output.endswith("warning\n"))
+        # captured stdout is complete, stderr is not part of it
+        result = runner.run([sys.executable, "-c", script], capture=True, tail_bytes=20)
+        self.assertEqual(result.output.splitlines(), [str(i) for i in range(1000)])
+
+    def test_timeout(self):
+        start = time.monotonic()
+        with self.assertRaises(runner.CommandTimeout) as cm:
+            runner.run(["/bin/sh", "-c", "echo started; sleep 5"], timeout=0.5)
+        self.assertLess(time.monotonic() - start, 4)
+        self.assertEqual(cm.exception.timeout, 0.5)
+        self.assertEqual(cm.exception.output, "started\n")
+        self.assertIn("timed out", str(cm.exception))
+
+    def test_progress_is_throttled(self):
+        messages = []
+        with patch.object(runner, "PROGRESS_INTERVAL", 3600):
+            with runner.progress(messages.append):
+                runner.run(["/bin/sh", "-c", "echo one; echo two"], name="count")
+        self.assertEqual(messages, ["count: one"])
+        # the handler is only set within the context
+        runner.run(["/bin/sh", "-c", "echo three"])
+        self.assertEqual(messages, ["count: one"])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,83 @@
+# Copyright 2021 Márton Kiss
+# See LICENSE file for licensing details.
+
+import os
+import sys
+import tempfile
+import unittest
+sys.path.append('lib')
+
+from gitlab_helpers import profiling, templating  # noqa: E402
+
+
+class TestRenderEngine(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.addCleanup(profiling.reset)
+        self.root = os.path.join(self.tmp.name, "templates")
+        for name in ("13-12-stable", "14-3-stable", "15-0-stable"):
+            os.makedirs(os.path.join(self.root, name))
+        self._template("14-3-stable/a.conf.j2", "host {{ fqdn }} port {{ port }}\n")
+        self._template("14-3-stable/b.conf.j2", "email {{ email_from }}\n")
+        self.cache_dir = os.path.join(self.tmp.name, "cache")
+        self.engine = templating.RenderEngine("14-3-stable", root=self.root,
+                                              cache_dir=self.cache_dir)
+
+    def _template(self, name, content):
+        with open(os.path.join(self.root, name), "w") as f:
+            f.write(content)
+
+    def _files(self):
+        return [
+            templating.TemplateFile("a.conf.j2", os.path.join(self.tmp.name, "a.conf"),
+                                    {"port": 80}, perms=0o640),
+            templating.TemplateFile("b.conf.j2", os.path.join(self.tmp.name, "b.conf")),
+        ]
+
+    def _read(self, name):
+        with open(os.path.join(self.tmp.name, name)) as f:
+            return f.read()
+
+    def test_template_set(self):
+        self.assertEqual(templating.template_set("14-3-stable", self.root), "14-3-stable")
+        self.assertEqual(templating.template_set("14.3.1", self.root), "14-3-stable")
+        # no template changes since the release before
+        self.assertEqual(templating.template_set("14-10-stable", self.root), "14-3-stable")
+        self.assertEqual(templating.template_set("v15.2.0", self.root), "15-0-stable")
+        with self.assertRaises(templating.TemplateError):
+            templating.template_set("13.0.0", self.root)
+        with self.assertRaises(templating.TemplateError):
+            templating.template_set("master", self.root)
+
+    def test_render_all(self):
+        context = {"fqdn": "gitlab.example.com", "email_from": "gitlab@example.com"}
+        changed = self.engine.render_all(self._files(), context)
+        self.assertEqual(changed, {os.path.join(self.tmp.name, "a.conf"): True,
+                                   os.path.join(self.tmp.name, "b.conf"): True})
+        self.assertEqual(self._read("a.conf"), "host gitlab.example.com port 80")
+        self.assertEqual(self._read("b.conf"), "email gitlab@example.com")
+        self.assertEqual(os.stat(os.path.join(self.tmp.name, "a.conf")).st_mode & 0o777, 0o640)
+        # compiled templates are kept for the next hook
+        self.assertEqual(len(os.listdir(self.cache_dir)), 2)
+
+        engine = templating.RenderEngine("14-3-stable", root=self.root,
+                                         cache_dir=self.cache_dir)
+        context["email_from"] = "noreply@example.com"
+        changed = engine.render_all(self._files(), context)
+        self.assertEqual(list(changed.values()), [False, True])
+        self.assertEqual(self._read("b.conf"), "email noreply@example.com")
+        self.assertEqual(sorted(os.listdir(self.tmp.name)),
+                         ["a.conf", "b.conf", "cache", "templates"])
+        self.assertEqual([r["name"] for r in profiling.records()],
+                         ["a.conf.j2", "b.conf.j2"] * 2)
+
+    def test_broken_template_writes_nothing(self):
+        self._template("14-3-stable/b.conf.j2", "{{ email_from | no_such_filter }}\n")
+        with self.assertRaises(Exception):
+            self.engine.render_all(self._files(), {"fqdn": "localhost"})
+        self.assertFalse(os.path.exists(os.path.join(self.tmp.name, "a.conf")))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,153 @@
+# Copyright 2021 Márton Kiss
+# See LICENSE file for licensing details.
+
+import sys
+import unittest
+sys.path.append('lib')
+
+from gitlab_helpers import tuning  # noqa: E402
+
+GB = tuning.GB
+
+
+class TestPumaSettings(unittest.TestCase):
+    def test_large_host_is_bounded_by_cpus(self):
+        settings = tuning.puma_settings(32, 128 * GB)
+        self.assertEqual(settings["workers"], 32)
+        self.assertEqual(settings["min_threads"], 4)
+        self.assertEqual(settings["max_threads"], 4)
+        self.assertEqual(settings["worker_max_memory_mb"], 1200)
+
+    def test_small_host_is_bounded_by_memory(self):
+        settings = tuning.puma_settings(8, int(1.5 * GB))
+        self.assertEqual(settings["workers"], 1)
+        self.assertEqual(settings["worker_max_memory_mb"], 1024)
+        settings = tuning.puma_settings(8, int(2.5 * GB))
+        self.assertEqual(settings["workers"], 2)
+        settings = tuning.puma_settings(8, int(6.5 * GB))
+        self.assertEqual(settings["workers"], 5)
+
+    def test_memory_budget(self):
+        self.assertEqual(tuning.memory_budget(8 * GB), int(6.5 * GB))
+        self.assertEqual(tuning.memory_budget(GB), 0)
+
+    def test_explicit_values_win(self):
+        settings = tuning.puma_settings(32, 128 * GB, workers=3, min_threads=1,
+                                        max_threads=16, worker_timeout=120,
+                                        worker_max_memory_mb=2048)
+        self.assertEqual(settings, {"workers": 3, "min_threads": 1, "max_threads": 16,
+                                    "worker_timeout": 120, "worker_max_memory_mb": 2048})
+
+
+class TestRedisSettings(unittest.TestCase):
+    def test_profile_memory_share(self):
+        self.assertEqual(tuning.redis_memory("cache-heavy", 16 * GB), {None: 4 * GB})
+        self.assertEqual(tuning.redis_memory("default", 16 * GB), {None: 0})
+        settings = tuning.redis_settings("cache-heavy", 8, maxmemory=4 * GB)
+        self.assertEqual(settings["maxmemory"], 4 * GB)
+        self.assertEqual(settings["maxmemory_policy"], "allkeys-lru")
+        self.assertEqual(settings["save"], [])
+
+    def test_maxmemory_override(self):
+        memory = tuning.redis_memory("durable-aof", 16 * GB, maxmemory_mb=512)
+        self.assertEqual(memory, {None: 512 * tuning.MB})
+
+    def test_split_instances_share_the_redis_memory(self):
+        instances = {"cache": 0.5, "queues": 0.25}
+        memory = tuning.redis_memory("durable-aof", 16 * GB, instances=instances)
+        self.assertEqual(memory, {None: 2 * GB, "cache": 4 * GB, "queues": 2 * GB})
+        # the main instance stays without a limit
+        memory = tuning.redis_memory("default", 16 * GB, instances=instances)
+        self.assertEqual(memory, {None: 0, "cache": 4 * GB, "queues": 2 * GB})
+
+    def test_io_threads_need_support(self):
+        self.assertEqual(tuning.redis_settings("cache-heavy", 16)["io_threads"], 1)
+        settings = tuning.redis_settings("cache-heavy", 16, io_threads_supported=True)
+        self.assertEqual(settings["io_threads"], 4)
+
+    def test_unknown_profile(self):
+        with self.assertRaises(ValueError):
+            tuning.redis_settings("fast", 1)
+        with self.assertRaises(ValueError):
+            tuning.redis_memory("fast", GB)
+
+
+class TestPgbouncerSettings(unittest.TestCase):
+    def test_pool_is_derived_from_clients(self):
+        settings = tuning.pgbouncer_settings(64)
+        self.assertEqual(settings["max_client_conn"], 64 + tuning.PGBOUNCER_CLIENT_HEADROOM)
+        self.assertEqual(settings["default_pool_size"], 32)
+        self.assertEqual(settings["reserve_pool_size"], 8)
+        self.assertEqual(settings["max_db_connections"], 40)
+
+    def test_small_and_explicit_pools(self):
+        self.assertEqual(tuning.pgbouncer_settings(4)["default_pool_size"], 10)
+        self.assertEqual(tuning.pgbouncer_settings(64, pool_size=20)["default_pool_size"], 20)
+
+
+class TestSidekiqSettings(unittest.TestCase):
+    def test_auto_sizing(self):
+        settings = tuning.sidekiq_settings(32, 128 * GB)
+        self.assertEqual(settings["processes"], 8)
+        self.assertEqual(settings["concurrency"], 20)
+        self.assertEqual(settings["queue_groups"], ["*"] * 8)
+        self.assertEqual(tuning.sidekiq_settings(2, 4 * GB)["processes"], 1)
+
+    def test_queue_groups(self):
+        settings = tuning.sidekiq_settings(4, 8 * GB, processes=2,
+                                           queue_groups=["name=pipeline_processing", ""])
+        self.assertEqual(settings["queue_groups"], ["name=pipeline_processing", "*"])
+        settings = tuning.sidekiq_settings(4, 8 * GB, processes=1, queue_groups=["a", "b"])
+        self.assertEqual(settings["processes"], 2)
+
+    def test_db_pool_size(self):
+        puma = {"max_threads": 4}
+        sidekiq = {"concurrency": 20}
+        self.assertEqual(tuning.db_pool_size(puma, sidekiq), (30, 20))
+        self.assertEqual(tuning.db_pool_size(puma, sidekiq, pool_size=15), (15, 20))
+
+
+class TestNginxSettings(unittest.TestCase):
+    def test_defaults(self):
+        settings = tuning.nginx_settings(8)
+        self.assertEqual(settings["worker_processes"], 8)
+        self.assertEqual(settings["worker_connections"], tuning.NGINX_WORKER_CONNECTIONS)
+        self.assertEqual(settings["worker_rlimit_nofile"], 2 * tuning.NGINX_WORKER_CONNECTIONS)
+        self.assertEqual(settings["upstream_keepalive"], tuning.NGINX_UPSTREAM_KEEPALIVE)
+
+    def test_overrides(self):
+        settings = tuning.nginx_settings(0, worker_connections=1024, upstream_keepalive=8)
+        self.assertEqual(settings["worker_processes"], 1)
+        self.assertEqual(settings["worker_rlimit_nofile"], 2048)
+        self.assertEqual(settings["upstream_keepalive"], 8)
+
+    def test_cache_size_from_disk(self):
+        settings = tuning.nginx_cache_settings(100 * GB, 80 * GB)
+        self.assertEqual(settings, {"max_size_mb": 10240, "keys_zone_mb": 6, "inactive": "1d"})
+        # at most half of the free space, not below the minimum
+        settings = tuning.nginx_cache_settings(100 * GB, 3 * GB)
+        self.assertEqual(settings["max_size_mb"], 1536)
+        self.assertEqual(settings["inactive"], "6h")
+        settings = tuning.nginx_cache_settings(100 * GB, 0)
+        self.assertEqual(settings["max_size_mb"], tuning.NGINX_CACHE_MIN_SIZE_MB)
+        self.assertEqual(settings["inactive"], "1h")
+        self.assertEqual(tuning.nginx_cache_settings(10 * GB, 10 * GB, max_size_mb=100)
+                         ["max_size_mb"], 100)
+
+
+class TestGitalySettings(unittest.TestCase):
+    def test_host_defaults(self):
+        settings = tuning.gitaly_settings(8, 16 * GB)
+        self.assertEqual(settings["upload_pack_concurrency"], 8)
+        self.assertEqual(settings["catfile_cache_size"], tuning.GITALY_CATFILE_CACHE_SIZE)
+        self.assertEqual(settings["git_memory_limit"], 8 * GB)
+        self.assertEqual(tuning.gitaly_settings(1, 4 * GB)["upload_pack_concurrency"], 2)
+
+    def test_overrides(self):
+        settings = tuning.gitaly_settings(8, 16 * GB, upload_pack_concurrency=3,
+                                          pack_objects_cache_max_age="10m",
+                                          git_memory_limit_mb=2048, git_cpu_shares=256)
+        self.assertEqual(settings["upload_pack_concurrency"], 3)
+        self.assertEqual(settings["pack_objects_cache_max_age"], "10m")
+        self.assertEqual(settings["git_memory_limit"], 2 * GB)
+        self.assertEqual(settings["git_cpu_shares"], 256)